@@ -0,0 +1,102 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+'''Reports the accuracy of the scalable clustering engines of
+make_hierarchy against exact UPGMA (average linkage).
+
+Usage: python benchmarks/linkage_accuracy.py [CSI folder or .qza ...]
+
+Without arguments the CSI:FingerID results bundled with the tests are
+used, together with synthetic fingerprints drawn from a
+hierarchy of molecular families. For every dataset, metric and engine
+the cophenetic correlation with the exact UPGMA tree, the normalized
+Robinson-Foulds distance to it and the run time are printed.
+'''
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import linkage, cophenet
+from skbio import TreeNode
+
+from q2_qemistree._process_fingerprint import collate_fingerprint
+from q2_qemistree._distances import (FingerprintDistances,
+                                     condensed_distances)
+from q2_qemistree._linkage import mst_single_linkage, knn_average_linkage
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'q2_qemistree')
+REFERENCE = [os.path.join(ROOT, 'tests', 'data', 'goodcsi', 'csi-output'),
+             os.path.join(ROOT, 'tests', 'data', 'csiFolder2.qza')]
+
+
+def synthetic_fingerprints(n_families: int, n_subfamilies: int,
+                           n_members: int, n_bits: int = 2936,
+                           seed: int = 0) -> pd.DataFrame:
+    '''Fingerprint probabilities of molecules in families and subfamilies
+    that share most of their substructures'''
+    rng = np.random.RandomState(seed)
+    rows = []
+    for _ in range(n_families):
+        family = rng.rand(n_bits) < 0.15
+        for _ in range(n_subfamilies):
+            subfamily = family ^ (rng.rand(n_bits) < 0.03)
+            for _ in range(n_members):
+                member = subfamily ^ (rng.rand(n_bits) < 0.01)
+                rows.append(np.clip(member * 0.9 + rng.rand(n_bits) * 0.2,
+                                    0, 1))
+    return pd.DataFrame(np.array(rows))
+
+
+def engines(n: int) -> list:
+    return [('single-mst', lambda d: mst_single_linkage(d))] + [
+        ('knn-upgma (k=%d)' % k,
+         lambda d, k=k: knn_average_linkage(d, n_neighbors=k))
+        for k in (10, 30, 100) if k < n - 1]
+
+
+def report(name: str, fingerprints: pd.DataFrame):
+    n = fingerprints.shape[0]
+    ids = [str(i) for i in range(n)]
+    for metric in ['euclidean', 'jaccard']:
+        fps = fingerprints
+        if metric == 'jaccard':
+            fps = (fingerprints > 0.5).astype(int)
+        start = time.time()
+        exact = linkage(condensed_distances(fps, metric), method='average')
+        elapsed = time.time() - start
+        exact_tree = TreeNode.from_linkage_matrix(exact, ids)
+        print('%s\tN=%d\t%s\tupgma\t1.000\t0.000\t%.2fs' % (
+            name, n, metric, elapsed))
+        for engine, cluster in engines(n):
+            start = time.time()
+            approx = cluster(FingerprintDistances(fps, metric))
+            elapsed = time.time() - start
+            coph = np.corrcoef(cophenet(approx), cophenet(exact))[0, 1]
+            rfd = exact_tree.compare_rfd(
+                TreeNode.from_linkage_matrix(approx, ids), proportion=True)
+            print('%s\tN=%d\t%s\t%s\t%.3f\t%.3f\t%.2fs' % (
+                name, n, metric, engine, coph, rfd, elapsed))
+
+
+def main(paths: list):
+    print('dataset\tsize\tmetric\tengine\tcophenetic r\tnormalized RF\t'
+          'time')
+    datasets = [(os.path.basename(path), collate_fingerprint(path))
+                for path in paths or REFERENCE]
+    if not paths:
+        datasets.append(('synthetic', synthetic_fingerprints(20, 5, 10)))
+        datasets.append(('synthetic', synthetic_fingerprints(40, 10, 10)))
+    for name, fingerprints in datasets:
+        if fingerprints.shape[0] > 2:
+            report(name, fingerprints)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+'''Times merge_feature_data on many feature-data frames that share most of
+their molecules, as when dozens of batches of one study are merged.
+
+Usage: python benchmarks/merge_feature_data.py [n_tables n_features n_unique]
+
+Every frame holds ``n_features`` features whose MD5 labels are drawn from a
+pool of ``n_unique`` fingerprints, so that the same label repeats across
+(and within) tables. The defaults merge 200 frames of 500 features drawn
+from 2000 molecules.
+'''
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from q2_qemistree._hierarchy import merge_feature_data
+
+
+def feature_data(n_tables: int, n_features: int, n_unique: int,
+                 seed: int = 0) -> list:
+    '''
+    Returns ``n_tables`` feature-data frames shaped like the output of
+    get_matched_tables, with labels drawn from ``n_unique`` hashes.
+    '''
+    rng = np.random.RandomState(seed)
+    fdata = []
+    for table in range(n_tables):
+        labels = ['%032x' % i for i in rng.randint(0, n_unique, n_features)]
+        fdata.append(pd.DataFrame(
+            {'#featureID': ['%d_%d' % (table, i) for i in range(n_features)],
+             'csi_smiles': 'C',
+             'ms2_smiles': 'missing',
+             'ms2_library_match': 'missing',
+             'parent_mass': rng.rand(n_features).astype(str),
+             'retention_time': rng.rand(n_features).astype(str)},
+            index=pd.Index(labels, name='label')))
+    return fdata
+
+
+def main(args: list):
+    n_tables, n_features, n_unique = [int(i) for i in args] or [200, 500,
+                                                                2000]
+    fdata = feature_data(n_tables, n_features, n_unique)
+    start = time.time()
+    merged = merge_feature_data(fdata)
+    print('tables\tfeatures per table\tmerged features\ttime')
+    print('%d\t%d\t%d\t%.3f' % (n_tables, n_features, merged.shape[0],
+                                time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
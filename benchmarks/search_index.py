@@ -0,0 +1,60 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+'''Times building a fingerprint search index and querying it.
+
+Usage: python benchmarks/search_index.py [n_fingerprints n_columns n_queries]
+
+Fingerprints are float32 probabilities scattered around 2000 molecules, and
+queries are drawn from them. The defaults index one million fingerprints of
+512 columns and look up ten of them.
+'''
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from q2_qemistree._search import (build_fingerprint_index,
+                                  query_fingerprint_index)
+
+
+def fingerprints(n_fingerprints: int, n_columns: int,
+                 seed: int = 0) -> pd.DataFrame:
+    '''
+    Returns ``n_fingerprints`` float32 fingerprints drawn around 2000
+    random molecules.
+    '''
+    rng = np.random.RandomState(seed)
+    centers = rng.rand(2000, n_columns).astype(np.float32)
+    fps = np.empty((n_fingerprints, n_columns), dtype=np.float32)
+    for start in range(0, n_fingerprints, 100000):
+        stop = min(start + 100000, n_fingerprints)
+        fps[start:stop] = centers[rng.randint(0, 2000, stop - start)] + \
+            rng.normal(0, 0.05, (stop - start, n_columns))
+    return pd.DataFrame(fps, index=['%032x' % i
+                                    for i in range(n_fingerprints)])
+
+
+def main(args: list):
+    n_fingerprints, n_columns, n_queries = [int(i) for i in args] or [
+        1000000, 512, 10]
+    fps = fingerprints(n_fingerprints, n_columns)
+    start = time.time()
+    index = build_fingerprint_index(fps)
+    built = time.time() - start
+    queries = fps.iloc[np.random.RandomState(1).randint(0, n_fingerprints,
+                                                        n_queries)]
+    start = time.time()
+    query_fingerprint_index(index, queries)
+    print('fingerprints\tcolumns\tqueries\tbuild time\tquery time')
+    print('%d\t%d\t%d\t%.3f\t%.3f' % (n_fingerprints, n_columns, n_queries,
+                                      built, time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -10,17 +10,33 @@ from ._version import get_versions
 from ._fingerprint import (compute_fragmentation_trees,
                            rerank_molecular_formulas,
                            predict_fingerprints)
-from ._classyfire import get_classyfire_taxonomy
-from ._hierarchy import make_hierarchy
+from ._classyfire import get_classyfire_taxonomy, get_canopus_taxonomy
+from ._hierarchy import (make_hierarchy, collate_fingerprints,
+                         fingerprint_distances)
+from ._add_to_hierarchy import add_to_hierarchy
+from ._search import build_fingerprint_index, query_fingerprint_index
 from ._prune_hierarchy import prune_hierarchy
 from ._semantics import (MassSpectrometryFeatures, MGFDirFmt,
                          CSIFolder, CSIDirFmt, ZodiacFolder, ZodiacDirFmt,
-                         SiriusFolder, SiriusDirFmt, OutputDirs)
+                         SiriusFolder, SiriusDirFmt, OutputDirs,
+                         MolecularFingerprint, MolecularFingerprintDirFmt,
+                         FingerprintIndex, FingerprintIndexDirFmt,
+                         FingerprintNeighbors, FingerprintNeighborsDirFmt,
+                         CondensedDistanceMatrix,
+                         CondensedDistanceMatrixDirFmt)
 
 __all__ = ['compute_fragmentation_trees', 'rerank_molecular_formulas',
-           'predict_fingerprints', 'make_hierarchy', 'get_classyfire_taxonomy',
+           'predict_fingerprints', 'make_hierarchy', 'add_to_hierarchy',
+           'collate_fingerprints', 'fingerprint_distances',
+           'build_fingerprint_index', 'query_fingerprint_index',
+           'get_classyfire_taxonomy', 'get_canopus_taxonomy',
            'prune_hierarchy', 'plot', 'MassSpectrometryFeatures', 'MGFDirFmt',
            'CSIFolder', 'CSIDirFmt', 'ZodiacFolder', 'ZodiacDirFmt',
-           'SiriusFolder', 'SiriusDirFmt', 'OutputDirs']
+           'SiriusFolder', 'SiriusDirFmt', 'OutputDirs',
+           'MolecularFingerprint', 'MolecularFingerprintDirFmt',
+           'FingerprintIndex', 'FingerprintIndexDirFmt',
+           'FingerprintNeighbors', 'FingerprintNeighborsDirFmt',
+           'CondensedDistanceMatrix',
+           'CondensedDistanceMatrixDirFmt']
 
 __version__ = get_versions()['version']
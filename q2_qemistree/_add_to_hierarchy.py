@@ -0,0 +1,255 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import biom
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from skbio import TreeNode
+from q2_feature_table import merge
+
+from ._process_fingerprint import collate_fingerprint
+from ._match import _md5_rows
+from ._semantics import CSIDirFmt
+from ._distances import FingerprintDistances, _BLOCK_SIZE
+from ._hierarchy import (_process_datasets, _merge_fingerprints,
+                         _build_linkage_tree, merge_feature_data)
+
+
+def _reference_fingerprints(csi_results: CSIDirFmt, tips: list,
+                            metric: str = 'euclidean', cache_dir: str = None,
+                            n_jobs: int = 1,
+                            precision: str = 'float64') -> pd.DataFrame:
+    '''
+    Collates the CSI:FingerID results the tree was built from and returns
+    the fingerprints of its tips, indexed by their MD5 hash.
+    '''
+    found = []
+    for csi_result in csi_results:
+        fps = collate_fingerprint(csi_result, metric, n_jobs=n_jobs,
+                                  cache_dir=cache_dir, precision=precision)
+        fps.index = _md5_rows(fps.values, n_jobs)
+        found.append(fps[fps.index.isin(tips)])
+    return _check_reference(_merge_fingerprints(found), tips)
+
+
+def _check_reference(reference: pd.DataFrame, tips: list) -> pd.DataFrame:
+    '''Makes sure that every tip of the tree has a reference fingerprint'''
+    missing = set(tips) - set(reference.index)
+    if missing:
+        raise ValueError('The fingerprints of %d tips of the tree were not '
+                         'found in the reference fingerprints. Please check '
+                         'that they are those the tree was built from, with '
+                         'the same metric.' % len(missing))
+    return reference
+
+
+def _nearest_placed(distances: FingerprintDistances, n_reference: int,
+                    n_jobs: int = 1) -> (np.ndarray, np.ndarray):
+    '''
+    For every fingerprint after the first ``n_reference`` ones, finds the
+    closest fingerprint among the reference and the new fingerprints that
+    precede it, i.e. those already placed when it is inserted.
+    '''
+    n = distances.n
+    nearest = np.empty(n - n_reference, dtype=np.int64)
+    nearest_dists = np.empty(n - n_reference)
+    block_rows = max(1, _BLOCK_SIZE // n)
+
+    def fill(start):
+        stop = min(start + block_rows, n)
+        dists = distances.rows(np.arange(start, stop))
+        dists[np.arange(n)[None, :] >= np.arange(start, stop)[:, None]] = \
+            np.inf
+        rows = slice(start - n_reference, stop - n_reference)
+        nearest[rows] = dists.argmin(axis=1)
+        nearest_dists[rows] = dists[np.arange(stop - start), nearest[rows]]
+
+    starts = range(n_reference, n, block_rows)
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(fill, starts))
+    else:
+        for start in starts:
+            fill(start)
+    return nearest, nearest_dists
+
+
+def place_fingerprints(tree: TreeNode, reference: pd.DataFrame,
+                       new: pd.DataFrame, metric: str = 'euclidean',
+                       n_jobs: int = 1) -> TreeNode:
+    '''
+    Inserts new fingerprints into an ultrametric tree of fingerprints.
+
+    Every new fingerprint joins the tree next to its closest tip, at half
+    their distance, as UPGMA would if that tip were its last merge partner;
+    new fingerprints are placed one after the other, so that they can also
+    join one another.
+
+    Parameters
+    ----------
+    tree : skbio.TreeNode
+        tree of relatedness of molecules; tips are labeled by the MD5 hash
+        of their fingerprint
+    reference : pd.DataFrame
+        fingerprints of the tips of ``tree`` (index)
+    new : pd.DataFrame
+        fingerprints to insert, indexed by MD5 hash; none of them may be a
+        tip of ``tree``
+    metric : str, default `euclidean`
+        metric the tree was built with
+    n_jobs : int, default 1
+        number of threads used to compute distances
+
+    Returns
+    -------
+    skbio.TreeNode
+        the tree with the new fingerprints as tips; ``tree`` is modified in
+        place
+    '''
+    fingerprints = pd.concat([reference, new])
+    nearest, nearest_dists = _nearest_placed(
+        FingerprintDistances(fingerprints, metric), reference.shape[0],
+        n_jobs)
+    height = {}
+    for node in tree.postorder(include_self=True):
+        height[node] = (0.0 if node.is_tip() else
+                        height[node.children[0]] + node.children[0].length)
+    tips = {tip.name: tip for tip in tree.tips()}
+    names = list(fingerprints.index)
+    for name, neighbor, dist in zip(new.index, nearest, nearest_dists):
+        node, join_height = tips[names[neighbor]], dist / 2
+        while node.parent is not None and height[node.parent] <= join_height:
+            node = node.parent
+        tip = TreeNode(name=name, length=join_height)
+        joint = TreeNode()
+        parent = node.parent
+        if parent is not None:
+            joint.length = height[parent] - join_height
+            parent.remove(node)
+        node.length = join_height - height[node]
+        joint.extend([node, tip])
+        if parent is not None:
+            parent.append(joint)
+        else:
+            tree = joint
+        height[tip], height[joint] = 0.0, join_height
+        tips[name] = tip
+    return tree
+
+
+def add_to_hierarchy(tree: TreeNode,
+                     feature_table: biom.Table,
+                     feature_data: pd.DataFrame,
+                     csi_results: CSIDirFmt,
+                     feature_tables: biom.Table,
+                     reference_csi_results: CSIDirFmt = None,
+                     reference_fingerprints: pd.DataFrame = None,
+                     library_matches: pd.DataFrame = None,
+                     metric: str = 'euclidean',
+                     cache_dir: str = None,
+                     max_drift: float = 0.2,
+                     distance_dtype: str = 'float64',
+                     distance_dir: str = None,
+                     n_jobs: int = 1,
+                     clustering: str = 'upgma',
+                     n_neighbors: int = 30,
+                     n_workers: int = 1,
+                     precision: str = 'float64') -> (TreeNode, biom.Table,
+                                                     pd.DataFrame):
+    '''
+    This function adds new datasets to a hierarchy built by make_hierarchy.
+    Only the new CSI:FingerID results are collated and matched to their
+    feature tables; feature tables and feature data are merged with the
+    previous ones, and fingerprints that are not yet in the tree are placed
+    next to their closest tip. If there are too many of them, the tree is
+    rebuilt from all fingerprints instead.
+
+    Parameters
+    ----------
+    tree : skbio.TreeNode
+        tree of relatedness of molecules built by make_hierarchy
+    feature_table : biom.Table
+        merged feature table built by make_hierarchy
+    feature_data : pd.DataFrame
+        merged feature data built by make_hierarchy
+    csi_results : CSIDirFmt
+        one or more new CSI:FingerID output folders
+    feature_tables : biom.Table
+        one or more new feature tables with mass-spec feature intensity per
+        sample
+    reference_csi_results : CSIDirFmt, optional
+        CSI:FingerID output folders the tree was built from; used to look up
+        the fingerprints of its tips (cheap when ``cache_dir`` holds them)
+    reference_fingerprints : pd.DataFrame, optional
+        fingerprints of the tips of the tree, as made by
+        collate_fingerprints; used instead of ``reference_csi_results``
+    library_matches : pd.DataFrame, optional
+        one or more tables with MS/MS library match for the new features
+    metric : str, default `euclidean`
+        metric the tree was built with
+    cache_dir : str, optional
+        directory where collated fingerprints are cached between runs
+    max_drift : float, default 0.2
+        largest number of new fingerprints, as a fraction of the tips of
+        ``tree``, that are placed into it; beyond it the tree is rebuilt
+    distance_dtype, distance_dir, clustering, n_neighbors
+        as in make_hierarchy; used when the tree is rebuilt
+    n_jobs : int, default 1
+        number of threads used to read fingerprint files and to compute
+        distances
+    n_workers : int, default 1
+        number of processes that process the new datasets in parallel
+    precision : str, default `float64`
+        precision of the fingerprint probabilities the tree was built with
+
+    Raises
+    ------
+    ValueError
+        If neither ``reference_csi_results`` nor ``reference_fingerprints``
+        are given
+        If a tip of ``tree`` has no reference fingerprint
+        If the inputs of the new datasets are invalid (as in make_hierarchy)
+
+    Returns
+    -------
+    skbio.TreeNode
+        tree of relatedness of the previous and new molecules
+    biom.Table
+        merged feature table, indexed by the MD5 hash of fingerprint vectors
+    pd.DataFrame
+        merged feature data, indexed by the MD5 hash of fingerprint vectors
+    '''
+    if reference_csi_results is None and reference_fingerprints is None:
+        raise ValueError('The fingerprints of the tips of the tree are '
+                         'needed; please provide the reference CSI:FingerID '
+                         'results or fingerprints.')
+    fps, fts, fdata = _process_datasets(csi_results, feature_tables,
+                                        library_matches, metric, cache_dir,
+                                        n_jobs, n_workers, precision)
+    tips = [tip.name for tip in tree.tips()]
+    merged_fps = _merge_fingerprints(fps)
+    new_fps = merged_fps[~merged_fps.index.isin(tips)]
+    if reference_fingerprints is not None:
+        reference = _check_reference(
+            reference_fingerprints[reference_fingerprints.index.isin(tips)],
+            tips)
+    else:
+        reference = _reference_fingerprints(reference_csi_results, tips,
+                                            metric, cache_dir, n_jobs,
+                                            precision)
+    merged_fdata = merge_feature_data(fdata, previous=feature_data)
+    merged_fts = merge([feature_table] + fts,
+                       overlap_method='error_on_overlapping_sample')
+    if new_fps.shape[0] > max_drift * len(tips):
+        tree = _build_linkage_tree(pd.concat([reference, new_fps]), metric,
+                                   distance_dtype, distance_dir, n_jobs,
+                                   clustering, n_neighbors).to_treenode()
+    elif not new_fps.empty:
+        tree = place_fingerprints(tree, reference, new_fps, metric, n_jobs)
+    return tree, merged_fts, merged_fdata
@@ -6,23 +6,267 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import time
+import json
+import threading
 import requests
 import pandas as pd
 import numpy as np
 import warnings
 import urllib
+from requests.adapters import HTTPAdapter
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
+from ._lookup_cache import LookupCache
+from ._process_fingerprint import _open_csi_result
+from ._semantics import CSIDirFmt
 
-def get_classyfire_taxonomy(feature_data: pd.DataFrame) -> pd.DataFrame:
+_INCHIKEY_URL = 'https://gnps-structure.ucsd.edu/inchikey?smiles='
+_CLASSYFIRE_URL = 'https://gnps-classyfire.ucsd.edu/entities/'
+CLASSYFIRE_LEVELS = ['kingdom', 'superclass', 'class', 'subclass',
+                     'direct_parent']
+# columns of canopus_summary.tsv that hold the ClassyFire levels
+_CANOPUS_LEVELS = {'superclass': 'superclass', 'class': 'class',
+                   'subclass': 'subclass',
+                   'direct_parent': 'most specific class'}
+_KINGDOMS = ['Organic compounds', 'Inorganic compounds']
+# label of features whose lookups got no response at all
+_NO_RESPONSE = 'no server response'
+
+
+class _RateLimiter:
+    '''Spaces the requests of all threads to every host at least
+    1 / ``max_rate`` seconds apart'''
+
+    def __init__(self, max_rate: float = None):
+        self.interval = 1 / max_rate if max_rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url: str):
+        if not self.interval:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        time.sleep(slot - now)
+
+
+class _HttpClient:
+    '''
+    Sends the GET requests of a run through one pooled session, retrying
+    transient failures, and counts requests, retries, failures and their
+    latency.
+
+    Responses with a retryable status code, time-outs and connection errors
+    are retried up to ``max_retries`` times, waiting ``backoff`` seconds
+    and then twice as long every time (or as long as the server asks in a
+    Retry-After header). Every attempt waits for its turn on ``limiter``.
+
+    Parameters
+    ----------
+    limiter : _RateLimiter
+        spaces the requests sent to every host
+    n_connections : int, default 1
+        largest number of connections kept open to every host
+    timeout : float, default 30
+        seconds to wait for a server to accept a connection or to answer
+    max_retries : int, default 3
+        largest number of times a request is retried
+    backoff : float, default 0.5
+        seconds to wait before the first retry
+    '''
+
+    # 500 is not retried: GNPS answers it to SMILES it cannot parse
+    RETRY_STATUS = (429, 502, 503, 504)
+
+    def __init__(self, limiter: _RateLimiter, n_connections: int = 1,
+                 timeout: float = 30, max_retries: int = 3,
+                 backoff: float = 0.5):
+        self.limiter = limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=max(1, n_connections))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0,
+                      'latency': 0.0, 'max_latency': 0.0}
+
+    def _count(self, latency: float, retry: bool, failure: bool):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['retries'] += retry
+            self.stats['failures'] += failure
+            self.stats['latency'] += latency
+            self.stats['max_latency'] = max(self.stats['max_latency'],
+                                            latency)
+
+    def _delay(self, attempt: int, response: requests.Response) -> float:
+        delay = self.backoff * 2 ** attempt
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers['Retry-After']))
+            except (KeyError, ValueError):
+                pass
+        return delay
+
+    def get(self, url: str) -> tuple:
+        '''Returns the status code and text of the response to a request,
+        or None and the name and message of the network error if no
+        response came'''
+        for attempt in range(self.max_retries + 1):
+            self.limiter.wait(url)
+            start = time.monotonic()
+            response = error = None
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            retry = (error is not None or
+                     response.status_code in self.RETRY_STATUS)
+            last = attempt == self.max_retries
+            self._count(time.monotonic() - start, retry and not last,
+                        retry and last)
+            if not retry or last:
+                break
+            time.sleep(self._delay(attempt, response))
+        if error is not None:
+            return None, '%s: %s' % (type(error).__name__, error)
+        return response.status_code, response.text
+
+    def close(self):
+        self.session.close()
+
+    def summary(self) -> str:
+        stats = self.stats
+        return ('Sent %d requests (%d retried, %d failed); mean latency '
+                '%.3f s, slowest %.3f s.' % (
+                    stats['requests'], stats['retries'], stats['failures'],
+                    stats['latency'] / max(stats['requests'], 1),
+                    stats['max_latency']))
+
+
+def _lookup(url: str, stage: str, key: str, client: _HttpClient,
+            cache: LookupCache = None) -> tuple:
+    '''Returns the status code and text of a lookup, from ``cache`` if it
+    holds it and from the server otherwise'''
+    if cache is not None:
+        cached = cache.get(stage, key)
+        if cached is not None:
+            return cached
+    status_code, text = client.get(url)
+    if cache is not None:
+        cache.put(stage, key, status_code, text)
+    return status_code, text
+
+
+def _taxonomy(response: dict):
+    '''Names of the ClassyFire levels of an entity, or `unclassified`'''
+    sublevels = [level for level in CLASSYFIRE_LEVELS if level in response]
+    if len(sublevels) == 0:
+        return 'unclassified'
+    taxonomy = []
+    for level in CLASSYFIRE_LEVELS:
+        if (response and level in sublevels and
+                response[level] is not None):
+            taxonomy.append(response[level]['name'])
+        else:
+            taxonomy.append('unclassified')
+    return taxonomy
+
+
+def _map(function, items: list, n_jobs: int = 1) -> list:
+    '''Applies ``function`` to every item, on ``n_jobs`` threads'''
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(function, items))
+    return [function(item) for item in items]
+
+
+def _inchikey(smiles: str, client: _HttpClient,
+              cache: LookupCache = None) -> tuple:
+    '''Looks up the InChIKey of a structure; returns the status code of
+    the response and the InChIKey'''
+    return _lookup(_INCHIKEY_URL + urllib.parse.quote(smiles), 'inchikey',
+                   smiles, client, cache)
+
+
+def _classify_inchikey(inchikey: str, smiles: str, client: _HttpClient,
+                       cache: LookupCache = None) -> tuple:
+    '''Looks up the ClassyFire taxonomy of an InChIKey (and one of its
+    structures); returns the taxonomy (or `unclassified`, or the label of
+    an unexpected or missing server response) and the status code of an
+    unexpected server response or the network error, if any'''
+    status_code, entity = _lookup(
+        _CLASSYFIRE_URL + str(inchikey) + '.json?smiles=' + str(smiles),
+        'classyfire', inchikey, client, cache)
+    if status_code is None:
+        return _NO_RESPONSE, entity
+    elif status_code == 200:
+        return _taxonomy(json.loads(entity)), None
+    elif status_code == 404:
+        return 'unclassified', None
+    return 'unexpected server response', status_code
+
+
+def get_classyfire_taxonomy(feature_data: pd.DataFrame,
+                            n_jobs: int = 1,
+                            max_rate: float = None,
+                            cache_dir: str = None,
+                            negative_ttl: float = 7,
+                            max_cache_age: float = None,
+                            max_cache_entries: int = None,
+                            timeout: float = 30,
+                            max_retries: int = 3,
+                            backoff: float = 0.5,
+                            verbose: bool = False) -> pd.DataFrame:
     '''This function uses structural annotations of molecules (SMILES)
     to run Classyfire and obtain chemical taxonomy for each mass-spec feature.
-    It appends chemical taxonomy of features to feature data table.
+    It appends chemical taxonomy of features to feature data table. Every
+    unique structure, and then every unique InChIKey, is looked up once and
+    its result shared by all the features it annotates.
 
     Parameters
     ----------
     feature_data : pd.DataFrame
         a table that maps MD5 hash of mass-spec features to their structural
         annotations (SMILES)
+    n_jobs : int, default 1
+        number of structures looked up at once, i.e. the largest number of
+        requests in flight
+    max_rate : float, optional
+        largest number of requests per second sent to each server; not
+        limited by default
+    cache_dir : str, optional
+        directory of a persistent cache of InChIKey and ClassyFire lookups;
+        structures found in it are not looked up again
+    negative_ttl : float, default 7
+        days after which InChIKeys and ClassyFire entities that were not
+        found are looked up again
+    max_cache_age : float, optional
+        days after which cached lookups are evicted
+    max_cache_entries : int, optional
+        largest number of cached lookups; the least recently used ones are
+        evicted
+    timeout : float, default 30
+        seconds to wait for a server to accept a connection or to answer
+    max_retries : int, default 3
+        largest number of times a request that timed out or got a transient
+        error (429, 502, 503 or 504) is retried
+    backoff : float, default 0.5
+        seconds to wait before the first retry of a request; the wait
+        doubles with every retry
+    verbose : bool, default False
+        report the number of lookups, their deduplication, the requests
+        sent and the cache hits
 
     Raises
     ------
@@ -34,6 +278,8 @@ def get_classyfire_taxonomy(feature_data: pd.DataFrame) -> pd.DataFrame:
         If SMILES could not be converted to InChIKey
         If ClassyFire server returns an unexpected response i.e anything except
         200 or 404
+        If a server did not respond after all retries, e.g. it could not be
+        reached or timed out
 
     Returns
     -------
@@ -42,8 +288,6 @@ def get_classyfire_taxonomy(feature_data: pd.DataFrame) -> pd.DataFrame:
         'superclass', 'class','subclass', 'direct_parent') per mass-spec
         feature
     '''
-    classyfire_levels = ['kingdom', 'superclass', 'class', 'subclass',
-                         'direct_parent']
     smiles = {'csi_smiles', 'ms2_smiles'}
     if not smiles.issubset(feature_data.columns):
         raise ValueError('Feature data table must contain the columns '
@@ -66,45 +310,72 @@ def get_classyfire_taxonomy(feature_data: pd.DataFrame) -> pd.DataFrame:
                          "one structural annotation to run Classyfire")
     feature_data = feature_data.fillna('missing')
 
+    # every structure, and then every InChIKey, is looked up only once
+    structures = feature_data.loc[feature_data['smiles'] != 'missing',
+                                  'smiles']
+    unique_smiles = list(structures.unique())
+    client = _HttpClient(_RateLimiter(max_rate), n_jobs, timeout,
+                         max_retries, backoff)
+    cache = None
+    if cache_dir is not None:
+        cache = LookupCache(os.path.join(cache_dir, 'classyfire.sqlite'),
+                            negative_ttl, max_cache_age, max_cache_entries)
+    try:
+        inchikeys = dict(zip(unique_smiles, _map(
+            partial(_inchikey, client=client, cache=cache), unique_smiles,
+            n_jobs)))
+        # the first structure of an InChIKey is sent along with it
+        entities = {}
+        for smiles in unique_smiles:
+            status_code, inchikey = inchikeys[smiles]
+            if status_code == 200:
+                entities.setdefault(inchikey, smiles)
+        taxonomies = dict(zip(entities, _map(
+            lambda entity: _classify_inchikey(*entity, client=client,
+                                              cache=cache),
+            list(entities.items()), n_jobs)))
+    finally:
+        client.close()
+        if cache is not None:
+            cache.close()
+
     classyfire = {}
     no_inchikey = []
     unexpected = []
+    unreachable = []
+    n_requests = 0
     for idx in feature_data.index:
         smiles = feature_data.loc[idx, 'smiles']
-        if smiles != 'missing':
-            to_inchikey = 'https://gnps-structure.ucsd.edu/inchikey?smiles='
-            urlencoded_smiles = urllib.parse.quote(smiles)
-            response = requests.get(to_inchikey+urlencoded_smiles)
-            if response.status_code != 200:
-                classyfire[idx] = 'SMILE parse error'
-                no_inchikey.append((idx, smiles))
-                continue
-            inchikey = response.text
-            to_classyfire = 'https://gnps-classyfire.ucsd.edu/entities/'
-            response = requests.get(to_classyfire+str(inchikey)
-                                    + '.json?smiles='+str(smiles))
-            if response.status_code == 200:
-                response = response.json()
-                sublevels = [level for level in classyfire_levels
-                             if level in response]
-                if len(sublevels) == 0:
-                    classyfire[idx] = 'unclassified'
-                    continue
-                taxonomy = []
-                for level in classyfire_levels:
-                    if (response and level in sublevels and
-                            response[level] is not None):
-                        taxonomy.append(response[level]['name'])
-                    else:
-                        taxonomy.append('unclassified')
-                classyfire[idx] = taxonomy
-            elif response.status_code == 404:
-                classyfire[idx] = 'unclassified'
-            else:
-                classyfire[idx] = 'unexpected server response'
-                unexpected.append((idx, smiles, response.status_code))
-        else:
+        if smiles == 'missing':
             classyfire[idx] = 'unclassified'
+            continue
+        status_code, inchikey = inchikeys[smiles]
+        n_requests += 1
+        if status_code is None:
+            classyfire[idx] = _NO_RESPONSE
+            unreachable.append((idx, smiles, inchikey))
+            continue
+        elif status_code != 200:
+            classyfire[idx] = 'SMILE parse error'
+            no_inchikey.append((idx, smiles))
+            continue
+        n_requests += 1
+        classyfire[idx], problem = taxonomies[inchikey]
+        if classyfire[idx] == _NO_RESPONSE:
+            unreachable.append((idx, smiles, problem))
+        elif problem is not None:
+            unexpected.append((idx, smiles, problem))
+    if verbose:
+        n_lookups = len(unique_smiles) + len(entities)
+        print('Looked up %d unique structures and %d unique InChIKeys for '
+              '%d annotated features: %d instead of %d lookups '
+              '(deduplication ratio %.2f).'
+              % (len(unique_smiles), len(entities), len(structures),
+                 n_lookups, n_requests, n_requests / n_lookups))
+        print(client.summary())
+        if cache is not None:
+            print('%d of %d lookups were found in the cache.'
+                  % (cache.hits, cache.hits + cache.misses))
     if bool(no_inchikey):
         warnings.warn('The following structures (id, SMILES) could not be used'
                       ' to retrieve an InChIKey from Classyfire:\n' +
@@ -117,7 +388,115 @@ def get_classyfire_taxonomy(feature_data: pd.DataFrame) -> pd.DataFrame:
                       'found here:\n' +
                       'https://www.ietf.org/assignments/http-status-codes/'
                       'http-status-codes.txt', UserWarning)
-    classyfire = pd.DataFrame(classyfire, index=classyfire_levels).T
+    if bool(unreachable):
+        warnings.warn('The following structures (id, SMILES, error) could '
+                      'not be looked up because the server did not respond; '
+                      'they are labeled `%s` and are looked up again in the '
+                      'next run:\n' % _NO_RESPONSE +
+                      ', '.join(str(i) for i in unreachable), UserWarning)
+    classyfire = pd.DataFrame(classyfire, index=CLASSYFIRE_LEVELS).T
     classified_feature_data = pd.concat([feature_data, classyfire],
                                         sort=False, axis=1)
     return classified_feature_data
+
+
+def _read_canopus(csi_result: CSIDirFmt) -> pd.DataFrame:
+    '''Reads the CANOPUS summary of a CSI:FingerID result into a table of
+    ClassyFire levels indexed by feature ID'''
+    reader = _open_csi_result(csi_result)
+    try:
+        with reader.open('canopus_summary.tsv') as fh:
+            summary = pd.read_csv(fh, dtype=str, sep='\t').fillna('')
+    except (FileNotFoundError, KeyError):
+        raise ValueError('A CSI:FingerID result does not contain '
+                         '`canopus_summary.tsv`; please run CANOPUS when '
+                         'predicting fingerprints.')
+    finally:
+        if reader is not csi_result:
+            reader.close()
+    # SIRIUS names compounds <index>_<file>_<feature ID>
+    names = summary['id' if 'id' in summary.columns else 'name']
+    canopus = pd.DataFrame(index=names.str.split('_').str[-1].values)
+    classifications = summary['all classifications'].str.split(';')
+    canopus['kingdom'] = [
+        next((k for k in _KINGDOMS if k in {c.strip() for c in found}), '')
+        for found in classifications]
+    for level, column in _CANOPUS_LEVELS.items():
+        canopus[level] = summary[column].str.strip().values
+    canopus = canopus.replace('', 'unclassified')
+    return canopus[~canopus.index.duplicated(keep='first')]
+
+
+def get_canopus_taxonomy(feature_data: pd.DataFrame,
+                         csi_results: CSIDirFmt) -> pd.DataFrame:
+    '''This function fills the chemical taxonomy of mass-spec features
+    from the CANOPUS predictions that SIRIUS stores along CSI:FingerID
+    results, without any request to the ClassyFire servers.
+
+    Parameters
+    ----------
+    feature_data : pd.DataFrame
+        a table that maps MD5 hash of mass-spec features to their feature
+        IDs (`#featureID`) and input tables (`table_number`), as made by
+        make_hierarchy
+    csi_results : CSIDirFmt
+        one or more CSI:FingerID output folders with CANOPUS predictions,
+        in the order their feature tables were given to make_hierarchy
+
+    Raises
+    ------
+    ValueError
+        If feature data does not contain the column '#featureID'
+        If feature data refers to more tables than there are CSI:FingerID
+        results
+        If a CSI:FingerID result does not contain `canopus_summary.tsv`
+    UserWarning
+        If some features have no CANOPUS prediction
+
+    Returns
+    -------
+    pd.DataFrame
+        feature data table with Classyfire annotations ('kingdom',
+        'superclass', 'class','subclass', 'direct_parent') per mass-spec
+        feature; features without a CANOPUS prediction are `unclassified`
+    '''
+    if '#featureID' not in feature_data.columns:
+        raise ValueError('Feature data table must contain the column '
+                         '`#featureID` to look up CANOPUS predictions')
+    if 'table_number' in feature_data.columns:
+        tables = feature_data['table_number'].astype(str).str.split(',')
+    else:
+        tables = pd.Series([['1']] * feature_data.shape[0],
+                           index=feature_data.index)
+    n_tables = max(int(number) for numbers in tables for number in numbers)
+    if n_tables > len(csi_results):
+        raise ValueError('The feature data refers to %d feature tables but '
+                         '%d CSI:FingerID results were given; please provide '
+                         'one per feature table, in the same order.'
+                         % (n_tables, len(csi_results)))
+    canopus = [_read_canopus(csi_result) for csi_result in csi_results]
+
+    classyfire = {}
+    no_prediction = []
+    for idx, numbers in tables.items():
+        ids = str(feature_data.loc[idx, '#featureID']).split(',')
+        classyfire[idx] = ['unclassified'] * len(CLASSYFIRE_LEVELS)
+        # a feature of several tables takes its first prediction
+        for fid, number in zip(ids, numbers):
+            predictions = canopus[int(number) - 1]
+            if fid in predictions.index:
+                classyfire[idx] = list(predictions.loc[fid,
+                                                       CLASSYFIRE_LEVELS])
+                break
+        else:
+            no_prediction.append(idx)
+    if bool(no_prediction):
+        warnings.warn('The following features have no CANOPUS prediction '
+                      'and are unclassified (%d of %d):\n'
+                      % (len(no_prediction), feature_data.shape[0]) +
+                      ', '.join(str(i) for i in no_prediction), UserWarning)
+    classyfire = pd.DataFrame(classyfire, index=CLASSYFIRE_LEVELS).T
+    classified_feature_data = pd.concat(
+        [feature_data.drop(columns=CLASSYFIRE_LEVELS, errors='ignore'),
+         classyfire.reindex(feature_data.index)], sort=False, axis=1)
+    return classified_feature_data
@@ -0,0 +1,509 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import numpy as np
+import pandas as pd
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial.distance import cdist
+
+
+def _popcount(packed: np.ndarray, overwrite: bool = False) -> np.ndarray:
+    '''Returns the number of set bits in each row of a packed uint64 array.
+    Uses ``np.bitwise_count`` where available (numpy >= 2.0) and a SWAR
+    bit count otherwise; with ``overwrite`` the SWAR steps work in place,
+    using ``packed`` as working memory.
+    '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(packed).sum(axis=-1, dtype=np.int64)
+    counts = packed if overwrite else packed.copy()
+    shifted = np.right_shift(counts, np.uint64(1))
+    shifted &= np.uint64(0x5555555555555555)
+    counts -= shifted
+    np.right_shift(counts, np.uint64(2), out=shifted)
+    shifted &= np.uint64(0x3333333333333333)
+    counts &= np.uint64(0x3333333333333333)
+    counts += shifted
+    np.right_shift(counts, np.uint64(4), out=shifted)
+    counts += shifted
+    counts &= np.uint64(0x0f0f0f0f0f0f0f0f)
+    counts *= np.uint64(0x0101010101010101)
+    counts >>= np.uint64(56)
+    return counts.sum(axis=-1, dtype=np.int64)
+
+
+def pack_fingerprints(fingerprints: pd.DataFrame) -> np.ndarray:
+    '''Packs binary fingerprints into an array of uint64 words with one bit
+    per substructure (see ``np.packbits``). Rows are zero-padded to whole
+    words, which does not change bit counts.
+    '''
+    packed = np.packbits(fingerprints.values.astype(bool), axis=1)
+    padding = -packed.shape[1] % 8
+    packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+# upper bound on the number of entries in a block of distances computed
+# at once; 2 ** 22 float64 values take 32 MiB
+_BLOCK_SIZE = 2 ** 22
+
+# number of words of packed fingerprints whose intersections are counted at
+# once by the Jaccard kernel
+_TILE_WORDS = 2 ** 16
+
+# quantized fingerprints store probabilities as integers from 0 to 255
+_QUANTIZATION_LEVELS = 255
+
+
+def _condensed_offset(i: int, n: int) -> int:
+    '''Position of the distance between rows ``i`` and ``i + 1`` in a
+    condensed distance vector over ``n`` rows'''
+    return i * (2 * n - i - 1) // 2
+
+
+def _jaccard_cross(x: np.ndarray, x_bitcounts: np.ndarray, y: np.ndarray,
+                   y_bitcounts: np.ndarray) -> np.ndarray:
+    '''Jaccard distances between the rows of packed fingerprints ``x`` and
+    ``y``. The intersections of a whole tile of pairs are counted by one
+    vectorised popcount, so the work happens in numpy kernels that release
+    the GIL rather than in a Python loop over rows; tiles hold about
+    ``_TILE_WORDS`` words so that they stay in cache.'''
+    dists = np.empty((x.shape[0], y.shape[0]), dtype=np.float64)
+    tile = max(1, int(np.sqrt(_TILE_WORDS / max(x.shape[1], 1))))
+    for i in range(0, x.shape[0], tile):
+        xi = x[i:i + tile, None, :]
+        for j in range(0, y.shape[0], tile):
+            shared = _popcount(xi & y[None, j:j + tile, :], overwrite=True)
+            union = (x_bitcounts[i:i + tile, None] +
+                     y_bitcounts[None, j:j + tile] - shared)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                dists[i:i + tile, j:j + tile] = np.where(
+                    union == 0, 0.0, (union - shared) / union)
+    return dists
+
+
+def _jaccard_rows(packed: np.ndarray, bitcounts: np.ndarray, start: int,
+                  stop: int, out: np.ndarray):
+    '''Writes the Jaccard distances from rows ``start``..``stop`` of packed
+    fingerprints to all later rows into the condensed vector ``out``'''
+    n = packed.shape[0]
+    tile = max(1, int(np.sqrt(_TILE_WORDS / max(packed.shape[1], 1))))
+    for first in range(start, stop, tile):
+        last = min(first + tile, stop)
+        block = _jaccard_cross(packed[first:last], bitcounts[first:last],
+                               packed[first:], bitcounts[first:])
+        for i in range(first, last):
+            row = i - first
+            offset = _condensed_offset(i, n)
+            out[offset:offset + n - i - 1] = block[row, row + 1:]
+
+
+def quantize_fingerprints(probabilities: np.ndarray) -> np.ndarray:
+    '''Quantizes fingerprint probabilities to 8-bit integers (0-255)'''
+    return np.rint(np.asarray(probabilities) * _QUANTIZATION_LEVELS).astype(
+        np.uint8)
+
+
+def _fingerprint_values(fingerprints: pd.DataFrame) -> np.ndarray:
+    '''Returns the fingerprint matrix, keeping float32 and quantized
+    (uint8) fingerprints in their compact precision'''
+    values = fingerprints.values
+    if values.dtype not in (np.float32, np.uint8):
+        values = values.astype(np.float64)
+    return np.ascontiguousarray(values)
+
+
+def _pairwise(x: np.ndarray, y: np.ndarray, metric: str) -> np.ndarray:
+    '''Distances between the rows of ``x`` and ``y``. Quantized
+    fingerprints are compared as probabilities (value / 255); their
+    euclidean distances come from integer dot products, which float64
+    arithmetic computes exactly, so they do not depend on the block shape.
+    '''
+    if x.dtype != np.uint8:
+        return cdist(x, y, metric=metric)
+    x, y = x.astype(np.float64), y.astype(np.float64)
+    if metric != 'euclidean':
+        return cdist(x / _QUANTIZATION_LEVELS, y / _QUANTIZATION_LEVELS,
+                     metric=metric)
+    sqdists = (np.einsum('ij,ij->i', x, x)[:, None] +
+               np.einsum('ij,ij->i', y, y)[None, :] - 2 * x @ y.T)
+    return np.sqrt(sqdists, out=sqdists) / _QUANTIZATION_LEVELS
+
+
+def _cross_distances(x: np.ndarray, y: np.ndarray,
+                     metric: str) -> np.ndarray:
+    '''Distances between the rows of ``x`` and ``y``. Compact fingerprints
+    are converted to float64 a chunk of ``y`` at a time, so the whole
+    matrix is never copied.'''
+    if y.dtype == np.float64:
+        return cdist(x, y, metric=metric)
+    dists = np.empty((x.shape[0], y.shape[0]))
+    chunk = max(1, _BLOCK_SIZE // max(y.shape[1], 1))
+    for start in range(0, y.shape[0], chunk):
+        dists[:, start:start + chunk] = _pairwise(x, y[start:start + chunk],
+                                                  metric)
+    return dists
+
+
+def _dot_rows(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    '''Dot products between the rows of ``x`` and ``y`` in float64; float32
+    fingerprints are converted a chunk of ``y`` at a time'''
+    if y.dtype == np.float64:
+        return x @ y.T
+    x = x.astype(np.float64)
+    dots = np.empty((x.shape[0], y.shape[0]))
+    chunk = max(1, _BLOCK_SIZE // max(y.shape[1], 1))
+    for start in range(0, y.shape[0], chunk):
+        dots[:, start:start + chunk] = x @ y[start:start + chunk].astype(
+            np.float64).T
+    return dots
+
+
+def _metric_rows(fingerprints: np.ndarray, metric: str, start: int,
+                 stop: int, out: np.ndarray):
+    '''Writes the distances from rows ``start``..``stop`` to all later rows
+    into the condensed vector ``out``'''
+    n = fingerprints.shape[0]
+    block = _cross_distances(fingerprints[start:stop], fingerprints[start:],
+                             metric)
+    for i in range(start, stop):
+        row = i - start
+        offset = _condensed_offset(i, n)
+        out[offset:offset + n - i - 1] = block[row, row + 1:]
+
+
+def informative_columns(fingerprints: pd.DataFrame,
+                        metric: str = 'euclidean',
+                        min_variance: float = 0.0) -> np.ndarray:
+    '''
+    Returns a boolean mask of the fingerprint columns to keep for
+    clustering.
+
+    With ``min_variance`` of 0 only columns that provably do not change any
+    distance are dropped: constant columns for the euclidean metric (their
+    terms are all zero), and columns that are 0 in every fingerprint for
+    the Jaccard metric (a column that is 1 everywhere adds one to both the
+    intersection and the union, so it is kept). With a positive
+    ``min_variance``, columns whose probability variance is below it are
+    dropped as well, which approximates the distances. Quantized
+    fingerprints are compared as probabilities (value / 255).
+    '''
+    values = fingerprints.values
+    if min_variance == 0:
+        if metric == 'jaccard':
+            return values.any(axis=0)
+        return (values != values[:1]).any(axis=0)
+    variance = np.empty(values.shape[1])
+    chunk = max(1, _BLOCK_SIZE // max(values.shape[0], 1))
+    for start in range(0, values.shape[1], chunk):
+        variance[start:start + chunk] = values[:, start:start + chunk].astype(
+            np.float64).var(axis=0)
+    if values.dtype == np.uint8:
+        variance /= _QUANTIZATION_LEVELS ** 2
+    return variance >= min_variance
+
+
+def packed_jaccard_distances(packed: np.ndarray) -> np.ndarray:
+    '''Computes the condensed Jaccard distance vector between rows of
+    packed binary fingerprints.
+
+    Only the intersection is counted for every pair; the union is derived
+    from the per-row bit counts. Pairs of empty fingerprints have a
+    distance of 0, as in ``scipy.spatial.distance.jaccard``.
+    '''
+    n = packed.shape[0]
+    distsq = np.empty(n * (n - 1) // 2, dtype=np.float64)
+    bitcounts = _popcount(packed)
+    block_rows = max(1, _BLOCK_SIZE // max(n, 1))
+    for start in range(0, n - 1, block_rows):
+        _jaccard_rows(packed, bitcounts, start, min(start + block_rows,
+                                                    n - 1), distsq)
+    return distsq
+
+
+def condensed_distances(fingerprints: pd.DataFrame,
+                        metric: str = 'euclidean',
+                        out: np.ndarray = None,
+                        n_jobs: int = 1) -> np.ndarray:
+    '''
+    Computes the condensed pairwise distance vector between fingerprints
+    without building the square distance matrix. Rows are processed in
+    blocks that are written straight into a preallocated condensed vector,
+    so peak memory is the vector itself plus one block per worker. ``out``
+    may be any preallocated float array of the right length, e.g. an
+    ``np.memmap``. Jaccard distances are computed on a bit-packed copy of
+    the fingerprints; all other metrics use ``scipy.spatial.distance.cdist``,
+    whose values do not depend on the block size. float32 and quantized
+    fingerprints are kept in their precision (see ``_pairwise``).
+
+    With ``n_jobs`` > 1 blocks are computed by a pool of threads (the
+    distance kernels release the GIL); blocks never overlap in ``out``, so
+    the result is identical to the serial one.
+    '''
+    n = fingerprints.shape[0]
+    if out is None:
+        out = np.empty(n * (n - 1) // 2, dtype=np.float64)
+    if metric == 'jaccard':
+        packed = pack_fingerprints(fingerprints)
+        fill = partial(_jaccard_rows, packed, _popcount(packed))
+    else:
+        fill = partial(_metric_rows, _fingerprint_values(fingerprints),
+                       metric)
+    block_rows = max(1, _BLOCK_SIZE // max(n, 1))
+    if n_jobs > 1:
+        # rows near the top of the condensed matrix are the longest; many
+        # small blocks keep the workers evenly loaded
+        block_rows = max(1, min(block_rows, (n - 1) // (4 * n_jobs)))
+    blocks = [(start, min(start + block_rows, n - 1))
+              for start in range(0, n - 1, block_rows)]
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(lambda block: fill(*block, out), blocks))
+    else:
+        for start, stop in blocks:
+            fill(start, stop, out)
+    return out
+
+
+def _allocate_condensed(n: int, dtype: str = 'float64',
+                        directory: str = None) -> np.ndarray:
+    '''Allocates a condensed distance vector for ``n`` rows, backed by a
+    file in ``directory`` if one is given'''
+    size = n * (n - 1) // 2
+    if directory is None or size == 0:
+        return np.empty(size, dtype=dtype)
+    path = os.path.join(directory, 'distances.%s' % dtype)
+    return np.memmap(path, dtype=dtype, mode='w+', shape=(size,))
+
+
+class CondensedDistances:
+    '''
+    Pairwise distances between fingerprints, kept as a condensed vector:
+    the upper triangle of the distance matrix row by row, as in
+    ``scipy.spatial.distance.squareform``. It takes half the space of the
+    square matrix. Artifacts hold it as a QIIME 2 ``DistanceMatrix``, which
+    is written and read one row at a time (see ``write_lsmat`` and
+    ``read_lsmat``); the compact ``CondensedDistanceMatrix`` stores the
+    vector as a binary ``.npy`` file that can be memory-mapped.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        condensed distance vector
+    ids : list
+        labels of the fingerprints, in the order of ``values``
+    metric : str, optional
+        metric the distances were computed with, if known
+
+    Raises
+    ------
+    ValueError
+        If ``values`` does not hold one distance per pair of ``ids``
+    '''
+
+    def __init__(self, values: np.ndarray, ids: list, metric: str = None):
+        n = len(ids)
+        if values.shape != (n * (n - 1) // 2,):
+            raise ValueError('The condensed distance vector has %d entries; '
+                             '%d fingerprints need %d.'
+                             % (values.size, n, n * (n - 1) // 2))
+        self.values = values
+        self.ids = [str(i) for i in ids]
+        self.metric = metric
+
+    @property
+    def n(self) -> int:
+        return len(self.ids)
+
+    def subset(self, ids: list) -> np.ndarray:
+        '''Returns the condensed distances between the fingerprints
+        ``ids``, in their order; the stored vector itself when they are all
+        the fingerprints in the stored order. Every id must be stored.'''
+        positions = pd.Index(self.ids).get_indexer([str(i) for i in ids])
+        if np.array_equal(positions, np.arange(self.n)):
+            return self.values
+        m = len(positions)
+        out = np.empty(m * (m - 1) // 2, dtype=self.values.dtype)
+        for row in range(m - 1):
+            others = positions[row + 1:]
+            low = np.minimum(positions[row], others)
+            high = np.maximum(positions[row], others)
+            offset = _condensed_offset(row, m)
+            out[offset:offset + m - row - 1] = self.values[
+                _condensed_offset(low, self.n) + high - low - 1]
+        return out
+
+    def row(self, i: int) -> np.ndarray:
+        '''Returns the distances from fingerprint ``i`` to all of them'''
+        n = self.n
+        out = np.zeros(n, dtype=self.values.dtype)
+        before = np.arange(i)
+        out[:i] = self.values[_condensed_offset(before, n) + i - before - 1]
+        offset = _condensed_offset(i, n)
+        out[i + 1:] = self.values[offset:offset + n - i - 1]
+        return out
+
+    def write_lsmat(self, fh):
+        '''Writes the square distance matrix in the tab-separated format of
+        ``skbio.DistanceMatrix``, one row at a time; every distance is
+        written exactly, so that it is read back unchanged'''
+        fh.write('\t' + '\t'.join(self.ids) + '\n')
+        for i, label in enumerate(self.ids):
+            fh.write(label + '\t' +
+                     '\t'.join(map(repr, self.row(i).tolist())) + '\n')
+
+    @classmethod
+    def read_lsmat(cls, fh, dtype: str = 'float64',
+                   metric: str = None) -> 'CondensedDistances':
+        '''Reads a distance matrix written in the tab-separated format of
+        ``skbio.DistanceMatrix``, keeping only the upper triangle of every
+        row'''
+        ids = fh.readline().rstrip('\r\n').split('\t')[1:]
+        n = len(ids)
+        values = np.empty(n * (n - 1) // 2, dtype=dtype)
+        for i in range(n):
+            row = fh.readline().rstrip('\r\n').split('\t')
+            offset = _condensed_offset(i, n)
+            values[offset:offset + n - i - 1] = np.array(row[i + 2:],
+                                                         dtype=float)
+        return cls(values, ids, metric)
+
+
+class FingerprintDistances:
+    '''Computes rows of the pairwise distance matrix between fingerprints
+    on demand, so that clustering engines never have to hold all pairwise
+    distances. Binary fingerprints are bit-packed for the Jaccard metric,
+    which keeps a packed copy next to the boolean fingerprint table.
+    '''
+
+    def __init__(self, fingerprints: pd.DataFrame,
+                 metric: str = 'euclidean'):
+        self.metric = metric
+        self.n = fingerprints.shape[0]
+        if metric == 'jaccard':
+            self.packed = pack_fingerprints(fingerprints)
+            self.bitcounts = _popcount(self.packed)
+        else:
+            self.values = _fingerprint_values(fingerprints)
+            self.sqnorms = np.einsum('ij,ij->i', self.values, self.values,
+                                     dtype=np.float64)
+
+    def rows(self, idx, fast: bool = False, to=None) -> np.ndarray:
+        '''Returns the distances from the rows ``idx`` to the rows ``to``
+        (all rows by default).
+
+        With ``fast``, euclidean distances are computed from dot products
+        (``|x|² + |y|² - 2 x.y``) by BLAS, which is much faster but carries
+        rounding errors in the order of 1e-13; good enough to rank
+        neighbours but not to reproduce exact linkages. Quantized
+        fingerprints always use the exact integer form of ``_pairwise``.
+        '''
+        idx = np.atleast_1d(idx)
+        to = slice(None) if to is None else np.atleast_1d(to)
+        if fast and self.metric == 'euclidean' and \
+                self.values.dtype != np.uint8:
+            sqdists = (self.sqnorms[idx, None] + self.sqnorms[None, to] -
+                       2 * _dot_rows(self.values[idx], self.values[to]))
+            return np.sqrt(np.maximum(sqdists, 0, out=sqdists), out=sqdists)
+        if self.metric != 'jaccard':
+            return _cross_distances(self.values[idx], self.values[to],
+                                    self.metric)
+        return _jaccard_cross(self.packed[idx], self.bitcounts[idx],
+                              self.packed[to], self.bitcounts[to])
+
+
+def _principal_axes(values: np.ndarray,
+                    n_components: int = 16) -> np.ndarray:
+    '''Orthonormal leading principal axes of (a sample of) the
+    fingerprints'''
+    sample = values[::max(1, values.shape[0] // 2048)].astype(np.float64)
+    sample -= sample.mean(axis=0)
+    return np.linalg.svd(sample, full_matrices=False)[2][:n_components]
+
+
+def _project(values: np.ndarray, axes: np.ndarray) -> np.ndarray:
+    '''Projects fingerprints onto ``axes``; quantized fingerprints are
+    projected as probabilities (value / 255). The axes are orthonormal, so
+    distances between projections never exceed the distances between
+    fingerprints.'''
+    projections = _dot_rows(axes, values).T
+    if values.dtype == np.uint8:
+        projections /= _QUANTIZATION_LEVELS
+    return projections
+
+
+def group_fingerprints(fingerprints: pd.DataFrame,
+                       metric: str = 'euclidean',
+                       max_distance: float = 0.0) -> np.ndarray:
+    '''
+    Groups fingerprints that are within ``max_distance`` of one another.
+
+    Fingerprints are visited in order; every fingerprint that is not yet in
+    a group represents a new group, which takes all ungrouped fingerprints
+    within ``max_distance`` of it. Members are thus never further than
+    ``max_distance`` from their representative, and representatives are
+    further than that from one another.
+
+    Candidates are looked up in an index that bounds distances from below,
+    and only those are compared: euclidean fingerprints are sorted along
+    their first principal axis and filtered by their distance in the space
+    of the leading principal axes; binary fingerprints are sorted by their
+    number of set bits a and b, since Jaccard distances are at least
+    1 - min(a, b) / max(a, b).
+
+    Parameters
+    ----------
+    fingerprints : pd.DataFrame
+        fingerprint table
+    metric : str, default `euclidean`
+        distance metric; binary fingerprints are bit-packed for `jaccard`
+    max_distance : float, default 0
+        largest distance between a fingerprint and the representative of
+        its group
+
+    Returns
+    -------
+    np.ndarray
+        for every fingerprint, the row of the representative of its group
+    '''
+    distances = FingerprintDistances(fingerprints, metric)
+    if metric == 'jaccard':
+        projections = None
+        keys = distances.bitcounts.astype(np.float64)
+        if max_distance >= 1:
+            lows = np.full_like(keys, -np.inf)
+            highs = np.full_like(keys, np.inf)
+        else:
+            lows, highs = keys * (1 - max_distance), keys / (1 - max_distance)
+    else:
+        projections = _project(distances.values,
+                               _principal_axes(distances.values))
+        keys = projections[:, 0]
+        # a little slack for the rounding errors of projections
+        max_projected = max_distance + 1e-9 * (
+            1 + np.sqrt(distances.sqnorms.max()))
+        lows, highs = keys - max_projected, keys + max_projected
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.searchsorted(sorted_keys, lows, side='left')
+    stops = np.searchsorted(sorted_keys, highs, side='right')
+    representatives = np.full(distances.n, -1, dtype=np.int64)
+    for i in range(distances.n):
+        if representatives[i] >= 0:
+            continue
+        candidates = order[starts[i]:stops[i]]
+        candidates = candidates[representatives[candidates] < 0]
+        if projections is not None:
+            candidates = candidates[np.linalg.norm(
+                projections[candidates] - projections[i],
+                axis=1) <= max_projected]
+        dists = distances.rows(i, to=candidates)[0]
+        representatives[candidates[dists <= max_distance]] = i
+        representatives[i] = i
+    return representatives
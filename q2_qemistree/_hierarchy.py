@@ -6,62 +6,310 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import tempfile
+import warnings
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import biom
+import numpy as np
 import pandas as pd
-from sklearn.metrics import pairwise_distances
-from scipy.spatial.distance import squareform
 from scipy.cluster.hierarchy import linkage
 from skbio import TreeNode
 from q2_feature_table import merge
+from q2_types.tree import NewickFormat
 
 from ._process_fingerprint import process_csi_results
-from ._match import get_matched_tables
+from ._match import get_matched_tables, _collapse_table
 from ._semantics import CSIDirFmt
+from ._distances import (FingerprintDistances, CondensedDistances,
+                         condensed_distances, informative_columns,
+                         group_fingerprints, _allocate_condensed)
+from ._linkage import (mst_single_linkage, knn_average_linkage,
+                       nn_chain_average_linkage, LinkageTree)
+
+
+def _build_linkage_tree(relabeled_fingerprints: pd.DataFrame,
+                        metric: str = 'euclidean',
+                        distance_dtype: str = 'float64',
+                        distance_dir: str = None,
+                        n_jobs: int = 1,
+                        clustering: str = 'upgma',
+                        n_neighbors: int = 30,
+                        distance_matrix: CondensedDistances = None,
+                        members: dict = None) -> LinkageTree:
+    '''
+    This function clusters fingerprints into an array-backed tree of
+    relatedness between mass-spectrometry features.
+
+    If ``distance_dir`` is given, the condensed distances are written in
+    blocks to a temporary memory-mapped file in that directory instead of
+    being held in memory, and ``distance_dtype`` sets their precision.
+    Average linkage then runs on the file itself, a row at a time (see
+    ``nn_chain_average_linkage``), so the distances never have to fit in
+    memory; float64 gives the same tree as in memory, float32 halves the
+    file at the cost of rounding the merged distances. In memory, scipy
+    clusters a float64 copy of the distances, so float32 only adds that
+    copy to the vector and is warned against. Distances are computed by
+    ``n_jobs`` threads.
+
+    ``clustering`` selects the clustering engine: exact average linkage
+    (``'upgma'``), single linkage from a minimum spanning tree
+    (``'single-mst'``) or approximate average linkage on the
+    ``n_neighbors`` nearest neighbour graph (``'knn-upgma'``). The last two
+    compute distances on the fly and never hold all of them, so
+    ``distance_dtype`` and ``distance_dir`` do not apply to them.
+
+    Precomputed condensed distances (``distance_matrix``, the output of
+    fingerprint_distances) that cover all fingerprints are clustered by
+    ``'upgma'`` instead of computing the distances again.
+
+    ``members`` maps fingerprints to near-duplicates collapsed into them
+    (see ``_collapse_near_duplicates``), which are attached to their tips.
+    '''
+    n = relabeled_fingerprints.shape[0]
+    if distance_matrix is not None and clustering != 'upgma':
+        raise ValueError("A distance matrix can only be clustered with "
+                         "`upgma`; the other clustering engines compute "
+                         "distances on the fly.")
+    if distance_matrix is not None:
+        if distance_matrix.metric not in (None, metric):
+            raise ValueError('The distance matrix was computed with the %s '
+                             'metric, not %s.'
+                             % (distance_matrix.metric, metric))
+        ids = relabeled_fingerprints.index
+        missing = set(ids) - set(distance_matrix.ids)
+        if missing:
+            raise ValueError('%d fingerprints are missing from the distance '
+                             'matrix. Please check that it was computed '
+                             'from the same inputs and metric.'
+                             % len(missing))
+        linkage_matrix = linkage(distance_matrix.subset(ids),
+                                 method='average')
+    elif clustering == 'single-mst':
+        distances = FingerprintDistances(relabeled_fingerprints, metric)
+        linkage_matrix = mst_single_linkage(distances)
+    elif clustering == 'knn-upgma':
+        distances = FingerprintDistances(relabeled_fingerprints, metric)
+        linkage_matrix = knn_average_linkage(distances, n_neighbors, n_jobs)
+    elif distance_dir is None:
+        if distance_dtype != 'float64':
+            warnings.warn('Average linkage copies %s distances held in '
+                          'memory to float64, which takes more memory than '
+                          'float64 distances alone; use a `distance_dir` '
+                          'to cluster them out of memory.' % distance_dtype,
+                          UserWarning)
+        distsq = _allocate_condensed(n, distance_dtype)
+        condensed_distances(relabeled_fingerprints, metric, out=distsq,
+                            n_jobs=n_jobs)
+        linkage_matrix = linkage(distsq, method='average')
+    else:
+        with tempfile.TemporaryDirectory(dir=distance_dir) as tmp:
+            distsq = _allocate_condensed(n, distance_dtype, tmp)
+            condensed_distances(relabeled_fingerprints, metric,
+                                out=distsq, n_jobs=n_jobs)
+            linkage_matrix = nn_chain_average_linkage(distsq)
+            del distsq
+    return LinkageTree(linkage_matrix, relabeled_fingerprints.index.tolist(),
+                       members)
 
 
 def build_tree(relabeled_fingerprints: pd.DataFrame,
-               metric: str = 'euclidean') -> TreeNode:
+               metric: str = 'euclidean',
+               distance_dtype: str = 'float64',
+               distance_dir: str = None,
+               n_jobs: int = 1,
+               clustering: str = 'upgma',
+               n_neighbors: int = 30,
+               distance_matrix: CondensedDistances = None) -> TreeNode:
     '''
     This function makes a tree of relatedness between mass-spectrometry
-    features using molecular substructure fingerprints.
+    features using molecular substructure fingerprints. See
+    ``_build_linkage_tree`` for the parameters.
     '''
-    distmat = pairwise_distances(X=relabeled_fingerprints.values,
-                                 Y=None, metric=metric)
-    distsq = squareform(distmat, checks=False)
-    linkage_matrix = linkage(distsq, method='average')
-    tree = TreeNode.from_linkage_matrix(linkage_matrix,
-                                        relabeled_fingerprints.index.tolist())
-    return tree
+    tree = _build_linkage_tree(relabeled_fingerprints, metric, distance_dtype,
+                               distance_dir, n_jobs, clustering, n_neighbors,
+                               distance_matrix)
+    return tree.to_treenode()
 
 
-def merge_feature_data(fdata: pd.DataFrame) -> pd.DataFrame:
+def merge_feature_data(fdata: pd.DataFrame,
+                       previous: pd.DataFrame = None) -> pd.DataFrame:
     '''
     This function merges feature data from multiple feature tables. The
     resulting table is indexed by MD5 hash mapped to unique feature
-    identifiers in the original feature tables.
-    '''
-    for idx, data in enumerate(fdata):
-        data['table_number'] = str(idx+1)
-    merged_fdata = pd.concat(fdata)
-    dupl_bool = merged_fdata.index.duplicated(keep='first')
-    duplicates = merged_fdata[dupl_bool].index.unique()
-    if len(duplicates) == 0:
+    identifiers in the original feature tables. When the merged feature
+    data of an earlier run is given as ``previous``, it is kept first and
+    the new tables are numbered after the tables it already refers to.
+    '''
+    merged_fdata, first = [], 1
+    if previous is not None:
+        merged_fdata.append(previous)
+        first += max(int(number) for numbers in previous['table_number']
+                     for number in str(numbers).split(','))
+    merged_fdata += [data.assign(table_number=str(idx+first))
+                     for idx, data in enumerate(fdata)]
+    merged_fdata = pd.concat(merged_fdata)
+    repeated = merged_fdata.index.duplicated(keep=False)
+    if not repeated.any():
         return merged_fdata
+    joined = merged_fdata.loc[repeated, ['#featureID', 'table_number']]
+    joined = joined.groupby(level=0, sort=False).agg(','.join)
+    merged_fdata = merged_fdata[
+        ~merged_fdata.index.duplicated(keep='first')].copy()
+    merged_fdata.update(joined)
+    return merged_fdata
+
+
+def _process_dataset(csi_result, feature_table: biom.Table,
+                     library_match: pd.DataFrame, metric: str,
+                     cache_dir: str, n_jobs: int,
+                     precision: str = 'float64') -> tuple:
+    '''
+    Collates the fingerprints of one CSI:FingerID result and matches them
+    to its feature table; returns the relabeled fingerprints, the matched
+    feature table and the feature data.
+    '''
+    collated_fps, smiles = process_csi_results(csi_result, library_match,
+                                               metric=metric,
+                                               cache_dir=cache_dir,
+                                               n_jobs=n_jobs,
+                                               precision=precision)
+    return get_matched_tables(collated_fps, smiles, feature_table,
+                              n_jobs=n_jobs)
+
+
+def _process_dataset_recorded(*args, **kwargs) -> tuple:
+    '''
+    Runs ``_process_dataset`` in a worker process and records the warnings
+    it raises, which would otherwise be lost with the worker; returns the
+    processed dataset and the recorded warnings.
+    '''
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        processed = _process_dataset(*args, **kwargs)
+    return processed, [(w.message, w.category, w.filename, w.lineno)
+                       for w in caught]
+
+
+def _process_datasets(csi_results: list, feature_tables: list,
+                      library_matches: list = None,
+                      metric: str = 'euclidean', cache_dir: str = None,
+                      n_jobs: int = 1, n_workers: int = 1,
+                      precision: str = 'float64') -> tuple:
+    '''
+    Validates the inputs of make_hierarchy and processes every
+    (CSI:FingerID result, feature table) pair, optionally on a pool of
+    ``n_workers`` processes; returns the lists of relabeled fingerprints,
+    matched feature tables and feature data in input order.
+    '''
+    if len(feature_tables) != len(csi_results):
+        raise ValueError("The feature tables and CSI results should have a "
+                         "one-to-one correspondance.")
+    if library_matches and len(library_matches) != len(feature_tables):
+        raise ValueError("The MS2 match tables should have a one-to-one "
+                         "correspondance with feature tables and CSI results.")
+    for n, feature_table in enumerate(feature_tables):
+        if feature_table.is_empty():
+            raise ValueError("Cannot have empty feature table")
+        if library_matches and 'Smiles' not in library_matches[n].columns:
+            raise ValueError("MS2 match tables must contain the "
+                             "column `Smiles`. Please check if you have "
+                             "the correct input file for this command.")
+    datasets = [(csi_result, feature_table,
+                 library_matches[n] if library_matches else None)
+                for n, (feature_table, csi_result) in enumerate(
+                    zip(feature_tables, csi_results))]
+    options = dict(metric=metric, cache_dir=cache_dir, n_jobs=n_jobs,
+                   precision=precision)
+    if n_workers > 1 and len(datasets) > 1:
+        # the directory formats are handed to the workers as plain paths
+        datasets = [(str(csi_result.get_path())
+                     if isinstance(csi_result, CSIDirFmt) else csi_result,
+                     feature_table, library_match)
+                    for csi_result, feature_table, library_match in datasets]
+        process = partial(_process_dataset_recorded, **options)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            recorded = list(executor.map(process, *zip(*datasets)))
+        # warnings of the workers are raised again in dataset order
+        processed = []
+        for dataset, caught in recorded:
+            for message, category, filename, lineno in caught:
+                warnings.warn_explicit(message, category, filename, lineno)
+            processed.append(dataset)
     else:
-        for idx in duplicates:
-            merged_fdata.loc[idx, '#featureID'] = (',').join(
-                list(merged_fdata.loc[idx, '#featureID']))
-            merged_fdata.loc[idx, 'table_number'] = (',').join(
-                list(merged_fdata.loc[idx, 'table_number']))
-        merged_fdata = merged_fdata[~dupl_bool]
-        return merged_fdata
+        processed = [_process_dataset(*dataset, **options)
+                     for dataset in datasets]
+    return tuple(list(i) for i in zip(*processed))
+
+
+def _merge_fingerprints(fps: list) -> pd.DataFrame:
+    '''Concatenates relabeled fingerprint tables, keeping every MD5 hash
+    once'''
+    merged_fps = pd.concat(fps)
+    return merged_fps[~merged_fps.index.duplicated(keep='first')]
+
+
+def _collapse_near_duplicates(relabeled_fingerprints: pd.DataFrame,
+                              metric: str = 'euclidean',
+                              max_distance: float = 0.0) -> tuple:
+    '''
+    Groups fingerprints within ``max_distance`` of one another (see
+    ``group_fingerprints``); returns the fingerprints of the group
+    representatives, the members of every group that has some, and the
+    representative of every fingerprint.
+    '''
+    labels = relabeled_fingerprints.index
+    representatives = pd.Series(
+        labels[group_fingerprints(relabeled_fingerprints, metric,
+                                  max_distance)], index=labels)
+    collapsed = representatives[representatives != labels]
+    members = {label: list(group.index)
+               for label, group in collapsed.groupby(collapsed, sort=False)}
+    kept = relabeled_fingerprints[representatives == labels]
+    return kept, members, representatives
+
+
+def _collapse_features(feature_table: biom.Table, fdata: pd.DataFrame,
+                       representatives: pd.Series) -> tuple:
+    '''
+    Aggregates the feature table and the feature data by the groups of
+    ``_collapse_near_duplicates``: the rows of every group are summed into
+    the row of its representative, and its feature data keeps the row of
+    the representative, with the feature identifiers and table numbers of
+    all members joined by commas and their labels listed in `members`.
+    '''
+    kept = pd.Index(representatives.unique())
+    feature_ids = list(feature_table.ids(axis='observation'))
+    collapsed_table = _collapse_table(feature_table, feature_ids,
+                                      representatives[feature_ids].values,
+                                      kept)
+    groups = representatives[fdata.index].values
+    joined = fdata[['#featureID', 'table_number']].groupby(
+        groups, sort=False).agg(','.join)
+    collapsed_fdata = fdata.loc[fdata.index.isin(kept)].copy()
+    collapsed_fdata.update(joined)
+    collapsed_fdata['members'] = fdata.index.to_series().groupby(
+        groups, sort=False).agg(','.join)
+    return collapsed_table, collapsed_fdata
 
 
 def make_hierarchy(csi_results: CSIDirFmt,
                    feature_tables: biom.Table,
                    library_matches: pd.DataFrame = None,
-                   metric: str = 'euclidean') -> (TreeNode, biom.Table,
-                                                  pd.DataFrame):
+                   metric: str = 'euclidean',
+                   cache_dir: str = None,
+                   distance_dtype: str = 'float64',
+                   distance_dir: str = None,
+                   n_jobs: int = 1,
+                   clustering: str = 'upgma',
+                   n_neighbors: int = 30,
+                   n_workers: int = 1,
+                   distance_matrix: CondensedDistances = None,
+                   precision: str = 'float64',
+                   min_column_variance: float = None,
+                   collapse_distance: float = None,
+                   verbose: bool = False
+                   ) -> (NewickFormat, biom.Table, pd.DataFrame):
     '''
     This function generates a hierarchy of mass-spec features based on
     predicted chemical fingerprints. It filters the feature table to
@@ -77,53 +325,191 @@ def make_hierarchy(csi_results: CSIDirFmt,
         one or more tables with MS/MS library match for mass-spec features
     metric : str, default `euclidean`
         metric for hierarchical clustering of fingerprints
+    cache_dir : str, optional
+        directory where collated fingerprints are cached between runs
+    distance_dtype : str, default `float64`
+        precision of the pairwise distances between fingerprints; float32
+        only saves space with ``distance_dir``
+    distance_dir : str, optional
+        directory for a temporary memory-mapped file that holds the pairwise
+        distances, which are clustered by `upgma` from the file; by default
+        they are kept in memory
+    n_jobs : int, default 1
+        number of threads used to read fingerprint files and to compute
+        pairwise distances
+    clustering : str, default `upgma`
+        clustering engine; exact average linkage (`upgma`), single linkage
+        from a minimum spanning tree (`single-mst`) or approximate average
+        linkage on a nearest neighbour graph (`knn-upgma`)
+    n_neighbors : int, default 30
+        number of nearest neighbours per fingerprint for `knn-upgma`
+    n_workers : int, default 1
+        number of processes that collate fingerprints and match feature
+        tables of the datasets in parallel; results are gathered in input
+        order
+    distance_matrix : CondensedDistances, optional
+        pairwise distances between the fingerprints, as computed by
+        fingerprint_distances from the same inputs and metric; clustered
+        with `upgma` instead of computing the distances again. With float64
+        distances of fingerprints stored by collate_fingerprints, the tree
+        is the same as without them
+    precision : str, default `float64`
+        precision of the fingerprint probabilities: `float64`, `float32` or
+        `uint8` (quantized to 256 levels). Features are labeled by the MD5
+        hash of their fingerprint in this precision, so labels differ
+        between precisions, and in `uint8` fingerprints that quantize to
+        the same levels share a label. Ignored for the Jaccard metric,
+        which binarizes float64 probabilities.
+    min_column_variance : float, optional
+        if given, fingerprint columns that do not inform the clustering are
+        dropped before it: with 0, only columns that cannot change any
+        distance (the tree is unchanged); with a positive value, also
+        columns whose probability variance is below it
+    collapse_distance : float, optional
+        if given, fingerprints within this distance of one another are
+        grouped, only one representative per group is clustered, and the
+        other members are attached to it with zero-length branches. The
+        feature table and feature data are aggregated by group: the rows of
+        the members are summed into the row of their representative, whose
+        feature data lists the labels of the group in `members`
+    verbose : bool, default False
+        report how many fingerprint columns were dropped and how many
+        groups of near-duplicates were formed
     Raises
     ------
     ValueError
         If ``feature_table`` in empty
         If collated fingerprint table is empty
+        If ``collapse_distance`` leaves a single representative
     Returns
     -------
-    skbio.TreeNode
-        a tree of relatedness of molecules
+    NewickFormat
+        a tree of relatedness of molecules, written as Newick straight from
+        the linkage matrix
     biom.Table
         merged feature table that is filtered to contain only the
         features present in the tree; indexed by the MD5 hash of
-        fingerprint vectors of mass-spec features
+        fingerprint vectors of mass-spec features (of the representatives
+        when ``collapse_distance`` is given)
     pd.DataFrame
         merged feature data; indexed by the MD5 hash of the fingerprint
-        vectors of mass-spec features
+        vectors of mass-spec features (of the representatives when
+        ``collapse_distance`` is given)
     '''
-    fps, fts, fdata = [], [], []
-    if len(feature_tables) != len(csi_results):
-        raise ValueError("The feature tables and CSI results should have a "
-                         "one-to-one correspondance.")
-    if library_matches and len(library_matches) != len(feature_tables):
-        raise ValueError("The MS2 match tables should have a one-to-one "
-                         "correspondance with feature tables and CSI results.")
-    for n, (feature_table, csi_result) in enumerate(zip(feature_tables,
-                                                        csi_results)):
-        if feature_table.is_empty():
-            raise ValueError("Cannot have empty feature table")
-        if library_matches:
-            library_match = library_matches[n]
-            if 'Smiles' not in library_match.columns:
-                raise ValueError("MS2 match tables must contain the "
-                                 "column `Smiles`. Please check if you have "
-                                 "the correct input file for this command.")
-            collated_fps, smiles = process_csi_results(csi_result,
-                                                       library_match,
-                                                       metric=metric)
-        else:
-            collated_fps, smiles = process_csi_results(csi_result, None, metric)
-        relabeled_fp, matched_ft, feature_data = get_matched_tables(
-            collated_fps, smiles, feature_table)
-        fps.append(relabeled_fp)
-        fts.append(matched_ft)
-        fdata.append(feature_data)
+    fps, fts, fdata = _process_datasets(csi_results, feature_tables,
+                                        library_matches, metric, cache_dir,
+                                        n_jobs, n_workers, precision)
     merged_fdata = merge_feature_data(fdata)
-    merged_fps = pd.concat(fps)
-    merged_fps = merged_fps[~merged_fps.index.duplicated(keep='first')]
+    merged_fps = _merge_fingerprints(fps)
     merged_fts = merge(fts, overlap_method='error_on_overlapping_sample')
-    tree = build_tree(merged_fps, metric)
-    return tree, merged_fts, merged_fdata
+    if min_column_variance is not None and distance_matrix is None:
+        keep = informative_columns(merged_fps, metric, min_column_variance)
+        if verbose:
+            print('Dropped %d of %d fingerprint columns that do not inform '
+                  'the clustering.' % ((~keep).sum(), keep.size))
+        merged_fps = merged_fps.loc[:, keep]
+    members = None
+    if collapse_distance is not None:
+        n_fps = merged_fps.shape[0]
+        merged_fps, members, representatives = _collapse_near_duplicates(
+            merged_fps, metric, collapse_distance)
+        if merged_fps.shape[0] < 2:
+            raise ValueError('All %d fingerprints are within a collapse '
+                             'distance of %s of one another, which leaves a '
+                             'single representative and nothing to cluster. '
+                             'Please use a smaller collapse distance.'
+                             % (n_fps, collapse_distance))
+        if verbose:
+            print('Collapsed %d fingerprints into %d groups of '
+                  'near-duplicates.' % (n_fps, merged_fps.shape[0]))
+        merged_fts, merged_fdata = _collapse_features(
+            merged_fts, merged_fdata, representatives)
+    tree = _build_linkage_tree(merged_fps, metric, distance_dtype,
+                               distance_dir, n_jobs, clustering, n_neighbors,
+                               distance_matrix, members)
+    newick = NewickFormat()
+    with newick.open() as fh:
+        fh.write(tree.to_newick())
+    return newick, merged_fts, merged_fdata
+
+
+def collate_fingerprints(csi_results: CSIDirFmt,
+                         feature_tables: biom.Table,
+                         metric: str = 'euclidean',
+                         cache_dir: str = None,
+                         n_jobs: int = 1,
+                         n_workers: int = 1,
+                         precision: str = 'float64') -> pd.DataFrame:
+    '''
+    This function collates the fingerprints that make_hierarchy clusters:
+    the fingerprints of mass-spec features found in the feature tables,
+    indexed by the MD5 hash of their fingerprint vector, so that they match
+    the tips of the tree built from the same inputs.
+
+    Parameters
+    ----------
+    csi_results : CSIDirFmt
+        one or more CSI:FingerID output folder
+    feature_tables : biom.Table
+        one or more feature tables with mass-spec feature intensity per sample
+    metric : str, default `euclidean`
+        metric for hierarchical clustering of fingerprints; fingerprints
+        are binarized for `jaccard`
+    cache_dir : str, optional
+        directory where collated fingerprints are cached between runs
+    n_jobs : int, default 1
+        number of threads used to read fingerprint files
+    n_workers : int, default 1
+        number of processes that process the datasets in parallel
+    precision : str, default `float64`
+        precision of the fingerprint probabilities (see make_hierarchy)
+
+    Returns
+    -------
+    pd.DataFrame
+        fingerprint table indexed by the MD5 hash of fingerprint vectors
+    '''
+    fps, _, _ = _process_datasets(csi_results, feature_tables, None, metric,
+                                  cache_dir, n_jobs, n_workers, precision)
+    return _merge_fingerprints(fps)
+
+
+def fingerprint_distances(fingerprints: pd.DataFrame,
+                          metric: str = 'euclidean',
+                          distance_dtype: str = 'float32',
+                          n_jobs: int = 1) -> CondensedDistances:
+    '''
+    This function computes the pairwise distances between molecular
+    fingerprints, e.g. for ordination and beta-diversity analyses; the
+    same distances can be passed to make_hierarchy so that they are only
+    computed once. Distances are kept as a condensed vector and never as a
+    square matrix.
+
+    Parameters
+    ----------
+    fingerprints : pd.DataFrame
+        fingerprint table indexed by the MD5 hash of fingerprint vectors,
+        as made by collate_fingerprints
+    metric : str, default `euclidean`
+        distance metric; `jaccard` needs binary fingerprints
+    distance_dtype : str, default `float32`
+        precision of the distances
+    n_jobs : int, default 1
+        number of threads used to compute distances
+
+    Raises
+    ------
+    ValueError
+        If the Jaccard metric is used with fingerprints that are not binary
+
+    Returns
+    -------
+    CondensedDistances
+        condensed pairwise distances between fingerprints
+    '''
+    if metric == 'jaccard' and not np.isin(fingerprints.values, (0, 1)).all():
+        raise ValueError('The Jaccard metric needs binary fingerprints; '
+                         'please collate them with the `jaccard` metric.')
+    distsq = _allocate_condensed(fingerprints.shape[0], distance_dtype)
+    condensed_distances(fingerprints, metric, out=distsq, n_jobs=n_jobs)
+    return CondensedDistances(distsq, list(fingerprints.index), metric)
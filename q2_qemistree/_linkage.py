@@ -0,0 +1,441 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import heapq
+import numpy as np
+from scipy.sparse import csr_matrix
+from concurrent.futures import ThreadPoolExecutor
+from skbio import TreeNode
+
+from ._distances import (FingerprintDistances, _BLOCK_SIZE,
+                         _condensed_offset)
+
+
+def mst_single_linkage(distances: FingerprintDistances) -> np.ndarray:
+    '''
+    Computes a single linkage clustering from the minimum spanning tree of
+    the fingerprints (Prim's algorithm). Distances are computed one row at
+    a time, so memory grows linearly with the number of fingerprints while
+    the result is identical to ``scipy.cluster.hierarchy.linkage`` with
+    ``method='single'``.
+
+    Parameters
+    ----------
+    distances : FingerprintDistances
+        fingerprints and the metric used to compare them
+
+    Returns
+    -------
+    np.ndarray
+        linkage matrix in the format used by ``scipy.cluster.hierarchy``
+    '''
+    n = distances.n
+    in_tree = np.zeros(n, dtype=bool)
+    nearest = np.full(n, np.inf)
+    parent = np.zeros(n, dtype=np.int64)
+    edges = np.empty((n - 1, 3))
+    current = 0
+    for k in range(n - 1):
+        in_tree[current] = True
+        dists = distances.rows(current)[0]
+        closer = (dists < nearest) & ~in_tree
+        nearest[closer] = dists[closer]
+        parent[closer] = current
+        nearest[in_tree] = np.inf
+        current = int(np.argmin(nearest))
+        edges[k] = parent[current], current, nearest[current]
+    return _edges_to_linkage(edges, n)
+
+
+def _edges_to_linkage(edges: np.ndarray, n: int) -> np.ndarray:
+    '''Converts the edges of a minimum spanning tree into a single linkage
+    matrix by merging clusters along edges of increasing weight'''
+    edges = edges[np.argsort(edges[:, 2], kind='mergesort')]
+    root = np.arange(2 * n - 1)
+    size = np.ones(2 * n - 1)
+
+    def find(node):
+        while root[node] != node:
+            root[node] = root[root[node]]
+            node = root[node]
+        return node
+
+    linkage_matrix = np.empty((n - 1, 4))
+    for k, (a, b, weight) in enumerate(edges):
+        a, b = find(int(a)), find(int(b))
+        size[n + k] = size[a] + size[b]
+        root[a] = root[b] = n + k
+        linkage_matrix[k] = min(a, b), max(a, b), weight, size[n + k]
+    return linkage_matrix
+
+
+def nn_chain_average_linkage(condensed: np.ndarray) -> np.ndarray:
+    '''
+    Computes an average linkage (UPGMA) clustering with the nearest
+    neighbour chain algorithm, updating the condensed distances in place.
+    ``scipy.cluster.hierarchy.linkage`` always works on an in-memory float64
+    copy of its input; here only one row of distances is read at a time
+    (two when clusters are merged), so ``condensed`` may be a memory-mapped
+    vector larger than memory. The algorithm, its tie-breaking and its
+    floating point operations are those of scipy, so with float64 distances
+    the result is identical; float32 distances are updated in float64 and
+    stored rounded to float32.
+
+    Parameters
+    ----------
+    condensed : np.ndarray
+        condensed distance vector, e.g. an ``np.memmap``; it is overwritten
+
+    Returns
+    -------
+    np.ndarray
+        linkage matrix in the format used by ``scipy.cluster.hierarchy``
+    '''
+    n = int(np.ceil(np.sqrt(2 * len(condensed))))
+    offsets = _condensed_offset(np.arange(n), n)
+
+    def row_index(x):
+        # positions of the distances between x and every row
+        index = np.empty(n, dtype=np.int64)
+        index[:x] = offsets[:x] + x - np.arange(x) - 1
+        index[x] = 0
+        index[x + 1:] = offsets[x] + np.arange(n - x - 1)
+        return index
+
+    size = np.ones(n)
+    active = np.ones(n, dtype=bool)
+    merges = np.empty((n - 1, 3))
+    chain = []
+    for k in range(n - 1):
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        while True:
+            x = chain[-1]
+            row = condensed[row_index(x)].astype(np.float64)
+            row[~active] = np.inf
+            row[x] = np.inf
+            y = int(np.argmin(row))
+            # like scipy, the previous cluster of the chain is kept unless
+            # another one is strictly closer
+            if len(chain) > 1 and not row[y] < row[chain[-2]]:
+                y = chain[-2]
+                break
+            chain.append(y)
+        distance = row[y]
+        del chain[-2:]
+        x, y = min(x, y), max(x, y)
+        merges[k] = x, y, distance
+        x_index, y_index = row_index(x), row_index(y)
+        x_dists = condensed[x_index].astype(np.float64)
+        y_dists = condensed[y_index].astype(np.float64)
+        nx, ny = size[x], size[y]
+        size[x] = 0
+        active[x] = False
+        size[y] = nx + ny
+        others = active.copy()
+        others[y] = False
+        condensed[y_index[others]] = ((nx * x_dists[others] +
+                                       ny * y_dists[others]) / (nx + ny))
+    return _edges_to_linkage(merges, n)
+
+
+def _nearest_neighbors(distances: FingerprintDistances, n_neighbors: int,
+                       n_jobs: int = 1) -> (np.ndarray, np.ndarray):
+    '''Finds the ``n_neighbors`` closest fingerprints of every fingerprint.
+    Distances are computed in row blocks, by ``n_jobs`` threads.'''
+    n = distances.n
+    n_neighbors = min(n_neighbors, n - 1)
+    neighbors = np.empty((n, n_neighbors), dtype=np.int64)
+    neighbor_dists = np.empty((n, n_neighbors))
+    block_rows = max(1, _BLOCK_SIZE // n)
+
+    def fill(start):
+        stop = min(start + block_rows, n)
+        dists = distances.rows(np.arange(start, stop), fast=True)
+        dists[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        nearest = np.argpartition(dists, n_neighbors - 1,
+                                  axis=1)[:, :n_neighbors]
+        neighbors[start:stop] = nearest
+        neighbor_dists[start:stop] = np.take_along_axis(dists, nearest,
+                                                        axis=1)
+
+    starts = range(0, n, block_rows)
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(fill, starts))
+    else:
+        for start in starts:
+            fill(start)
+    return neighbors, neighbor_dists
+
+
+def _cluster_members(linkage_matrix: np.ndarray, clusters: list,
+                     n: int) -> np.ndarray:
+    '''Labels every fingerprint with its position in ``clusters``, a list
+    of cluster identifiers from a partial linkage matrix'''
+    labels = np.empty(n, dtype=np.int64)
+    for label, cluster in enumerate(clusters):
+        stack = [cluster]
+        while stack:
+            node = stack.pop()
+            if node < n:
+                labels[node] = label
+            else:
+                a, b = linkage_matrix[node - n, :2]
+                stack.extend([int(a), int(b)])
+    return labels
+
+
+def _cluster_distance_sums(distances: FingerprintDistances,
+                           labels: np.ndarray, n_clusters: int,
+                           n_jobs: int = 1) -> np.ndarray:
+    '''Sums the distances between all pairs of fingerprints for every pair
+    of clusters, one block of rows at a time'''
+    n = distances.n
+    indicator = csr_matrix((np.ones(n), (np.arange(n), labels)),
+                           shape=(n, n_clusters))
+    sums = np.zeros((n_clusters, n_clusters))
+    block_rows = max(1, _BLOCK_SIZE // n)
+
+    def fill(start):
+        stop = min(start + block_rows, n)
+        block = indicator[start:stop].T @ (
+            indicator.T @ distances.rows(np.arange(start, stop),
+                                         fast=True).T).T
+        return block
+
+    starts = range(0, n, block_rows)
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for block in executor.map(fill, starts):
+                sums += block
+    else:
+        for start in starts:
+            sums += fill(start)
+    return sums
+
+
+def knn_average_linkage(distances: FingerprintDistances,
+                        n_neighbors: int = 30,
+                        n_jobs: int = 1) -> np.ndarray:
+    '''
+    Computes an approximate average linkage (UPGMA) clustering on the
+    symmetric k-nearest-neighbour graph of the fingerprints.
+
+    The distance between two clusters is the mean of all fingerprint
+    distances between them, where pairs that are not joined by a neighbour
+    graph edge are imputed with the mean radius (distance to the furthest
+    kept neighbour) of both fingerprints, a lower bound of their distance.
+    When the graph is complete (``n_neighbors`` of at least N - 1) nothing
+    is imputed and this is exact UPGMA. If the graph falls apart into several
+    components, the exact average distances between the remaining clusters
+    are computed and clustering finishes as exact UPGMA over them. Merge
+    heights are kept monotone so that branch lengths are never negative.
+
+    Memory grows with N x ``n_neighbors`` rather than N². Euclidean
+    distances are computed from dot products (see
+    ``FingerprintDistances.rows``).
+
+    Parameters
+    ----------
+    distances : FingerprintDistances
+        fingerprints and the metric used to compare them
+    n_neighbors : int, default 30
+        number of nearest neighbours of each fingerprint kept in the graph
+    n_jobs : int, default 1
+        number of threads used to compute distances
+
+    Returns
+    -------
+    np.ndarray
+        linkage matrix in the format used by ``scipy.cluster.hierarchy``
+    '''
+    n = distances.n
+    neighbors, neighbor_dists = _nearest_neighbors(distances, n_neighbors,
+                                                   n_jobs)
+    # adjacency between clusters: every edge holds the sum of the known
+    # distances and their count, shared by both endpoints
+    adjacency = {i: {} for i in range(n)}
+    for i in range(n):
+        for j, dist in zip(neighbors[i], neighbor_dists[i]):
+            j = int(j)
+            if j not in adjacency[i]:
+                adjacency[i][j] = adjacency[j][i] = [dist, 1]
+    size = {i: 1 for i in range(n)}
+    radius = dict(enumerate(neighbor_dists.max(axis=1)))
+    height = {i: 0.0 for i in range(n)}
+
+    def average(a, b, edge):
+        missing = size[a] * size[b] - edge[1]
+        imputed = (radius[a] / size[a] + radius[b] / size[b]) / 2
+        return (edge[0] + missing * imputed) / (size[a] * size[b])
+
+    heap = [(average(a, b, edge), a, b) for a in adjacency
+            for b, edge in adjacency[a].items() if a < b]
+    heapq.heapify(heap)
+    linkage_matrix = np.empty((n - 1, 4))
+    for k in range(n - 1):
+        while True:
+            if not heap:
+                _connect_clusters(distances, adjacency, size,
+                                  linkage_matrix[:k], n_jobs)
+                heap = [(average(a, b, edge), a, b) for a in adjacency
+                        for b, edge in adjacency[a].items() if a < b]
+                heapq.heapify(heap)
+            dist, a, b = heapq.heappop(heap)
+            if a in adjacency and b in adjacency[a]:
+                break
+        merged = n + k
+        edges = {}
+        for cluster in (a, b):
+            for other, edge in adjacency.pop(cluster).items():
+                if other in (a, b):
+                    continue
+                del adjacency[other][cluster]
+                if other in edges:
+                    edges[other][0] += edge[0]
+                    edges[other][1] += edge[1]
+                else:
+                    edges[other] = [edge[0], edge[1]]
+        adjacency[merged] = edges
+        size[merged] = size.pop(a) + size.pop(b)
+        radius[merged] = radius.pop(a) + radius.pop(b)
+        height[merged] = max(dist, height.pop(a), height.pop(b))
+        for other, edge in edges.items():
+            adjacency[other][merged] = edge
+            heapq.heappush(heap, (average(other, merged, edge), other,
+                                  merged))
+        linkage_matrix[k] = a, b, height[merged], size[merged]
+    return linkage_matrix
+
+
+def _connect_clusters(distances: FingerprintDistances, adjacency: dict,
+                      size: dict, linkage_matrix: np.ndarray,
+                      n_jobs: int = 1):
+    '''Joins the remaining disconnected clusters with edges that hold the
+    exact sums of distances between their fingerprints'''
+    clusters = sorted(adjacency)
+    labels = _cluster_members(linkage_matrix, clusters, distances.n)
+    sums = _cluster_distance_sums(distances, labels, len(clusters), n_jobs)
+    for i, a in enumerate(clusters):
+        for j in range(i + 1, len(clusters)):
+            b = clusters[j]
+            edge = [sums[i, j], size[a] * size[b]]
+            adjacency[a][b] = adjacency[b][a] = edge
+
+
+class LinkageTree:
+    '''
+    An array-backed rooted binary tree built straight from a linkage
+    matrix. Children and branch lengths are stored in arrays indexed like
+    the clusters of the linkage matrix (tips first, then one node per
+    merge), so the tree can be written as Newick without creating a Python
+    object per node; ``to_treenode`` builds an ``skbio.TreeNode`` when one
+    is needed.
+
+    Branch lengths follow ``skbio.TreeNode.from_linkage_matrix``: a node
+    sits at half the merge distance, and each child's length is that minus
+    the child's distance to its tips along first children.
+
+    ``members`` maps tip names to the names of fingerprints collapsed into
+    them; such a tip becomes a node whose children, the tip itself and its
+    members, all have zero-length branches.
+    '''
+
+    def __init__(self, linkage_matrix: np.ndarray, tip_names: list,
+                 members: dict = None):
+        n = len(tip_names)
+        self.tip_names = list(tip_names)
+        self.members = members or {}
+        self.children = linkage_matrix[:, :2].astype(np.int64)
+        self.lengths = np.full(2 * n - 1, np.nan)
+        tip_distance = np.zeros(2 * n - 1)
+        for k, (a, b) in enumerate(self.children):
+            path_length = linkage_matrix[k, 2] / 2
+            self.lengths[a] = path_length - tip_distance[a]
+            self.lengths[b] = path_length - tip_distance[b]
+            tip_distance[n + k] = self.lengths[a] + tip_distance[a]
+
+    @property
+    def n_tips(self) -> int:
+        return len(self.tip_names)
+
+    @property
+    def root(self) -> int:
+        return 2 * self.n_tips - 2
+
+    def _postorder(self):
+        '''Yields (node, first visit) pairs; internal nodes are yielded
+        once before and once after their children'''
+        n = self.n_tips
+        stack = [(self.root, True)]
+        while stack:
+            node, first = stack.pop()
+            yield node, first
+            if first and node >= n:
+                stack.append((node, False))
+                a, b = self.children[node - n]
+                stack.append((b, True))
+                stack.append((a, True))
+
+    def to_newick(self) -> str:
+        '''Formats the tree as Newick, as skbio's Newick writer does'''
+        n = self.n_tips
+        tokens = []
+        for node, first in self._postorder():
+            if node >= n and first:
+                tokens.append('(')
+                continue
+            if node >= n:
+                tokens[-1] = ')'
+            else:
+                tokens.append(self._tip_newick(node))
+            if node != self.root:
+                tokens.append(':%r' % float(self.lengths[node]))
+            tokens.append(',')
+        tokens[-1] = ';\n'
+        return ''.join(tokens)
+
+    def _group(self, tip: int) -> list:
+        '''Names of the fingerprints collapsed into a tip, itself first'''
+        name = self.tip_names[tip]
+        return [name] + list(self.members.get(name, []))
+
+    def _tip_newick(self, tip: int) -> str:
+        group = self._group(tip)
+        if len(group) == 1:
+            return _newick_label(group[0])
+        return '(%s)' % ','.join('%s:0.0' % _newick_label(name)
+                                 for name in group)
+
+    def _tip_treenode(self, tip: int) -> TreeNode:
+        group = self._group(tip)
+        if len(group) == 1:
+            return TreeNode(name=group[0])
+        return TreeNode(children=[TreeNode(name=name, length=0.0)
+                                  for name in group])
+
+    def to_treenode(self) -> TreeNode:
+        '''Builds the equivalent ``skbio.TreeNode``'''
+        n = self.n_tips
+        nodes = [self._tip_treenode(tip) for tip in range(n)]
+        nodes += [TreeNode() for _ in range(n - 1)]
+        for k, (a, b) in enumerate(self.children):
+            nodes[a].length = float(self.lengths[a])
+            nodes[b].length = float(self.lengths[b])
+            nodes[n + k].extend([nodes[a], nodes[b]])
+        return nodes[-1]
+
+
+def _newick_label(name: str) -> str:
+    '''Escapes a tip name the way skbio's Newick writer does'''
+    name = str(name)
+    escaped = name.replace("'", "''")
+    if any(t in set(",:_;()[]") for t in name):
+        return "'%s'" % escaped
+    return escaped.replace(' ', '_')
@@ -0,0 +1,123 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import time
+import sqlite3
+import threading
+
+_DAY = 24 * 60 * 60
+
+
+class LookupCache:
+    '''
+    A persistent cache of web service responses in an SQLite file, shared
+    by the threads of a run and between runs.
+
+    Responses are stored per lookup stage (e.g. SMILES to InChIKey) and
+    key, with their status code. Only successful (200) and not found (404)
+    responses are cached; not found responses expire after
+    ``negative_ttl`` days, so that structures added to a service later are
+    looked up again, and any response expires after ``max_age`` days.
+    Writes are committed in batches; with every batch, and when the cache
+    is closed, expired responses and, beyond ``max_entries``, the least
+    recently used responses are evicted, so that the file stays bounded
+    during a run.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file that holds the cache; created if it does not exist
+    negative_ttl : float, default 7
+        days after which not found responses are looked up again
+    max_age : float, optional
+        days after which any response is evicted
+    max_entries : int, optional
+        largest number of responses kept
+    '''
+
+    def __init__(self, path: str, negative_ttl: float = 7,
+                 max_age: float = None, max_entries: int = None):
+        self.negative_ttl = negative_ttl * _DAY
+        self.max_age = None if max_age is None else max_age * _DAY
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS lookups ('
+                         'stage TEXT, key TEXT, status INTEGER, value TEXT, '
+                         'created REAL, used REAL, '
+                         'PRIMARY KEY (stage, key))')
+        self._db.commit()
+
+    def get(self, stage: str, key: str) -> tuple:
+        '''Returns the cached (status code, text) of a lookup, or None'''
+        now = time.time()
+        with self._lock:
+            found = self._db.execute(
+                'SELECT status, value, created FROM lookups '
+                'WHERE stage = ? AND key = ?', (stage, key)).fetchone()
+            if found is None or self._expired(found[0], found[2], now):
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE lookups SET used = ? '
+                             'WHERE stage = ? AND key = ?', (now, stage, key))
+            self._written()
+            self.hits += 1
+        return found[0], found[1]
+
+    def _expired(self, status: int, created: float, now: float) -> bool:
+        age = now - created
+        return ((status == 404 and age > self.negative_ttl) or
+                (self.max_age is not None and age > self.max_age))
+
+    def put(self, stage: str, key: str, status: int, value: str):
+        '''Caches the response of a lookup if it is cacheable'''
+        if status not in (200, 404):
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO lookups '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (stage, key, status, value, now, now))
+            self._written()
+
+    def _written(self):
+        # writes are committed in batches rather than one at a time, and
+        # every batch evicts responses so that the file stays bounded
+        self._pending += 1
+        if self._pending >= 100:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        self._db.execute('DELETE FROM lookups WHERE status = 404 '
+                         'AND created < ?', (now - self.negative_ttl,))
+        if self.max_age is not None:
+            self._db.execute('DELETE FROM lookups WHERE created < ?',
+                             (now - self.max_age,))
+        if self.max_entries is not None:
+            self._db.execute(
+                'DELETE FROM lookups WHERE rowid NOT IN (SELECT rowid '
+                'FROM lookups ORDER BY used DESC LIMIT ?)',
+                (self.max_entries,))
+        self._db.commit()
+        self._pending = 0
+
+    def evict(self):
+        '''Evicts expired, too old and least recently used responses'''
+        with self._lock:
+            self._evict()
+
+    def close(self):
+        '''Evicts responses and closes the cache file'''
+        self.evict()
+        self._db.close()
@@ -8,13 +8,73 @@
 
 import biom
 import hashlib
+import numpy as np
 import pandas as pd
 import warnings
+from scipy.sparse import csr_matrix
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _md5_rows(fingerprints: np.ndarray, n_jobs: int = 1) -> list:
+    '''
+    Returns the MD5 hex digest of the bytes of every row of a fingerprint
+    matrix. The matrix is made C-contiguous once so that each row is hashed
+    in place; the digests are identical to hashing ``row.tobytes()``.
+    hashlib releases the GIL on large buffers, so with ``n_jobs`` > 1 chunks
+    of rows are hashed by a pool of threads.
+
+    Binary fingerprints are kept as booleans, but every row is hashed as
+    int64, one row at a time, so that their labels are those of the
+    integer fingerprints of earlier versions.
+    '''
+    fingerprints = np.ascontiguousarray(fingerprints)
+    canonical = np.int64 if fingerprints.dtype == bool else None
+
+    def _hash(rows):
+        if canonical is not None:
+            return [hashlib.md5(fingerprints[row].astype(canonical)
+                                ).hexdigest() for row in rows]
+        return [hashlib.md5(fingerprints[row]).hexdigest() for row in rows]
+
+    rows = range(fingerprints.shape[0])
+    if n_jobs > 1 and len(rows) > 1:
+        chunks = [rows[i::n_jobs] for i in range(n_jobs)]
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            hashed = list(executor.map(_hash, chunks))
+        md5s = [None] * len(rows)
+        for i, chunk in enumerate(hashed):
+            md5s[i::n_jobs] = chunk
+        return md5s
+    return _hash(rows)
+
+
+def _collapse_table(feature_table: biom.Table, feature_ids: list,
+                    labels: list, unique_labels: pd.Index) -> biom.Table:
+    '''
+    Sums the rows of ``feature_table`` that share a label without
+    densifying it: a sparse (label x feature) indicator matrix is multiplied
+    with the selected sparse (feature x sample) rows.
+    '''
+    obs_index = {fid: i for i, fid in
+                 enumerate(feature_table.ids(axis='observation'))}
+    rows = [obs_index[fid] for fid in feature_ids]
+    data = feature_table.matrix_data.tocsr()[rows]
+    indicator = csr_matrix(
+        (np.ones(len(rows)), (unique_labels.get_indexer(labels),
+                              np.arange(len(rows)))),
+        shape=(len(unique_labels), len(rows)))
+    collapsed = (indicator @ data).astype(float)
+    collapsed.eliminate_zeros()
+    # biom requires that ids be strings
+    return biom.table.Table(
+        data=collapsed, observation_ids=unique_labels.astype(str),
+        sample_ids=[str(i) for i in feature_table.ids(axis='sample')])
 
 
 def get_matched_tables(collated_fingerprints: pd.DataFrame,
                        smiles: pd.DataFrame,
-                       feature_table: biom.Table):
+                       feature_table: biom.Table,
+                       n_jobs: int = 1):
     '''
     This function filters the feature table to retain only features with
     fingerprints. It also relabels features with MD5 hash of its
@@ -29,6 +89,8 @@ def get_matched_tables(collated_fingerprints: pd.DataFrame,
         table containing smiles for each mass-spec feature (index)
     feature_table : biom.Table
         feature tables with mass-spec feature intensity per sample.
+    n_jobs : int, default 1
+        number of threads used to hash fingerprints
 
     Raises
     ------
@@ -53,22 +115,16 @@ def get_matched_tables(collated_fingerprints: pd.DataFrame,
     allfps = list(fps.index)
     if fps.empty:
         raise ValueError("Cannot have empty fingerprint table")
-    table = feature_table.to_dataframe(dense=True)
-    allfeatrs = set(table.index)
-    overlap = list(set(allfps).intersection(allfeatrs))
+    allfeatrs = set(feature_table.ids(axis='observation'))
+    overlap = [fid for fid in allfps if fid in allfeatrs]
     if not set(allfps).issubset(allfeatrs):
         extra_tips = set(allfps) - set(overlap)
         warnings.warn('The following fingerprints were not '
                       'found in the feature table; removed from qemistree:\n' +
                       ', '.join([str(i) for i in extra_tips]), UserWarning)
-    filtered_table = table.reindex(overlap)
     filtered_fps = fps.reindex(overlap)
-    list_md5 = []
-    for fid in overlap:
-        md5 = str(hashlib.md5(fps.loc[fid].values.tobytes()).hexdigest())
-        list_md5.append(md5)
+    list_md5 = _md5_rows(filtered_fps.values, n_jobs)
     filtered_fps['label'] = list_md5
-    filtered_table['label'] = list_md5
     feature_data = pd.DataFrame(columns=['label', '#featureID', 'csi_smiles',
                                          'ms2_smiles', 'ms2_library_match',
                                          'parent_mass', 'retention_time'])
@@ -83,11 +139,7 @@ def get_matched_tables(collated_fingerprints: pd.DataFrame,
                                                      'retention_time'])
     feature_data.set_index('label', inplace=True)
     relabel_fps = filtered_fps.groupby('label').first()
-    matched_table = filtered_table.groupby('label').sum()
-    # biom requires that ids be strings
-    npfeatures = matched_table.values
-    matched_table = biom.table.Table(
-        data=npfeatures, observation_ids=matched_table.index.astype(str),
-        sample_ids=matched_table.columns.astype(str))
+    matched_table = _collapse_table(feature_table, overlap, list_md5,
+                                    relabel_fps.index)
 
     return relabel_fps, matched_table, feature_data
@@ -7,45 +7,313 @@
 # ----------------------------------------------------------------------------
 
 import os
+import json
+import hashlib
+import zipfile
 import pandas as pd
 import numpy as np
 import pkg_resources
+from concurrent.futures import ThreadPoolExecutor
 
 from ._semantics import CSIDirFmt
+from ._distances import quantize_fingerprints
 
 
 data = pkg_resources.resource_filename('q2_qemistree', 'data')
 
 
+class _CSIDirectory:
+    '''Reads CSI:FingerID results from an output folder on disk.'''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fingerprint_files(self) -> list:
+        '''Walks the output folder once and returns a list of
+        (feature ID, fingerprint file path) tuples in directory order.
+        Paths are relative to the output folder.
+        '''
+        fpfiles = []
+        with os.scandir(self.path) as foldrs:
+            for foldr in foldrs:
+                if not foldr.is_dir():
+                    continue
+                fpdir = os.path.join(foldr.path, 'fingerprints')
+                try:
+                    with os.scandir(fpdir) as fnames:
+                        fname = next(fnames, None)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                if fname is not None:
+                    fpfiles.append((foldr.name.split('_')[-1],
+                                    '/'.join([foldr.name, 'fingerprints',
+                                              fname.name])))
+        return fpfiles
+
+    def read(self, relpath: str) -> bytes:
+        with open(os.path.join(self.path, relpath), 'rb') as f:
+            return f.read()
+
+    def open(self, relpath: str):
+        return open(os.path.join(self.path, relpath), 'rb')
+
+    def checksums(self) -> bytes:
+        '''A plain folder has no artifact checksums'''
+        return None
+
+    def close(self):
+        pass
+
+
+class _CSIArchive:
+    '''Reads CSI:FingerID results straight out of a CSIFolder artifact
+    (.qza) without extracting it to disk. Members are located relative to
+    the ``data/csi-output`` folder of the archive.
+    '''
+
+    def __init__(self, path: str):
+        self.zf = zipfile.ZipFile(path)
+        self.members = {}
+        self.checksums_info = None
+        prefix = None
+        for info in self.zf.infolist():
+            parts = info.filename.split('/')
+            if parts[1:3] == ['data', 'csi-output'] and len(parts) > 3:
+                prefix = '/'.join(parts[:3]) + '/'
+                self.members[info.filename[len(prefix):]] = info
+            elif parts[1:] == ['checksums.md5']:
+                self.checksums_info = info
+        if prefix is None:
+            self.zf.close()
+            raise ValueError('%s is not a CSIFolder artifact' % path)
+
+    def fingerprint_files(self) -> list:
+        fpfiles, seen = [], set()
+        for relpath, info in self.members.items():
+            parts = relpath.split('/')
+            if (len(parts) == 3 and parts[1] == 'fingerprints' and
+                    parts[2] and not info.is_dir() and parts[0] not in seen):
+                seen.add(parts[0])
+                fpfiles.append((parts[0].split('_')[-1], relpath))
+        return fpfiles
+
+    def read(self, relpath: str) -> bytes:
+        return self.zf.read(self.members[relpath])
+
+    def open(self, relpath: str):
+        return self.zf.open(self.members[relpath])
+
+    def checksums(self) -> bytes:
+        '''The MD5 checksums QIIME 2 records for every file of the
+        artifact, or None if the archive has none'''
+        if self.checksums_info is None:
+            return None
+        return self.zf.read(self.checksums_info)
+
+    def close(self):
+        self.zf.close()
+
+
+def _open_csi_result(csi_result):
+    '''Returns a reader for a CSIDirFmt, an output folder path or the path
+    to a CSIFolder artifact (.qza).
+    '''
+    if isinstance(csi_result, (_CSIDirectory, _CSIArchive)):
+        return csi_result
+    if isinstance(csi_result, CSIDirFmt):
+        return _CSIDirectory(str(csi_result.get_path()))
+    if os.path.isfile(csi_result) and zipfile.is_zipfile(csi_result):
+        return _CSIArchive(csi_result)
+    return _CSIDirectory(csi_result)
+
+
+def _parse_fingerprints(reader, relpaths: tuple, nbits: int,
+                        n_jobs: int = 1,
+                        precision: str = 'float64') -> np.ndarray:
+    '''Parses fingerprint files into a preallocated (features x bits)
+    matrix of probabilities, optionally using a pool of threads. Each file
+    is converted to ``precision`` as it is parsed: float64, float32, uint8
+    (probabilities quantized to 0-255) or bool (probabilities above 0.5,
+    one byte per substructure).
+    '''
+    molfp = np.empty((len(relpaths), nbits), dtype=precision)
+
+    def _fill(row):
+        probabilities = np.array(reader.read(relpaths[row]).split(),
+                                 dtype=np.float64)
+        if precision == 'uint8':
+            probabilities = quantize_fingerprints(probabilities)
+        elif precision == 'bool':
+            probabilities = probabilities > 0.5
+        molfp[row] = probabilities
+
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(_fill, range(len(relpaths))))
+    else:
+        for row in range(len(relpaths)):
+            _fill(row)
+    return molfp
+
+
+def _cache_key(reader, fpfiles: list, n_jobs: int = 1) -> str:
+    '''Computes a cache key from the contents of the substructure index and
+    of the fingerprint files, with their relative names.
+
+    The contents of an artifact (.qza) are covered by the checksums QIIME 2
+    stores in it, so its fingerprint files are not read; those of an output
+    folder are hashed, optionally on a pool of threads. Modification times
+    are deliberately left out: QIIME 2 extracts an artifact to a new
+    temporary directory every time it is viewed, so they change between
+    otherwise identical runs.
+    '''
+    manifest = hashlib.md5(reader.read('csi_fingerid.tsv'))
+    checksums = reader.checksums()
+    if checksums is not None:
+        manifest.update(checksums)
+        return manifest.hexdigest()
+    fpfiles = sorted(fpfiles)
+
+    def _digest(relpath):
+        return hashlib.md5(reader.read(relpath)).hexdigest()
+
+    relpaths = [relpath for _, relpath in fpfiles]
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            digests = list(executor.map(_digest, relpaths))
+    else:
+        digests = [_digest(relpath) for relpath in relpaths]
+    for (fid, relpath), digest in zip(fpfiles, digests):
+        manifest.update(('%s\t%s\t%s\n' % (fid, relpath, digest)).encode())
+    return manifest.hexdigest()
+
+
+def _load_cached_fingerprints(cache_dir: str, key: str):
+    '''Returns the memory-mapped fingerprint matrix, feature IDs and
+    column labels stored under ``key``, or None on a cache miss.
+    '''
+    matrix_fp = os.path.join(cache_dir, key + '.npy')
+    sidecar_fp = os.path.join(cache_dir, key + '.json')
+    if not (os.path.exists(matrix_fp) and os.path.exists(sidecar_fp)):
+        return None
+    with open(sidecar_fp) as f:
+        sidecar = json.load(f)
+    molfp = np.load(matrix_fp, mmap_mode='r')
+    if molfp.shape != (len(sidecar['feature_ids']),
+                       len(sidecar['columns'])):
+        return None
+    return molfp, sidecar['feature_ids'], sidecar['columns']
+
+
+def _store_cached_fingerprints(cache_dir: str, key: str, molfp: np.ndarray,
+                               fids: list, columns: list):
+    '''Writes the fingerprint matrix as a .npy file with a JSON sidecar of
+    feature IDs and column labels. Files are written under temporary names
+    and moved in place so that concurrent runs never see partial entries.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    suffix = '.%d.tmp' % os.getpid()
+    matrix_fp = os.path.join(cache_dir, key + '.npy')
+    sidecar_fp = os.path.join(cache_dir, key + '.json')
+    with open(matrix_fp + suffix, 'wb') as f:
+        np.save(f, molfp)
+    with open(sidecar_fp + suffix, 'w') as f:
+        json.dump({'feature_ids': list(fids), 'columns': list(columns)}, f)
+    os.replace(matrix_fp + suffix, matrix_fp)
+    os.replace(sidecar_fp + suffix, sidecar_fp)
+
+
+def encode_fingerprints(fingerprints: pd.DataFrame) -> (np.ndarray, dict):
+    '''Encodes a fingerprint table compactly for storage: binary
+    fingerprints (as binarized for the Jaccard metric) are packed eight
+    bits per byte, and probabilities are kept in the precision they were
+    collated with (float64, float32 or uint8), so that decoding gives back
+    the same table, and the same MD5 labels and distances. Returns the
+    matrix and a JSON-serializable index of feature IDs, column labels, the
+    encoding and the dtype of the table.
+    '''
+    values = fingerprints.values
+    index = {'feature_ids': [str(i) for i in fingerprints.index],
+             'columns': [str(i) for i in fingerprints.columns],
+             'dtype': values.dtype.name}
+    if values.dtype.kind in 'ib' and np.isin(values, (0, 1)).all():
+        index['encoding'] = 'packed-bits'
+        return np.packbits(values.astype(np.uint8), axis=1), index
+    if values.dtype not in (np.float32, np.uint8):
+        values = values.astype(np.float64, copy=False)
+    index['encoding'] = index['dtype'] = values.dtype.name
+    return values, index
+
+
+def decode_fingerprints(matrix: np.ndarray, index: dict) -> pd.DataFrame:
+    '''Rebuilds the fingerprint table written by ``encode_fingerprints``;
+    packed bits are unpacked to the integer dtype they were collated with,
+    so MD5 labels of binary fingerprints can be recomputed from the table.
+    '''
+    if index['encoding'] == 'packed-bits':
+        matrix = np.unpackbits(matrix, axis=1,
+                               count=len(index['columns'])).astype(
+                                   index.get('dtype', 'int64'))
+    fingerprints = pd.DataFrame(matrix, index=index['feature_ids'])
+    fingerprints.index.name = 'label'
+    fingerprints.columns = pd.Index(index['columns'], name='absoluteIndex')
+    return fingerprints
+
+
 def collate_fingerprint(csi_result: CSIDirFmt,
-                        metric: str = 'euclidean'):
+                        metric: str = 'euclidean',
+                        n_jobs: int = 1,
+                        cache_dir: str = None,
+                        precision: str = 'float64'):
     '''
     This function collates predicted chemical fingerprints for mass-spec
-    features in an experiment.
+    features in an experiment. ``csi_result`` can be a CSIDirFmt, an output
+    folder or a CSIFolder artifact (.qza), which is read without being
+    extracted to disk. Fingerprint files are parsed directly into
+    a preallocated matrix; with ``n_jobs`` > 1 the files are read using a
+    pool of threads. If ``cache_dir`` is given, the collated probabilities
+    are stored there and memory-mapped on later runs over the same
+    CSI:FingerID output.
+
+    ``precision`` sets how probabilities are stored: float64, float32 or
+    uint8 (quantized to 0-255). It only applies to probabilities; for the
+    Jaccard metric every file is binarized as it is parsed into a boolean
+    table of one byte per substructure, whose MD5 labels are the same as
+    those of the integer table it replaces (see ``_md5_rows``).
     '''
-    if isinstance(csi_result, CSIDirFmt):
-        csi_result = str(csi_result.get_path())
-    fpfoldrs = os.listdir(csi_result)
-    molfp = dict()
-    for foldr in fpfoldrs:
-        if os.path.isdir(os.path.join(csi_result, foldr)):
-            fid = foldr.split('_')[-1]
-            fidpath = os.path.join(csi_result, foldr)
-            if 'fingerprints' in os.listdir(fidpath):
-                fname = os.listdir(os.path.join(fidpath, 'fingerprints'))[0]
-                with open(os.path.join(fidpath, 'fingerprints', fname)) as f:
-                    fp = f.read().strip().split('\n')
-                molfp[fid] = [float(val) for val in fp]
-    collated_fps = pd.DataFrame.from_dict(molfp, orient='index')
     if metric == 'jaccard':
-        collated_fps = (collated_fps > 0.5).astype(int)
-    if collated_fps.shape == (0, 0):
-        raise ValueError('Fingerprint file is empty!')
-    substructrs = pd.read_csv(os.path.join(csi_result, 'csi_fingerid.tsv'),
-                              index_col='relativeIndex', dtype=str, sep='\t')
+        precision = 'bool'
+    reader = _open_csi_result(csi_result)
+    try:
+        fpfiles = reader.fingerprint_files()
+        if len(fpfiles) == 0:
+            raise ValueError('Fingerprint file is empty!')
+        cached = None
+        if cache_dir is not None:
+            key = _cache_key(reader, fpfiles, n_jobs)
+            if precision != 'float64':
+                key += '-' + precision
+            cached = _load_cached_fingerprints(cache_dir, key)
+        if cached is not None:
+            molfp, fids, columns = cached
+        else:
+            with reader.open('csi_fingerid.tsv') as fh:
+                substructrs = pd.read_csv(fh, index_col='relativeIndex',
+                                          dtype=str, sep='\t')
+            fids, relpaths = zip(*fpfiles)
+            molfp = _parse_fingerprints(reader, relpaths, len(substructrs),
+                                        n_jobs, precision)
+            columns = substructrs.loc[range(molfp.shape[1]),
+                                      'absoluteIndex']
+            if cache_dir is not None:
+                _store_cached_fingerprints(cache_dir, key, molfp, fids,
+                                           columns)
+    finally:
+        if reader is not csi_result:
+            reader.close()
+    collated_fps = pd.DataFrame(molfp, index=list(fids))
     collated_fps.index.name = '#featureID'
-    collated_fps.columns = substructrs.loc[collated_fps.columns,
-                                           'absoluteIndex']
+    collated_fps.columns = pd.Index(columns, name='absoluteIndex')
     return collated_fps
 
 
@@ -54,11 +322,13 @@ def get_feature_smiles(csi_result: CSIDirFmt, collated_fps: pd.DataFrame,
     '''This function gets the SMILES of mass-spec features from
     CSI:FingerID and optionally, MS/MS library match results
     '''
-    if isinstance(csi_result, CSIDirFmt):
-        csi_result = str(csi_result.get_path())
-    csi_summary = os.path.join(csi_result, 'compound_identifications.tsv')
-    csi_summary = pd.read_csv(csi_summary, dtype=str,
-                              sep='\t')
+    reader = _open_csi_result(csi_result)
+    try:
+        with reader.open('compound_identifications.tsv') as fh:
+            csi_summary = pd.read_csv(fh, dtype=str, sep='\t')
+    finally:
+        if reader is not csi_result:
+            reader.close()
     csi_summary.index = csi_summary['id'].str.split('_', 2, expand=True)[2]
     smiles = pd.DataFrame(index=collated_fps.index)
     smiles['csi_smiles'] = csi_summary.reindex(smiles.index)['smiles'].str.strip()
@@ -80,12 +350,22 @@ def get_feature_smiles(csi_result: CSIDirFmt, collated_fps: pd.DataFrame,
 
 def process_csi_results(csi_result: CSIDirFmt,
                         library_match: pd.DataFrame = None,
-                        metric: str = 'euclidean') -> (pd.DataFrame,
-                                                       pd.DataFrame):
+                        metric: str = 'euclidean',
+                        cache_dir: str = None,
+                        n_jobs: int = 1,
+                        precision: str = 'float64'
+                        ) -> (pd.DataFrame, pd.DataFrame):
     '''This function parses CSI:FingerID result to generate tables
     of collated molecular fingerprints and SMILES for mass-spec features
     '''
-    collated_fps = collate_fingerprint(csi_result, metric)
-    feature_smiles = get_feature_smiles(csi_result, collated_fps,
-                                        library_match)
+    reader = _open_csi_result(csi_result)
+    try:
+        collated_fps = collate_fingerprint(reader, metric, n_jobs=n_jobs,
+                                           cache_dir=cache_dir,
+                                           precision=precision)
+        feature_smiles = get_feature_smiles(reader, collated_fps,
+                                            library_match)
+    finally:
+        if reader is not csi_result:
+            reader.close()
     return collated_fps, feature_smiles
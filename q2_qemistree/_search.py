@@ -0,0 +1,270 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from scipy.cluster.vq import kmeans2, vq
+from scipy.spatial.distance import cdist
+
+from ._process_fingerprint import encode_fingerprints
+from ._distances import (_principal_axes, _project, _BLOCK_SIZE,
+                         _QUANTIZATION_LEVELS)
+
+
+class FingerprintSearchIndex:
+    '''
+    An inverted-file index for approximate nearest-neighbour search over
+    molecular fingerprints.
+
+    Fingerprints are projected onto their leading principal axes and
+    assigned to the closest of a set of k-means centroids in that space;
+    they are stored grouped by centroid, so that every list is a contiguous
+    block of rows. A query is compared exactly with the fingerprints of
+    the lists whose centroids are closest to its projection. Fingerprints
+    are kept in their stored encoding (see ``encode_fingerprints``), which
+    may be memory-mapped, and only the rows that are compared are decoded.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        encoded fingerprints, ordered by list
+    index : dict
+        feature IDs, column labels and encoding of ``matrix``
+    metric : str
+        metric used to compare fingerprints
+    axes : np.ndarray
+        principal axes the fingerprints are projected onto
+    centroids : np.ndarray
+        centroid of every list, in the space of ``axes``
+    offsets : np.ndarray
+        first row of every list, followed by the number of rows
+    '''
+
+    def __init__(self, matrix: np.ndarray, index: dict, metric: str,
+                 axes: np.ndarray, centroids: np.ndarray,
+                 offsets: np.ndarray):
+        self.matrix = matrix
+        self.index = index
+        self.metric = metric
+        self.axes = axes
+        self.centroids = centroids
+        self.offsets = offsets
+        self.labels = np.asarray(index['feature_ids'], dtype=object)
+
+    @property
+    def n(self) -> int:
+        return len(self.labels)
+
+    def _values(self, start: int, stop: int) -> np.ndarray:
+        '''Decodes rows ``start``..``stop`` as float64 probabilities, or as
+        booleans for the Jaccard metric'''
+        rows = np.asarray(self.matrix[start:stop])
+        encoding = self.index['encoding']
+        if encoding == 'packed-bits':
+            return np.unpackbits(rows, axis=1,
+                                 count=len(self.index['columns'])).astype(
+                                     bool)
+        if encoding == 'uint8':
+            return rows / _QUANTIZATION_LEVELS
+        return rows.astype(np.float64)
+
+    def _probe(self, projection: np.ndarray, n_neighbors: int,
+               n_probe: int) -> list:
+        '''Row ranges of the ``n_probe`` lists closest to a projected
+        query, and of further lists until they hold ``n_neighbors``
+        fingerprints'''
+        order = np.argsort(cdist(projection[None, :], self.centroids)[0],
+                           kind='mergesort')
+        ranges, n_found = [], 0
+        for k, centroid in enumerate(order):
+            if k >= n_probe and n_found >= n_neighbors:
+                break
+            start, stop = self.offsets[centroid], self.offsets[centroid + 1]
+            if stop > start:
+                ranges.append((start, stop))
+                n_found += stop - start
+        return ranges
+
+    def _search(self, query: np.ndarray, projection: np.ndarray,
+                n_neighbors: int, n_probe: int) -> (np.ndarray, np.ndarray):
+        rows, dists = [], []
+        chunk = max(1, _BLOCK_SIZE // max(self.matrix.shape[1], 1))
+        for start, stop in self._probe(projection, n_neighbors, n_probe):
+            for first in range(start, stop, chunk):
+                last = min(first + chunk, stop)
+                rows.append(np.arange(first, last))
+                dists.append(cdist(query[None, :],
+                                   self._values(first, last),
+                                   metric=self.metric)[0])
+        rows, dists = np.concatenate(rows), np.concatenate(dists)
+        nearest = np.lexsort((rows, dists))[:n_neighbors]
+        return rows[nearest], dists[nearest]
+
+    def query(self, fingerprints: pd.DataFrame, n_neighbors: int = 10,
+              n_probe: int = 8, n_jobs: int = 1) -> (np.ndarray, np.ndarray):
+        '''
+        Finds the indexed fingerprints closest to every query fingerprint.
+
+        Parameters
+        ----------
+        fingerprints : pd.DataFrame
+            query fingerprints, with the columns of the indexed ones
+        n_neighbors : int, default 10
+            number of neighbours returned per query
+        n_probe : int, default 8
+            number of lists compared with every query; more lists make
+            the search more accurate and slower
+        n_jobs : int, default 1
+            number of threads that search for the queries
+
+        Returns
+        -------
+        np.ndarray
+            labels of the neighbours of every query, closest first
+        np.ndarray
+            their distances to the query
+        '''
+        n_neighbors = min(n_neighbors, self.n)
+        queries = fingerprints.values
+        if queries.dtype == np.uint8:
+            queries = queries / _QUANTIZATION_LEVELS
+        queries = queries.astype(bool if self.metric == 'jaccard' else
+                                 np.float64)
+        projections = _project(queries.astype(np.float64), self.axes)
+
+        def search(i):
+            return self._search(queries[i], projections[i], n_neighbors,
+                                n_probe)
+
+        if n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                found = list(executor.map(search, range(len(queries))))
+        else:
+            found = [search(i) for i in range(len(queries))]
+        neighbors = np.array([self.labels[rows] for rows, _ in found],
+                             dtype=object).reshape(-1, n_neighbors)
+        distances = np.array([dists for _, dists in found]).reshape(
+            -1, n_neighbors)
+        return neighbors, distances
+
+
+def build_fingerprint_index(fingerprints: pd.DataFrame,
+                            metric: str = 'euclidean',
+                            n_lists: int = None,
+                            n_components: int = 32,
+                            seed: int = 0) -> FingerprintSearchIndex:
+    '''
+    This function builds a search index over molecular fingerprints, so
+    that the molecules closest to new features can be found without
+    computing their distances to all of them.
+
+    Parameters
+    ----------
+    fingerprints : pd.DataFrame
+        fingerprint table indexed by the MD5 hash of fingerprint vectors,
+        as made by collate_fingerprints
+    metric : str, default `euclidean`
+        metric used to compare fingerprints; `jaccard` needs binary
+        fingerprints
+    n_lists : int, optional
+        number of lists fingerprints are grouped into; the square root of
+        the number of fingerprints by default
+    n_components : int, default 32
+        number of principal axes fingerprints are projected onto to be
+        grouped
+    seed : int, default 0
+        seed of the k-means clustering that groups fingerprints
+
+    Raises
+    ------
+    ValueError
+        If the Jaccard metric is used with fingerprints that are not binary
+
+    Returns
+    -------
+    FingerprintSearchIndex
+        the search index
+    '''
+    if metric == 'jaccard' and not np.isin(fingerprints.values, (0, 1)).all():
+        raise ValueError('The Jaccard metric needs binary fingerprints; '
+                         'please collate them with the `jaccard` metric.')
+    n = fingerprints.shape[0]
+    if n_lists is None:
+        n_lists = int(np.sqrt(n))
+    n_lists = max(1, min(n_lists, n))
+    values = np.ascontiguousarray(fingerprints.values)
+    axes = _principal_axes(values, n_components)
+    projections = _project(values, axes)
+    # the centroids are trained on a sample and all fingerprints assigned
+    sample = projections[np.random.RandomState(seed).permutation(n)[
+        :64 * n_lists]]
+    centroids, _ = kmeans2(sample, n_lists, minit='points', seed=seed)
+    codes = np.empty(n, dtype=np.int64)
+    block_rows = max(1, _BLOCK_SIZE // n_lists)
+    for start in range(0, n, block_rows):
+        codes[start:start + block_rows] = vq(
+            projections[start:start + block_rows], centroids,
+            check_finite=False)[0]
+    order = np.argsort(codes, kind='mergesort')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(
+        codes, minlength=n_lists))])
+    matrix, index = encode_fingerprints(fingerprints)
+    matrix = matrix[order]
+    index['feature_ids'] = [index['feature_ids'][i] for i in order]
+    return FingerprintSearchIndex(matrix, index, metric, axes, centroids,
+                                  offsets)
+
+
+def query_fingerprint_index(index: FingerprintSearchIndex,
+                            fingerprints: pd.DataFrame,
+                            n_neighbors: int = 10,
+                            n_probe: int = 8,
+                            n_jobs: int = 1) -> pd.DataFrame:
+    '''
+    This function finds the indexed molecules closest to every query
+    fingerprint.
+
+    Parameters
+    ----------
+    index : FingerprintSearchIndex
+        search index built by build_fingerprint_index
+    fingerprints : pd.DataFrame
+        query fingerprints, as made by collate_fingerprints with the
+        metric and precision of the indexed ones
+    n_neighbors : int, default 10
+        number of neighbours returned per query
+    n_probe : int, default 8
+        number of lists of the index compared with every query
+    n_jobs : int, default 1
+        number of threads that search for the queries
+
+    Raises
+    ------
+    ValueError
+        If the query fingerprints do not have the columns of the indexed
+        ones
+
+    Returns
+    -------
+    pd.DataFrame
+        the comma-separated MD5 hashes of the neighbours of every query
+        and their distances, closest first; indexed by the MD5 hash of the
+        query fingerprints
+    '''
+    if [str(i) for i in fingerprints.columns] != index.index['columns']:
+        raise ValueError('The query fingerprints do not have the same '
+                         'columns as the indexed fingerprints.')
+    neighbors, distances = index.query(fingerprints, n_neighbors, n_probe,
+                                       n_jobs)
+    result = pd.DataFrame(
+        {'neighbors': [','.join(row) for row in neighbors],
+         'distances': [','.join('%r' % float(d) for d in row)
+                       for row in distances]},
+        index=pd.Index([str(i) for i in fingerprints.index], name='id'))
+    return result
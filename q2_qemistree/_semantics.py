@@ -7,10 +7,12 @@
 # ----------------------------------------------------------------------------
 
 import qiime2.plugin.model as model
-from qiime2.plugin import SemanticType
+from qiime2.plugin import SemanticType, ValidationError
 from q2_types.feature_data import FeatureData
 import os
+import json
 import warnings
+import numpy as np
 
 
 def validate_mgf(iterable):
@@ -78,6 +80,154 @@ TSVMoleculesFormat = model.SingleFileDirectoryFormat('TSVMoleculesFormat',
 Molecules = SemanticType('Molecules', variant_of=FeatureData.field['type'])
 
 
+class MolecularFingerprintMatrix(model.BinaryFileFormat):
+    def sniff(self):
+        try:
+            matrix = np.load(str(self), mmap_mode='r')
+        except (ValueError, OSError):
+            return False
+        return matrix.ndim == 2
+
+
+class MolecularFingerprintIndex(model.TextFileFormat):
+    def sniff(self):
+        with open(str(self)) as f:
+            try:
+                index = json.load(f)
+            except ValueError:
+                return False
+        return isinstance(index, dict) and {
+            'feature_ids', 'columns', 'encoding'}.issubset(index)
+
+
+class MolecularFingerprintDirFmt(model.DirectoryFormat):
+    matrix = model.File('fingerprints.npy', format=MolecularFingerprintMatrix)
+    index = model.File('index.json', format=MolecularFingerprintIndex)
+
+    def _validate_(self, level):
+        matrix = np.load(str(self.path / 'fingerprints.npy'), mmap_mode='r')
+        with open(str(self.path / 'index.json')) as f:
+            index = json.load(f)
+        if matrix.shape[0] != len(index['feature_ids']):
+            raise ValidationError(
+                'The fingerprint matrix has %d rows but the index lists %d '
+                'features.' % (matrix.shape[0], len(index['feature_ids'])))
+
+
+MolecularFingerprint = SemanticType('MolecularFingerprint',
+                                    variant_of=FeatureData.field['type'])
+
+
+class InvertedListsFormat(model.BinaryFileFormat):
+    def sniff(self):
+        try:
+            with np.load(str(self)) as lists:
+                return {'axes', 'centroids', 'offsets'}.issubset(lists.files)
+        except (ValueError, OSError, AttributeError):
+            return False
+
+
+class FingerprintIndexDirFmt(model.DirectoryFormat):
+    matrix = model.File('fingerprints.npy', format=MolecularFingerprintMatrix)
+    index = model.File('index.json', format=MolecularFingerprintIndex)
+    lists = model.File('inverted_lists.npz', format=InvertedListsFormat)
+
+    def _validate_(self, level):
+        matrix = np.load(str(self.path / 'fingerprints.npy'), mmap_mode='r')
+        with np.load(str(self.path / 'inverted_lists.npz')) as lists:
+            offsets = lists['offsets']
+        if offsets[-1] != matrix.shape[0]:
+            raise ValidationError(
+                'The inverted lists hold %d fingerprints but the matrix '
+                'has %d rows.' % (offsets[-1], matrix.shape[0]))
+
+
+FingerprintIndex = SemanticType('FingerprintIndex')
+
+
+def validate_neighbors(iterable):
+    '''Checks a table of nearest neighbours made by query-fingerprint-index:
+    a header `id`, `neighbors`, `distances`, and for every query as many
+    comma-separated distances as neighbours, closest first'''
+    lines = iter(iterable)
+    header = next(lines, '').rstrip('\r\n').split('\t')
+    if header != ['id', 'neighbors', 'distances']:
+        raise ValueError('The neighbour table must have the columns `id`, '
+                         '`neighbors` and `distances`.')
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        fields = line.split('\t')
+        if len(fields) != 3:
+            raise ValueError('Query "%s" does not have 3 fields.'
+                             % fields[0])
+        query, neighbors, distances = fields
+        neighbors, distances = neighbors.split(','), distances.split(',')
+        if len(neighbors) != len(distances):
+            raise ValueError('Query "%s" has %d neighbours but %d '
+                             'distances.' % (query, len(neighbors),
+                                             len(distances)))
+        try:
+            distances = [float(d) for d in distances]
+        except ValueError:
+            raise ValueError('Query "%s" has distances that are not '
+                             'numbers.' % query)
+        if distances != sorted(distances):
+            raise ValueError('The neighbours of query "%s" are not sorted '
+                             'by distance.' % query)
+    return True
+
+
+class FingerprintNeighborsFormat(model.TextFileFormat):
+    def sniff(self):
+        with open(str(self)) as f:
+            return validate_neighbors(f)
+
+
+FingerprintNeighborsDirFmt = model.SingleFileDirectoryFormat(
+    'FingerprintNeighborsDirFmt', 'neighbors.tsv',
+    FingerprintNeighborsFormat)
+FingerprintNeighbors = SemanticType('FingerprintNeighbors',
+                                    variant_of=FeatureData.field['type'])
+
+
+class CondensedDistancesFormat(model.BinaryFileFormat):
+    def sniff(self):
+        try:
+            distances = np.load(str(self), mmap_mode='r')
+        except (ValueError, OSError):
+            return False
+        return distances.ndim == 1
+
+
+class CondensedDistanceIndex(model.TextFileFormat):
+    def sniff(self):
+        with open(str(self)) as f:
+            try:
+                index = json.load(f)
+            except ValueError:
+                return False
+        return isinstance(index, dict) and {'ids', 'metric'}.issubset(index)
+
+
+class CondensedDistanceMatrixDirFmt(model.DirectoryFormat):
+    distances = model.File('distances.npy', format=CondensedDistancesFormat)
+    index = model.File('index.json', format=CondensedDistanceIndex)
+
+    def _validate_(self, level):
+        distances = np.load(str(self.path / 'distances.npy'), mmap_mode='r')
+        with open(str(self.path / 'index.json')) as f:
+            n = len(json.load(f)['ids'])
+        if distances.shape[0] != n * (n - 1) // 2:
+            raise ValidationError(
+                'The condensed distances have %d entries but the %d ids '
+                'need %d.' % (distances.shape[0], n, n * (n - 1) // 2))
+
+
+CondensedDistanceMatrix = SemanticType('CondensedDistanceMatrix')
+
+
 class OutputDirs(model.DirectoryFormat):
 
     def get_folder_name(self):
@@ -1,7 +1,18 @@
 from .plugin_setup import plugin
-from ._semantics import TSVMolecules
+from ._semantics import (TSVMolecules, MolecularFingerprintDirFmt,
+                         FingerprintIndexDirFmt,
+                         CondensedDistanceMatrixDirFmt,
+                         FingerprintNeighborsFormat)
+from ._process_fingerprint import encode_fingerprints, decode_fingerprints
+from ._search import FingerprintSearchIndex
+from ._distances import CondensedDistances
+import json
+import numpy as np
 import pandas as pd
 import qiime2
+import skbio
+from q2_types.distance_matrix import LSMatFormat
+from scipy.spatial.distance import squareform
 
 
 def _read_dataframe(fh):
@@ -46,3 +57,129 @@ def _2(ff: TSVMolecules) -> pd.DataFrame:
 @plugin.register_transformer
 def _3(ff: TSVMolecules) -> qiime2.Metadata:
     return qiime2.Metadata(_tsvmolecules_to_df(ff))
+
+
+# define a transformer from pd.DataFrame -> MolecularFingerprintDirFmt
+@plugin.register_transformer
+def _4(data: pd.DataFrame) -> MolecularFingerprintDirFmt:
+    ff = MolecularFingerprintDirFmt()
+    matrix, index = encode_fingerprints(data)
+    np.save(str(ff.path / 'fingerprints.npy'), matrix)
+    with open(str(ff.path / 'index.json'), 'w') as fh:
+        json.dump(index, fh)
+    return ff
+
+
+# define a transformer from MolecularFingerprintDirFmt -> pd.DataFrame
+@plugin.register_transformer
+def _5(ff: MolecularFingerprintDirFmt) -> pd.DataFrame:
+    with open(str(ff.path / 'index.json')) as fh:
+        index = json.load(fh)
+    return decode_fingerprints(np.load(str(ff.path / 'fingerprints.npy')),
+                               index)
+
+
+# define a transformer from FingerprintSearchIndex -> FingerprintIndexDirFmt
+@plugin.register_transformer
+def _6(data: FingerprintSearchIndex) -> FingerprintIndexDirFmt:
+    ff = FingerprintIndexDirFmt()
+    np.save(str(ff.path / 'fingerprints.npy'), data.matrix)
+    with open(str(ff.path / 'index.json'), 'w') as fh:
+        json.dump(dict(data.index, metric=data.metric), fh)
+    np.savez(str(ff.path / 'inverted_lists.npz'), axes=data.axes,
+             centroids=data.centroids, offsets=data.offsets)
+    return ff
+
+
+# define a transformer from FingerprintIndexDirFmt -> FingerprintSearchIndex;
+# the fingerprints are memory-mapped, so that large indexes load at once
+@plugin.register_transformer
+def _7(ff: FingerprintIndexDirFmt) -> FingerprintSearchIndex:
+    with open(str(ff.path / 'index.json')) as fh:
+        index = json.load(fh)
+    metric = index.pop('metric')
+    with np.load(str(ff.path / 'inverted_lists.npz')) as lists:
+        axes, centroids = lists['axes'], lists['centroids']
+        offsets = lists['offsets']
+    return FingerprintSearchIndex(
+        np.load(str(ff.path / 'fingerprints.npy'), mmap_mode='r'), index,
+        metric, axes, centroids, offsets)
+
+
+# define a transformer from CondensedDistances -> CondensedDistanceMatrixDirFmt,
+# the compact form of the distances that is memory-mapped when read
+@plugin.register_transformer
+def _8(data: CondensedDistances) -> CondensedDistanceMatrixDirFmt:
+    ff = CondensedDistanceMatrixDirFmt()
+    np.save(str(ff.path / 'distances.npy'), np.asarray(data.values))
+    with open(str(ff.path / 'index.json'), 'w') as fh:
+        json.dump({'ids': data.ids, 'metric': data.metric}, fh)
+    return ff
+
+
+# define a transformer from CondensedDistanceMatrixDirFmt ->
+# CondensedDistances; the distances are memory-mapped and never squared
+@plugin.register_transformer
+def _9(ff: CondensedDistanceMatrixDirFmt) -> CondensedDistances:
+    with open(str(ff.path / 'index.json')) as fh:
+        index = json.load(fh)
+    return CondensedDistances(
+        np.load(str(ff.path / 'distances.npy'), mmap_mode='r'),
+        index['ids'], index['metric'])
+
+
+# define a transformer from CondensedDistanceMatrixDirFmt ->
+# skbio.DistanceMatrix, for ordination and beta-diversity analyses
+@plugin.register_transformer
+def _10(ff: CondensedDistanceMatrixDirFmt) -> skbio.DistanceMatrix:
+    data = _9(ff)
+    return skbio.DistanceMatrix(squareform(data.values, checks=False),
+                                ids=data.ids)
+
+
+# define a transformer from CondensedDistances -> LSMatFormat, so that the
+# distances are a DistanceMatrix for q2-diversity; rows are written one at a
+# time and the square matrix is never held
+@plugin.register_transformer
+def _11(data: CondensedDistances) -> LSMatFormat:
+    ff = LSMatFormat()
+    with ff.open() as fh:
+        data.write_lsmat(fh)
+    return ff
+
+
+# define a transformer from LSMatFormat -> CondensedDistances, keeping only
+# the upper triangle of every row
+@plugin.register_transformer
+def _12(ff: LSMatFormat) -> CondensedDistances:
+    with ff.open() as fh:
+        return CondensedDistances.read_lsmat(fh)
+
+
+def _neighbors_to_df(ff):
+    with ff.open() as fh:
+        df = pd.read_csv(fh, sep='\t', header=0, dtype='str', index_col='id')
+    return df
+
+
+# define a transformer from pd.DataFrame -> FingerprintNeighborsFormat
+@plugin.register_transformer
+def _13(data: pd.DataFrame) -> FingerprintNeighborsFormat:
+    ff = FingerprintNeighborsFormat()
+    with ff.open() as fh:
+        data[['neighbors', 'distances']].to_csv(fh, sep='\t', header=True,
+                                                index_label='id')
+    return ff
+
+
+# define a transformer from FingerprintNeighborsFormat -> pd.DataFrame
+@plugin.register_transformer
+def _14(ff: FingerprintNeighborsFormat) -> pd.DataFrame:
+    return _neighbors_to_df(ff)
+
+
+# define a transformer from FingerprintNeighborsFormat -> qiime2.Metadata,
+# to tabulate the neighbours of every query
+@plugin.register_transformer
+def _15(ff: FingerprintNeighborsFormat) -> qiime2.Metadata:
+    return qiime2.Metadata(_neighbors_to_df(ff))
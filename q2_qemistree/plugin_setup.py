@@ -10,19 +10,28 @@ import importlib
 from ._fingerprint import (compute_fragmentation_trees,
                            rerank_molecular_formulas,
                            predict_fingerprints)
-from ._hierarchy import make_hierarchy
+from ._hierarchy import (make_hierarchy, collate_fingerprints,
+                         fingerprint_distances)
+from ._add_to_hierarchy import add_to_hierarchy
+from ._search import build_fingerprint_index, query_fingerprint_index
 from ._prune_hierarchy import prune_hierarchy
-from ._classyfire import get_classyfire_taxonomy
+from ._classyfire import get_classyfire_taxonomy, get_canopus_taxonomy
 from ._semantics import (MassSpectrometryFeatures, MGFDirFmt,
                          SiriusFolder, SiriusDirFmt,
                          ZodiacFolder, ZodiacDirFmt,
                          CSIFolder, CSIDirFmt,
-                         FeatureData, TSVMoleculesFormat, Molecules)
+                         FeatureData, TSVMoleculesFormat, Molecules,
+                         MolecularFingerprintDirFmt, MolecularFingerprint,
+                         FingerprintIndexDirFmt, FingerprintIndex,
+                         FingerprintNeighbors, FingerprintNeighborsDirFmt,
+                         FingerprintNeighborsFormat, CondensedDistanceMatrix,
+                         CondensedDistanceMatrixDirFmt)
 
 from qiime2.plugin import (Plugin, Str, Range, Choices, Float, Int, Bool, List,
                            Citations)
 from q2_types.feature_table import FeatureTable, Frequency
 from q2_types.tree import Phylogeny, Rooted
+from q2_types.distance_matrix import DistanceMatrix
 
 
 citations = Citations.load('citations.bib', package='q2_qemistree')
@@ -63,6 +72,30 @@ plugin.register_semantic_types(Molecules)
 plugin.register_semantic_type_to_format(FeatureData[Molecules],
                                         artifact_format=TSVMoleculesFormat)
 
+plugin.register_views(MolecularFingerprintDirFmt)
+plugin.register_semantic_types(MolecularFingerprint)
+plugin.register_semantic_type_to_format(
+    FeatureData[MolecularFingerprint],
+    artifact_format=MolecularFingerprintDirFmt)
+
+plugin.register_views(FingerprintIndexDirFmt)
+plugin.register_semantic_types(FingerprintIndex)
+plugin.register_semantic_type_to_format(FingerprintIndex,
+                                        artifact_format=FingerprintIndexDirFmt)
+
+# compact, memory-mapped form of fingerprint distances, e.g. to keep them
+# between runs; actions exchange them as a DistanceMatrix
+plugin.register_views(CondensedDistanceMatrixDirFmt)
+plugin.register_semantic_types(CondensedDistanceMatrix)
+plugin.register_semantic_type_to_format(
+    CondensedDistanceMatrix, artifact_format=CondensedDistanceMatrixDirFmt)
+
+plugin.register_views(FingerprintNeighborsFormat, FingerprintNeighborsDirFmt)
+plugin.register_semantic_types(FingerprintNeighbors)
+plugin.register_semantic_type_to_format(
+    FeatureData[FingerprintNeighbors],
+    artifact_format=FingerprintNeighborsDirFmt)
+
 PARAMS = {
     'ions_considered': List[Str],
     'database': List[Str],
@@ -177,8 +210,21 @@ plugin.methods.register_function(
     description='Build a phylogeny based on molecular substructures',
     inputs={'csi_results': List[CSIFolder],
             'feature_tables': List[FeatureTable[Frequency]],
-            'library_matches': List[FeatureData[Molecules]]},
-    parameters={'metric': Str % Choices(['euclidean', 'jaccard'])},
+            'library_matches': List[FeatureData[Molecules]],
+            'distance_matrix': DistanceMatrix},
+    parameters={'metric': Str % Choices(['euclidean', 'jaccard']),
+                'cache_dir': Str,
+                'distance_dtype': Str % Choices(['float32', 'float64']),
+                'distance_dir': Str,
+                'n_jobs': Int % Range(1, None),
+                'clustering': Str % Choices(['upgma', 'single-mst',
+                                             'knn-upgma']),
+                'n_neighbors': Int % Range(1, None),
+                'n_workers': Int % Range(1, None),
+                'precision': Str % Choices(['float64', 'float32', 'uint8']),
+                'min_column_variance': Float % Range(0, None),
+                'collapse_distance': Float % Range(0, None),
+                'verbose': Bool},
     input_descriptions={'csi_results': 'one or more CSI:FingerID '
                                        'output folders',
                         'feature_tables': 'one or more feature tables with '
@@ -186,12 +232,109 @@ plugin.methods.register_function(
                                           'per sample',
                         'library_matches': 'one or more tables with MS/MS '
                                            'library match for mass-spec '
-                                           'features'},
+                                           'features',
+                        'distance_matrix': 'pairwise fingerprint distances '
+                                           'computed by '
+                                           'fingerprint-distances from the '
+                                           'same inputs and metric. They '
+                                           'are clustered with `upgma` '
+                                           'instead of being computed '
+                                           'again.'},
     parameter_descriptions={'metric': 'metric for hierarchical clustering of '
                                       'fingerprints. If the Jaccard metric is '
                                       'selected, molecular fingerprints are '
                                       'first binarized (probabilities above '
-                                      '0.5 are True, and False otherwise).'},
+                                      '0.5 are True, and False otherwise).',
+                            'cache_dir': 'directory used to cache collated '
+                                         'fingerprints between runs. Repeated '
+                                         'runs over unchanged CSI:FingerID '
+                                         'results load the cached matrix '
+                                         'instead of re-parsing every '
+                                         'fingerprint file.',
+                            'distance_dtype': 'precision of the pairwise '
+                                              'fingerprint distances. With '
+                                              '`distance_dir`, float32 '
+                                              'halves the file at the cost '
+                                              'of rounding merged '
+                                              'distances. Without it, '
+                                              'distances are clustered as '
+                                              'a float64 copy, so float32 '
+                                              'uses more memory, not less.',
+                            'distance_dir': 'directory for a temporary '
+                                            'memory-mapped file that holds '
+                                            'the pairwise fingerprint '
+                                            'distances; `upgma` clusters '
+                                            'them from the file one row at '
+                                            'a time. Use this for '
+                                            'datasets whose distances do '
+                                            'not fit in memory.',
+                            'n_jobs': 'Number of threads used to read '
+                                      'fingerprint files and to compute '
+                                      'pairwise fingerprint distances.',
+                            'clustering': 'clustering engine. `upgma` is '
+                                          'exact average linkage and needs '
+                                          'all pairwise distances. '
+                                          '`single-mst` builds a single '
+                                          'linkage tree from a minimum '
+                                          'spanning tree and `knn-upgma` '
+                                          'approximates average linkage on '
+                                          'a nearest neighbour graph; both '
+                                          'compute distances on the fly and '
+                                          'scale to much larger datasets.',
+                            'n_neighbors': 'number of nearest neighbours '
+                                           'per fingerprint used by the '
+                                           '`knn-upgma` clustering engine.',
+                            'n_workers': 'Number of processes used to '
+                                         'collate fingerprints and match '
+                                         'feature tables of the input '
+                                         'datasets in parallel. Results are '
+                                         'gathered in input order, so the '
+                                         'outputs do not depend on it.',
+                            'precision': 'precision of the fingerprint '
+                                         'probabilities: float64, float32 '
+                                         'or uint8 (quantized to 256 '
+                                         'levels), which cut memory use 2 '
+                                         'and 8 times. Features are '
+                                         'labeled by the MD5 hash of their '
+                                         'fingerprint in this precision, so '
+                                         'outputs of different precisions '
+                                         'cannot be combined, and in uint8 '
+                                         'fingerprints that quantize to the '
+                                         'same levels share a label. '
+                                         'Ignored for the Jaccard metric.',
+                            'min_column_variance': 'drop fingerprint '
+                                                   'columns that do not '
+                                                   'inform the clustering '
+                                                   'before it. With 0, only '
+                                                   'columns that cannot '
+                                                   'change any distance are '
+                                                   'dropped (constant '
+                                                   'columns, or all-zero '
+                                                   'columns for Jaccard) and '
+                                                   'the tree is unchanged; '
+                                                   'a positive value also '
+                                                   'drops columns whose '
+                                                   'probability variance is '
+                                                   'below it. By default all '
+                                                   'columns are kept.',
+                            'collapse_distance': 'group fingerprints within '
+                                                 'this distance of one '
+                                                 'another and cluster one '
+                                                 'representative per group; '
+                                                 'the other members are '
+                                                 'attached to it with '
+                                                 'zero-length branches. The '
+                                                 'feature table and feature '
+                                                 'data are aggregated by '
+                                                 'group onto the '
+                                                 'representatives, whose '
+                                                 '`members` column lists the '
+                                                 'grouped features. By '
+                                                 'default no fingerprints '
+                                                 'are grouped.',
+                            'verbose': 'report how many fingerprint columns '
+                                       'were dropped and how many groups of '
+                                       'near-duplicates were formed.'},
     outputs=[('tree', Phylogeny[Rooted]),
              ('feature_table', FeatureTable[Frequency]),
              ('feature_data', FeatureData[Molecules])],
@@ -213,10 +356,81 @@ plugin.methods.register_function(
     name='Generate Classyfire annotations',
     description='Predicts chemical taxonomy based on molecule structures',
     inputs={'feature_data': FeatureData[Molecules]},
-    parameters={},
+    parameters={'n_jobs': Int % Range(1, None),
+                'max_rate': Float % Range(0, None, inclusive_start=False),
+                'cache_dir': Str,
+                'negative_ttl': Float % Range(0, None),
+                'max_cache_age': Float % Range(0, None),
+                'max_cache_entries': Int % Range(1, None),
+                'timeout': Float % Range(0, None, inclusive_start=False),
+                'max_retries': Int % Range(0, None),
+                'backoff': Float % Range(0, None),
+                'verbose': Bool},
     input_descriptions={'feature_data': 'Feature data table that maps MD5 '
                                         'hash of mass-spec features to their '
                                         'structural annotations (SMILES)'},
+    parameter_descriptions={'n_jobs': 'Number of structures looked up at '
+                                      'once, i.e. the largest number of '
+                                      'requests in flight. The results do '
+                                      'not depend on it.',
+                            'max_rate': 'largest number of requests per '
+                                        'second sent to each server. By '
+                                        'default requests are not '
+                                        'throttled.',
+                            'cache_dir': 'directory of a persistent cache of '
+                                         'InChIKey and ClassyFire lookups '
+                                         'shared between runs. Structures '
+                                         'found in it are not looked up '
+                                         'again.',
+                            'negative_ttl': 'days after which InChIKeys and '
+                                            'ClassyFire entities that were '
+                                            'not found are looked up again',
+                            'max_cache_age': 'days after which cached '
+                                             'lookups are evicted. By '
+                                             'default they are kept.',
+                            'max_cache_entries': 'largest number of cached '
+                                                 'lookups; the least '
+                                                 'recently used ones are '
+                                                 'evicted. Not limited by '
+                                                 'default.',
+                            'timeout': 'seconds to wait for a server to '
+                                       'accept a connection or to answer a '
+                                       'request',
+                            'max_retries': 'largest number of times a '
+                                           'request that timed out or got a '
+                                           'transient error (429, 502, 503 '
+                                           'or 504) is retried',
+                            'backoff': 'seconds to wait before the first '
+                                       'retry of a request; the wait '
+                                       'doubles with every retry',
+                            'verbose': 'report the number of lookups, '
+                                       'their deduplication, the requests '
+                                       'sent and the cache hits'},
+    outputs=[('classified_feature_data', FeatureData[Molecules])],
+    output_descriptions={'classified_feature_data': 'Feature data table that '
+                                                    'contains Classyfire '
+                                                    'annotations per mass-'
+                                                    'spec feature'},
+    citations=[citations['djoumbou2016classyfire']]
+)
+
+plugin.methods.register_function(
+    function=get_canopus_taxonomy,
+    name='Generate Classyfire annotations from CANOPUS predictions',
+    description='Fills the chemical taxonomy of features from the CANOPUS '
+                'predictions stored along CSI:FingerID results, without '
+                'querying the Classyfire servers',
+    inputs={'feature_data': FeatureData[Molecules],
+            'csi_results': List[CSIFolder]},
+    parameters={},
+    input_descriptions={'feature_data': 'Feature data table that maps MD5 '
+                                        'hash of mass-spec features to their '
+                                        'feature IDs and feature tables, as '
+                                        'made by make-hierarchy',
+                        'csi_results': 'one or more CSI:FingerID output '
+                                       'folders with CANOPUS predictions, in '
+                                       'the order their feature tables were '
+                                       'given to make-hierarchy'},
     parameter_descriptions={},
     outputs=[('classified_feature_data', FeatureData[Molecules])],
     output_descriptions={'classified_feature_data': 'Feature data table that '
@@ -226,6 +440,250 @@ plugin.methods.register_function(
     citations=[citations['djoumbou2016classyfire']]
 )
 
+plugin.methods.register_function(
+    function=collate_fingerprints,
+    name='Collate molecular fingerprints',
+    description='Collates the molecular fingerprints that make-hierarchy '
+                'clusters, labeled by the MD5 hash of their fingerprint '
+                'vector like the tips of its tree, and stores them in a '
+                'compact binary format so that later analyses do not have '
+                'to parse CSI:FingerID results again.',
+    inputs={'csi_results': List[CSIFolder],
+            'feature_tables': List[FeatureTable[Frequency]]},
+    parameters={'metric': Str % Choices(['euclidean', 'jaccard']),
+                'cache_dir': Str,
+                'n_jobs': Int % Range(1, None),
+                'n_workers': Int % Range(1, None),
+                'precision': Str % Choices(['float64', 'float32', 'uint8'])},
+    input_descriptions={'csi_results': 'one or more CSI:FingerID '
+                                       'output folders',
+                        'feature_tables': 'one or more feature tables with '
+                                          'mass-spec feature intensity '
+                                          'per sample'},
+    parameter_descriptions={'metric': 'metric the fingerprints are used '
+                                      'with. For the Jaccard metric, '
+                                      'fingerprints are binarized and '
+                                      'stored as packed bits; otherwise '
+                                      'probabilities are stored in their '
+                                      'precision.',
+                            'cache_dir': 'directory used to cache collated '
+                                         'fingerprints between runs',
+                            'n_jobs': 'Number of threads used to read '
+                                      'fingerprint files.',
+                            'n_workers': 'Number of processes used to '
+                                         'process the datasets in '
+                                         'parallel.',
+                            'precision': 'precision of the fingerprint '
+                                         'probabilities (see '
+                                         'make-hierarchy); labels match '
+                                         'those of make-hierarchy run with '
+                                         'the same precision.'},
+    outputs=[('fingerprints', FeatureData[MolecularFingerprint])],
+    output_descriptions={'fingerprints': 'molecular fingerprints of the '
+                                         'features in the feature tables, '
+                                         'indexed by the MD5 hash of '
+                                         'fingerprint vectors'}
+)
+
+plugin.methods.register_function(
+    function=fingerprint_distances,
+    name='Compute fingerprint distances',
+    description='Computes the pairwise distances between molecular '
+                'fingerprints. The distance matrix can be used for '
+                'ordination and beta-diversity analyses, and passed to '
+                'make-hierarchy so that it is computed only once.',
+    inputs={'fingerprints': FeatureData[MolecularFingerprint]},
+    parameters={'metric': Str % Choices(['euclidean', 'jaccard']),
+                'distance_dtype': Str % Choices(['float32', 'float64']),
+                'n_jobs': Int % Range(1, None)},
+    input_descriptions={'fingerprints': 'molecular fingerprints made by '
+                                        'collate-fingerprints'},
+    parameter_descriptions={'metric': 'distance metric. The Jaccard metric '
+                                      'needs fingerprints collated with '
+                                      'the `jaccard` metric.',
+                            'distance_dtype': 'precision of the distances. '
+                                              'float32 halves the memory '
+                                              'used; use float64 to build '
+                                              'the same tree as '
+                                              'make-hierarchy does from '
+                                              'CSI:FingerID results.',
+                            'n_jobs': 'Number of threads used to compute '
+                                      'pairwise fingerprint distances.'},
+    outputs=[('distance_matrix', DistanceMatrix)],
+    output_descriptions={'distance_matrix': 'pairwise distances between '
+                                            'fingerprints, indexed by the '
+                                            'MD5 hash of fingerprint '
+                                            'vectors, for q2-diversity '
+                                            'and make-hierarchy'}
+)
+
+plugin.methods.register_function(
+    function=add_to_hierarchy,
+    name='Add datasets to a molecular tree',
+    description='Adds new datasets to a tree built by make-hierarchy. Only '
+                'the new CSI:FingerID results are processed; new molecules '
+                'are placed next to their closest molecule in the tree, '
+                'unless there are so many that the tree is rebuilt.',
+    inputs={'tree': Phylogeny[Rooted],
+            'feature_table': FeatureTable[Frequency],
+            'feature_data': FeatureData[Molecules],
+            'csi_results': List[CSIFolder],
+            'feature_tables': List[FeatureTable[Frequency]],
+            'reference_csi_results': List[CSIFolder],
+            'reference_fingerprints': FeatureData[MolecularFingerprint],
+            'library_matches': List[FeatureData[Molecules]]},
+    parameters={'metric': Str % Choices(['euclidean', 'jaccard']),
+                'cache_dir': Str,
+                'max_drift': Float % Range(0, None),
+                'distance_dtype': Str % Choices(['float32', 'float64']),
+                'distance_dir': Str,
+                'n_jobs': Int % Range(1, None),
+                'clustering': Str % Choices(['upgma', 'single-mst',
+                                             'knn-upgma']),
+                'n_neighbors': Int % Range(1, None),
+                'n_workers': Int % Range(1, None),
+                'precision': Str % Choices(['float64', 'float32', 'uint8'])},
+    input_descriptions={'tree': 'Tree of relatedness of molecules built by '
+                                'make-hierarchy.',
+                        'feature_table': 'feature table built by '
+                                         'make-hierarchy',
+                        'feature_data': 'feature data built by '
+                                        'make-hierarchy',
+                        'reference_csi_results': 'the CSI:FingerID output '
+                                                 'folders the tree was built '
+                                                 'from; used to look up the '
+                                                 'fingerprints of its tips',
+                        'reference_fingerprints': 'fingerprints of the tips '
+                                                  'of the tree, made by '
+                                                  'collate-fingerprints; '
+                                                  'used instead of the '
+                                                  'reference CSI:FingerID '
+                                                  'results',
+                        'csi_results': 'one or more new CSI:FingerID '
+                                       'output folders',
+                        'feature_tables': 'one or more new feature tables '
+                                          'with mass-spec feature intensity '
+                                          'per sample',
+                        'library_matches': 'one or more tables with MS/MS '
+                                           'library match for the new '
+                                           'mass-spec features'},
+    parameter_descriptions={'metric': 'metric the tree was built with',
+                            'cache_dir': 'directory used to cache collated '
+                                         'fingerprints between runs. When '
+                                         'it was also used to build the '
+                                         'tree, the reference fingerprints '
+                                         'are not parsed again.',
+                            'max_drift': 'largest number of new molecules, '
+                                         'as a fraction of the tips of the '
+                                         'tree, that are placed into the '
+                                         'tree. If there are more, the tree '
+                                         'is rebuilt from all fingerprints.',
+                            'distance_dtype': 'precision of the pairwise '
+                                              'fingerprint distances when '
+                                              'the tree is rebuilt; float32 '
+                                              'only saves space with '
+                                              '`distance_dir`',
+                            'distance_dir': 'directory for a temporary '
+                                            'memory-mapped file that holds '
+                                            'the pairwise fingerprint '
+                                            'distances when the tree is '
+                                            'rebuilt, and from which '
+                                            '`upgma` clusters them',
+                            'n_jobs': 'Number of threads used to read '
+                                      'fingerprint files and to compute '
+                                      'fingerprint distances.',
+                            'clustering': 'clustering engine used when the '
+                                          'tree is rebuilt (see '
+                                          'make-hierarchy)',
+                            'n_neighbors': 'number of nearest neighbours '
+                                           'per fingerprint used by the '
+                                           '`knn-upgma` clustering engine '
+                                           'when the tree is rebuilt',
+                            'n_workers': 'Number of processes used to '
+                                         'process the new datasets in '
+                                         'parallel.',
+                            'precision': 'precision of the fingerprint '
+                                         'probabilities the tree was built '
+                                         'with.'},
+    outputs=[('tree', Phylogeny[Rooted]),
+             ('feature_table', FeatureTable[Frequency]),
+             ('feature_data', FeatureData[Molecules])],
+    output_descriptions={'tree': 'Tree of relatedness between the previous '
+                                 'and new mass spectrometry features',
+                         'feature_table': 'merged feature table that '
+                                          'contains only the features '
+                                          'present in the tree',
+                         'feature_data': 'merged mapping of unique feature '
+                                         'identifiers in all feature tables '
+                                         'to MD5 hash of feature '
+                                         'fingerprints'}
+)
+
+plugin.methods.register_function(
+    function=build_fingerprint_index,
+    name='Build a fingerprint search index',
+    description='Builds an index over molecular fingerprints that finds '
+                'the molecules closest to new features without computing '
+                'their distances to all molecules. Fingerprints are '
+                'grouped into lists around k-means centroids of their '
+                'leading principal components, and queries are compared '
+                'with the fingerprints of the closest lists only.',
+    inputs={'fingerprints': FeatureData[MolecularFingerprint]},
+    parameters={'metric': Str % Choices(['euclidean', 'jaccard']),
+                'n_lists': Int % Range(1, None),
+                'n_components': Int % Range(1, None),
+                'seed': Int},
+    input_descriptions={'fingerprints': 'molecular fingerprints made by '
+                                        'collate-fingerprints'},
+    parameter_descriptions={'metric': 'metric used to compare '
+                                      'fingerprints. The Jaccard metric '
+                                      'needs fingerprints collated with '
+                                      'the `jaccard` metric.',
+                            'n_lists': 'number of lists fingerprints are '
+                                       'grouped into. By default the square '
+                                       'root of the number of fingerprints.',
+                            'n_components': 'number of principal components '
+                                            'fingerprints are grouped by',
+                            'seed': 'seed of the k-means clustering that '
+                                    'groups fingerprints'},
+    outputs=[('index', FingerprintIndex)],
+    output_descriptions={'index': 'search index over the fingerprints, '
+                                  'labeled by the MD5 hash of fingerprint '
+                                  'vectors'}
+)
+
+plugin.methods.register_function(
+    function=query_fingerprint_index,
+    name='Find the closest molecules in a fingerprint index',
+    description='Finds the indexed molecules closest to every query '
+                'fingerprint, e.g. the molecules of a tree closest to new '
+                'features. The search is approximate: neighbours in lists '
+                'that are not probed are missed.',
+    inputs={'index': FingerprintIndex,
+            'fingerprints': FeatureData[MolecularFingerprint]},
+    parameters={'n_neighbors': Int % Range(1, None),
+                'n_probe': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None)},
+    input_descriptions={'index': 'search index made by '
+                                 'build-fingerprint-index',
+                        'fingerprints': 'query fingerprints made by '
+                                        'collate-fingerprints with the '
+                                        'metric and precision of the '
+                                        'indexed ones'},
+    parameter_descriptions={'n_neighbors': 'number of neighbours returned '
+                                           'per query',
+                            'n_probe': 'number of lists compared with every '
+                                       'query. More lists make the search '
+                                       'more accurate and slower.',
+                            'n_jobs': 'Number of threads that search for '
+                                      'the queries.'},
+    outputs=[('neighbors', FeatureData[FingerprintNeighbors])],
+    output_descriptions={'neighbors': 'comma-separated MD5 hashes of the '
+                                      'closest indexed molecules of every '
+                                      'query and their distances, closest '
+                                      'first'}
+)
+
 plugin.methods.register_function(
     function=prune_hierarchy,
     name='Prune hierarchy of molecules',
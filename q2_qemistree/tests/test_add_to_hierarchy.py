@@ -0,0 +1,120 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+import os
+import qiime2
+import numpy as np
+import pandas as pd
+from biom import load_table
+from skbio import TreeNode
+from scipy.spatial.distance import pdist
+from scipy.cluster.hierarchy import linkage
+
+from q2_qemistree import make_hierarchy, add_to_hierarchy
+from q2_qemistree import CSIDirFmt
+from q2_qemistree._add_to_hierarchy import place_fingerprints
+from q2_qemistree._hierarchy import collate_fingerprints
+from q2_qemistree._process_fingerprint import (encode_fingerprints,
+                                               decode_fingerprints)
+from q2_qemistree._linkage import LinkageTree
+
+
+class TestAddToHierarchy(TestCase):
+    def setUp(self):
+        THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.features = load_table(os.path.join(
+            THIS_DIR, 'data/features_formated.biom'))
+        self.features2 = load_table(os.path.join(
+            THIS_DIR, 'data/features2_formated.biom'))
+        self.goodcsi = qiime2.Artifact.load(os.path.join(
+            THIS_DIR, 'data/csiFolder.qza')).view(CSIDirFmt)
+        self.goodcsi2 = qiime2.Artifact.load(os.path.join(
+            THIS_DIR, 'data/csiFolder2.qza')).view(CSIDirFmt)
+        newick, self.table, self.fdata = make_hierarchy([self.goodcsi],
+                                                        [self.features])
+        self.tree = TreeNode.read(str(newick))
+
+    def assertUltrametric(self, tree):
+        depths = [tip.accumulate_to_ancestor(tree) for tip in tree.tips()]
+        np.testing.assert_allclose(depths, depths[0])
+
+    def test_addPlaced(self):
+        tree, table, fdata = add_to_hierarchy(
+            self.tree, self.table, self.fdata, [self.goodcsi2],
+            [self.features2], reference_csi_results=[self.goodcsi],
+            max_drift=10)
+        _, exp_table, exp_fdata = make_hierarchy(
+            [self.goodcsi, self.goodcsi2], [self.features, self.features2])
+        self.assertEqual(sorted(tip.name for tip in tree.tips()),
+                         sorted(exp_table.ids(axis='observation')))
+        self.assertEqual(table, exp_table.sort_order(
+            table.ids(axis='observation'), axis='observation'))
+        pd.testing.assert_frame_equal(fdata.sort_index(),
+                                      exp_fdata.sort_index(),
+                                      check_names=False)
+        self.assertUltrametric(tree)
+
+    def test_addRebuilt(self):
+        tree, table, fdata = add_to_hierarchy(
+            self.tree, self.table, self.fdata, [self.goodcsi2],
+            [self.features2], reference_csi_results=[self.goodcsi],
+            max_drift=0)
+        newick, _, _ = make_hierarchy([self.goodcsi, self.goodcsi2],
+                                      [self.features, self.features2])
+        exp = TreeNode.read(str(newick))
+        self.assertEqual(tree.compare_rfd(exp), 0)
+
+    def test_missingReference(self):
+        msg = "tips of the tree were not found in the reference"
+        with self.assertRaisesRegex(ValueError, msg):
+            add_to_hierarchy(self.tree, self.table, self.fdata,
+                             [self.goodcsi2], [self.features2],
+                             reference_csi_results=[self.goodcsi2])
+
+    def test_noReference(self):
+        msg = "please provide the reference"
+        with self.assertRaisesRegex(ValueError, msg):
+            add_to_hierarchy(self.tree, self.table, self.fdata,
+                             [self.goodcsi2], [self.features2])
+
+    def test_addStoredFingerprints(self):
+        reference = decode_fingerprints(*encode_fingerprints(
+            collate_fingerprints([self.goodcsi], [self.features])))
+        obs = add_to_hierarchy(
+            self.tree.copy(), self.table, self.fdata, [self.goodcsi2],
+            [self.features2], reference_fingerprints=reference,
+            max_drift=10)
+        exp = add_to_hierarchy(
+            self.tree.copy(), self.table, self.fdata, [self.goodcsi2],
+            [self.features2], reference_csi_results=[self.goodcsi],
+            max_drift=10)
+        self.assertEqual(obs[0].compare_rfd(exp[0]), 0)
+        self.assertEqual(obs[1], exp[1])
+
+    def test_placeFingerprints(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(30, 20),
+                           index=['f%d' % i for i in range(30)])
+        reference, new = fps.iloc[:20], fps.iloc[20:]
+        tree = LinkageTree(linkage(pdist(reference.values), 'average'),
+                           list(reference.index)).to_treenode()
+        tree = place_fingerprints(tree, reference, new)
+        self.assertEqual(sorted(tip.name for tip in tree.tips()),
+                         sorted(fps.index))
+        self.assertUltrametric(tree)
+        # the first new fingerprint joins the lineage of its closest
+        # reference at half their distance
+        dists = np.linalg.norm(reference.values - new.values[0], axis=1)
+        placed = tree.find('f20')
+        self.assertAlmostEqual(placed.length, dists.min() / 2)
+        self.assertIn(reference.index[dists.argmin()],
+                      {tip.name for tip in placed.parent.tips()})
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,22 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from unittest import TestCase, main
+from unittest import TestCase, main, mock
+import io
+import os
+import json
+import contextlib
+import time
+import socket
+import tempfile
+import threading
+import urllib
+import warnings
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import pandas as pd
-from q2_qemistree import get_classyfire_taxonomy
+from q2_qemistree import get_classyfire_taxonomy, get_canopus_taxonomy
+from q2_qemistree import _classyfire
+from q2_qemistree._lookup_cache import LookupCache
 
 
 class TestClassyfire(TestCase):
@@ -58,5 +71,409 @@ class TestClassyfire(TestCase):
         self.assertTrue((self.levels.issubset(set(classified.columns))))
 
 
+# InChIKeys and ClassyFire responses served by the stand-in server
+INCHIKEYS = {'CCO': 'KEY-A', 'OCC': 'KEY-A', 'c1ccccc1': 'KEY-B',
+             'CC(=O)O': 'KEY-C', 'CN': 'KEY-D', 'CCN': 'KEY-E'}
+ENTITIES = {'KEY-A': (200, {'kingdom': {'name': 'Organic compounds'},
+                            'superclass': {'name': 'Organic oxygen '
+                                                   'compounds'},
+                            'class': {'name': 'Organooxygen compounds'},
+                            'subclass': {'name': 'Alcohols and polyols'},
+                            'direct_parent': None}),
+            'KEY-B': (200, {}),
+            'KEY-C': (404, {}),
+            'KEY-D': (503, {}),
+            'KEY-E': (200, {'kingdom': {'name': 'Organic compounds'}})}
+# entities answered with 503 the first few times they are looked up
+FLAKY = {'KEY-E': 2}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''Answers InChIKey and ClassyFire lookups like the GNPS servers'''
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+            server.arrivals.append(time.monotonic())
+        time.sleep(server.delay)
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/inchikey':
+            smiles = urllib.parse.parse_qs(url.query)['smiles'][0]
+            status = 200 if smiles in INCHIKEYS else 500
+            body = INCHIKEYS.get(smiles, 'error')
+        else:
+            entity = url.path.split('/')[-1][:-len('.json')]
+            status, body = ENTITIES[entity]
+            with server.lock:
+                server.failures[entity] = server.failures.get(entity, 0) + 1
+                if server.failures[entity] <= FLAKY.get(entity, 0):
+                    status = 503
+            body = json.dumps(body)
+        with server.lock:
+            server.in_flight -= 1
+        try:
+            self.send_response(status)
+            self.end_headers()
+            self.wfile.write(body.encode())
+        except (BrokenPipeError, ConnectionResetError):
+            # the client timed out
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConcurrentClassyfire(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        root = 'http://127.0.0.1:%d' % cls.server.server_port
+        cls.patches = [mock.patch.object(_classyfire, '_INCHIKEY_URL',
+                                         root + '/inchikey?smiles='),
+                       mock.patch.object(_classyfire, '_CLASSYFIRE_URL',
+                                         root + '/entities/')]
+        for patch in cls.patches:
+            patch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in cls.patches:
+            patch.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.delay = 0
+        self.server.in_flight = self.server.max_in_flight = 0
+        self.server.arrivals = []
+        self.server.failures = {}
+        self.feature_data = pd.DataFrame(
+            index=['a', 'b', 'c', 'd', 'e', 'f'],
+            data=[['missing', 'CCO'], ['c1ccccc1', 'missing'],
+                  ['CC(=O)O', 'missing'], ['missing', 'CN'],
+                  ['foo', 'missing'], ['missing', 'missing']],
+            columns=['csi_smiles', 'ms2_smiles'])
+
+    def classify(self, **kwargs):
+        kwargs.setdefault('max_retries', 0)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            classified = get_classyfire_taxonomy(self.feature_data.copy(),
+                                                 **kwargs)
+        return classified, [str(w.message) for w in caught
+                            if w.category is UserWarning]
+
+    def test_standIn(self):
+        classified, messages = self.classify()
+        self.assertEqual(list(classified.loc['a', _classyfire.
+                                             CLASSYFIRE_LEVELS]),
+                         ['Organic compounds', 'Organic oxygen compounds',
+                          'Organooxygen compounds', 'Alcohols and polyols',
+                          'unclassified'])
+        for idx in ['b', 'c', 'f']:
+            self.assertEqual(classified.loc[idx, 'kingdom'], 'unclassified')
+        self.assertEqual(classified.loc['d', 'kingdom'],
+                         'unexpected server response')
+        self.assertEqual(classified.loc['e', 'kingdom'], 'SMILE parse error')
+        self.assertEqual(len(messages), 2)
+        self.assertIn("('e', 'foo')", messages[0])
+        self.assertIn("('d', 'CN', 503)", messages[1])
+
+    def test_verbose(self):
+        for verbose in [False, True]:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.classify(verbose=verbose)
+            self.assertEqual('Looked up 5 unique structures' in
+                             out.getvalue(), verbose)
+            self.assertEqual('Sent' in out.getvalue(), verbose)
+
+    def test_concurrentMatchesSerial(self):
+        exp, exp_messages = self.classify()
+        obs, obs_messages = self.classify(n_jobs=4)
+        pd.testing.assert_frame_equal(obs, exp)
+        self.assertEqual(obs_messages, exp_messages)
+
+    def test_inFlightLimit(self):
+        self.server.delay = 0.05
+        self.classify(n_jobs=2)
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_rateLimit(self):
+        self.classify(n_jobs=4, max_rate=20)
+        arrivals = self.server.arrivals
+        self.assertEqual(len(arrivals), 9)
+        # requests leave 1 / 20 s apart; allow for jitter on arrival
+        self.assertGreater(arrivals[-1] - arrivals[0], 0.9 * 8 / 20)
+        self.assertGreater(min(b - a for a, b in zip(arrivals,
+                                                     arrivals[1:])), 0.5 / 20)
+
+    def test_deduplicated(self):
+        self.feature_data = pd.DataFrame(
+            index=['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+            data=[['missing', 'CCO'], ['CCO', 'missing'], ['OCC', 'missing'],
+                  ['CN', 'missing'], ['missing', 'CN'], ['foo', 'missing'],
+                  ['missing', 'foo']],
+            columns=['csi_smiles', 'ms2_smiles'])
+        classified, messages = self.classify(n_jobs=3)
+        # four structures and two InChIKeys instead of 7 + 5 lookups
+        self.assertEqual(len(self.server.arrivals), 6)
+        for idx in ['b', 'c']:
+            pd.testing.assert_series_equal(
+                classified.loc[idx, _classyfire.CLASSYFIRE_LEVELS],
+                classified.loc['a', _classyfire.CLASSYFIRE_LEVELS],
+                check_names=False)
+        self.assertEqual(classified.loc['a', 'kingdom'], 'Organic compounds')
+        self.assertEqual(list(classified.loc[['d', 'e'], 'kingdom']),
+                         ['unexpected server response'] * 2)
+        self.assertEqual(list(classified.loc[['f', 'g'], 'kingdom']),
+                         ['SMILE parse error'] * 2)
+        self.assertIn("('f', 'foo'), ('g', 'foo')", messages[0])
+
+    def test_retried(self):
+        self.feature_data = pd.DataFrame(
+            index=['a', 'b', 'c'],
+            data=[['missing', 'CCO'], ['CCN', 'missing'], ['CN', 'missing']],
+            columns=['csi_smiles', 'ms2_smiles'])
+        classified, messages = self.classify(n_jobs=3, max_retries=3,
+                                             backoff=0.01)
+        # KEY-E succeeds at its third attempt, KEY-D fails all four
+        self.assertEqual(len(self.server.arrivals), 3 + 1 + 3 + 4)
+        self.assertEqual(classified.loc['b', 'kingdom'], 'Organic compounds')
+        self.assertEqual(classified.loc['c', 'kingdom'],
+                         'unexpected server response')
+        self.assertIn("('c', 'CN', 503)", messages[0])
+
+    def test_clientCounters(self):
+        client = _classyfire._HttpClient(_classyfire._RateLimiter(),
+                                         max_retries=1, backoff=0.01)
+        entities = _classyfire._CLASSYFIRE_URL
+        self.assertEqual(client.get(entities + 'KEY-E.json')[0], 503)
+        self.assertEqual(client.get(entities + 'KEY-E.json')[0], 200)
+        self.assertEqual(client.get(entities + 'KEY-D.json')[0], 503)
+        self.assertEqual(client.get(entities + 'KEY-C.json')[0], 404)
+        client.close()
+        self.assertEqual(client.stats['requests'], 2 + 1 + 2 + 1)
+        self.assertEqual(client.stats['retries'], 1 + 0 + 1 + 0)
+        self.assertEqual(client.stats['failures'], 2)
+        self.assertGreater(client.stats['latency'], 0)
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        client = _classyfire._HttpClient(_classyfire._RateLimiter(),
+                                         timeout=0.05, max_retries=1,
+                                         backoff=0)
+        status, text = client.get(_classyfire._CLASSYFIRE_URL + 'KEY-A.json')
+        client.close()
+        self.assertIsNone(status)
+        self.assertTrue(text.startswith('ReadTimeout'))
+        self.assertEqual(client.stats['retries'], 1)
+        self.assertEqual(client.stats['failures'], 1)
+
+    def test_unreachable(self):
+        # a port that nothing listens on
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            root = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.object(_classyfire, '_INCHIKEY_URL',
+                                   root + '/inchikey?smiles='):
+                classified, messages = self.classify(cache_dir=cache_dir,
+                                                     max_retries=1, backoff=0)
+            for idx in ['a', 'b', 'c', 'd', 'e']:
+                self.assertEqual(classified.loc[idx, 'kingdom'],
+                                 'no server response')
+            self.assertEqual(classified.loc['f', 'kingdom'], 'unclassified')
+            self.assertEqual(len(messages), 1)
+            self.assertIn('server did not respond', messages[0])
+            self.assertIn("('e', 'foo', 'ConnectionError", messages[0])
+            # lookups that got no response are not cached
+            exp, exp_messages = self.classify()
+            obs, obs_messages = self.classify(cache_dir=cache_dir)
+        pd.testing.assert_frame_equal(obs, exp)
+        self.assertEqual(obs_messages, exp_messages)
+
+    def test_cachedLookups(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            exp, exp_messages = self.classify()
+            self.classify(cache_dir=cache_dir)
+            self.server.arrivals = []
+            obs, obs_messages = self.classify(cache_dir=cache_dir, n_jobs=2)
+            pd.testing.assert_frame_equal(obs, exp)
+            self.assertEqual(obs_messages, exp_messages)
+            # only the lookups that failed on the server are repeated
+            self.assertEqual(len(self.server.arrivals), 2)
+            self.server.arrivals = []
+            self.classify(cache_dir=cache_dir, negative_ttl=0)
+            # as well as those that were not found, once they expire
+            self.assertEqual(len(self.server.arrivals), 3)
+
+
+class TestLookupCache(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cache', 'lookups.sqlite')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_persistent(self):
+        cache = LookupCache(self.path)
+        cache.put('inchikey', 'CCO', 200, 'KEY-A')
+        cache.put('classyfire', 'KEY-C', 404, '')
+        cache.put('classyfire', 'KEY-D', 503, '')
+        cache.close()
+        cache = LookupCache(self.path)
+        self.assertEqual(cache.get('inchikey', 'CCO'), (200, 'KEY-A'))
+        self.assertEqual(cache.get('classyfire', 'KEY-C'), (404, ''))
+        self.assertIsNone(cache.get('classyfire', 'KEY-D'))
+        self.assertIsNone(cache.get('classyfire', 'CCO'))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        cache.close()
+
+    def test_negativeTTL(self):
+        cache = LookupCache(self.path, negative_ttl=0)
+        cache.put('classyfire', 'KEY-A', 200, '{}')
+        cache.put('classyfire', 'KEY-C', 404, '')
+        time.sleep(0.01)
+        self.assertIsNone(cache.get('classyfire', 'KEY-C'))
+        self.assertEqual(cache.get('classyfire', 'KEY-A'), (200, '{}'))
+        cache.close()
+
+    def test_evictLeastRecentlyUsed(self):
+        cache = LookupCache(self.path, max_entries=2)
+        for smiles in ['CCO', 'CN', 'CC']:
+            cache.put('inchikey', smiles, 200, smiles)
+            time.sleep(0.01)
+        cache.get('inchikey', 'CCO')
+        cache.close()
+        cache = LookupCache(self.path)
+        self.assertIsNotNone(cache.get('inchikey', 'CCO'))
+        self.assertIsNone(cache.get('inchikey', 'CN'))
+        self.assertIsNotNone(cache.get('inchikey', 'CC'))
+        cache.close()
+
+    def test_maxAgeMiss(self):
+        cache = LookupCache(self.path, max_age=0)
+        cache.put('inchikey', 'CCO', 200, 'KEY-A')
+        time.sleep(0.01)
+        # responses older than max_age are not served, even before eviction
+        self.assertIsNone(cache.get('inchikey', 'CCO'))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        cache.close()
+
+    def test_evictDuringRun(self):
+        cache = LookupCache(self.path, max_entries=10)
+        for n in range(250):
+            cache.put('inchikey', 'C' * (n + 1), 200, str(n))
+        # every batch of 100 writes evicts beyond max_entries
+        count, = cache._db.execute('SELECT COUNT(*) FROM lookups').fetchone()
+        self.assertLessEqual(count, 10 + 100)
+        cache.close()
+        cache = LookupCache(self.path)
+        count, = cache._db.execute('SELECT COUNT(*) FROM lookups').fetchone()
+        self.assertEqual(count, 10)
+        cache.close()
+
+    def test_evictOld(self):
+        cache = LookupCache(self.path, max_age=0)
+        cache.put('inchikey', 'CCO', 200, 'KEY-A')
+        time.sleep(0.01)
+        cache.close()
+        cache = LookupCache(self.path)
+        self.assertIsNone(cache.get('inchikey', 'CCO'))
+        cache.close()
+
+
+CANOPUS_HEADER = ('name\tmolecularFormula\tadduct\tmost specific class\t'
+                  'level 5\tsubclass\tclass\tsuperclass\t'
+                  'all classifications\n')
+
+
+class TestCanopusTaxonomy(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.csi = []
+        for n, rows in enumerate([
+                ['0_features_4\tC6H9N3\t[M + H]+\tAminopyrimidines\t\t'
+                 'Pyrimidines\tDiazines\tOrganoheterocyclic compounds\t'
+                 'Chemical entities; Organic compounds; Diazines',
+                 '1_features_7\tC2H6O\t[M + H]+\tAlcohols\t\t\t'
+                 'Organooxygen compounds\tOrganic oxygen compounds\t'
+                 'Organic compounds'],
+                ['0_features_7\tCH4N\t[M + H]+\tAmines\t\t\t\t\t']]):
+            path = os.path.join(self.tmp.name, 'csi%d' % n)
+            os.makedirs(path)
+            with open(os.path.join(path, 'canopus_summary.tsv'), 'w') as fh:
+                fh.write(CANOPUS_HEADER + '\n'.join(rows) + '\n')
+            self.csi.append(path)
+        self.feature_data = pd.DataFrame(
+            index=['h1', 'h2', 'h3', 'h4'],
+            data=[['4', '1'], ['7', '2'], ['9,7', '2,1'], ['5', '1']],
+            columns=['#featureID', 'table_number'])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_canopusTaxonomy(self):
+        with mock.patch.object(_classyfire._HttpClient, 'get',
+                               side_effect=AssertionError('no requests')):
+            with self.assertWarnsRegex(UserWarning,
+                                       r'no CANOPUS prediction.*\(1 of 4\)'
+                                       r':\nh4$'):
+                classified = get_canopus_taxonomy(self.feature_data,
+                                                  self.csi)
+        levels = _classyfire.CLASSYFIRE_LEVELS
+        self.assertEqual(list(classified.index), ['h1', 'h2', 'h3', 'h4'])
+        self.assertEqual(list(classified.loc['h1', levels]),
+                         ['Organic compounds', 'Organoheterocyclic compounds',
+                          'Diazines', 'Pyrimidines', 'Aminopyrimidines'])
+        # feature 7 of the second table
+        self.assertEqual(list(classified.loc['h2', levels]),
+                         ['unclassified'] * 4 + ['Amines'])
+        # feature 9 of the second table has no prediction, 7 of the first
+        self.assertEqual(classified.loc['h3', 'class'],
+                         'Organooxygen compounds')
+        self.assertEqual(classified.loc['h3', 'subclass'], 'unclassified')
+        self.assertEqual(list(classified.loc['h4', levels]),
+                         ['unclassified'] * 5)
+        self.assertEqual(list(classified['table_number']), ['1', '2', '2,1',
+                                                            '1'])
+
+    def test_allPredicted(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                get_canopus_taxonomy(self.feature_data.loc[['h1', 'h2']],
+                                     self.csi)
+        self.assertEqual(caught, [])
+        self.assertEqual(out.getvalue(), '')
+
+    def test_singleTable(self):
+        feature_data = pd.DataFrame(index=['h1', 'h2'], data=['4', '5'],
+                                    columns=['#featureID'])
+        classified = get_canopus_taxonomy(feature_data, self.csi[:1])
+        self.assertEqual(list(classified['superclass']),
+                         ['Organoheterocyclic compounds', 'unclassified'])
+
+    def test_tooFewResults(self):
+        with self.assertRaisesRegex(ValueError, 'refers to 2 feature tables'):
+            get_canopus_taxonomy(self.feature_data, self.csi[:1])
+
+    def test_noCanopus(self):
+        os.remove(os.path.join(self.csi[1], 'canopus_summary.tsv'))
+        with self.assertRaisesRegex(ValueError, 'canopus_summary.tsv'):
+            get_canopus_taxonomy(self.feature_data, self.csi)
+
+    def test_noFeatureIDs(self):
+        with self.assertRaisesRegex(ValueError, '#featureID'):
+            get_canopus_taxonomy(self.feature_data[['table_number']],
+                                 self.csi)
+
+
 if __name__ == '__main__':
     main()
@@ -6,16 +6,42 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from unittest import TestCase, main
+from unittest import TestCase, main, mock
+import io
+import contextlib
 import os
+import hashlib
+import tempfile
+import warnings
 import qiime2
+import numpy as np
 import pandas as pd
 from biom.table import Table
 from biom import load_table
+from skbio import TreeNode, DistanceMatrix
 from q2_qemistree import make_hierarchy
 from q2_qemistree import CSIDirFmt
 
-from q2_qemistree._hierarchy import merge_feature_data
+from sklearn.metrics import pairwise_distances
+from scipy.spatial.distance import squareform, pdist
+from scipy.cluster.hierarchy import linkage
+
+from q2_qemistree._hierarchy import (merge_feature_data, build_tree,
+                                     collate_fingerprints,
+                                     fingerprint_distances)
+from q2_qemistree import _distances
+from q2_qemistree._process_fingerprint import (collate_fingerprint,
+                                               encode_fingerprints,
+                                               decode_fingerprints)
+from q2_qemistree._distances import (pack_fingerprints,
+                                     packed_jaccard_distances,
+                                     condensed_distances,
+                                     informative_columns,
+                                     group_fingerprints,
+                                     FingerprintDistances,
+                                     CondensedDistances)
+from q2_qemistree._linkage import (mst_single_linkage, knn_average_linkage,
+                                   nn_chain_average_linkage, LinkageTree)
 
 
 class TestHierarchy(TestCase):
@@ -88,6 +114,309 @@ class TestHierarchy(TestCase):
         self.assertEqual(len(featrs) == 6, True)
         self.assertEqual(fdata_featrs, featrs)
 
+    def test_mergeFeatureDataWorkers(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        serial = make_hierarchy([goodcsi1, goodcsi2],
+                                [self.features, self.features2])
+        parallel = make_hierarchy([goodcsi1, goodcsi2],
+                                  [self.features, self.features2],
+                                  n_workers=2)
+        self.assertEqual(str(TreeNode.read(str(serial[0]))),
+                         str(TreeNode.read(str(parallel[0]))))
+        self.assertEqual(serial[1], parallel[1])
+        pd.testing.assert_frame_equal(serial[2], parallel[2])
+
+    def test_workerWarnings(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        # a fingerprinted feature is missing from every feature table
+        tables = []
+        for csi, table in [(goodcsi1, self.features),
+                           (goodcsi2, self.features2)]:
+            fid = collate_fingerprint(csi).index[0]
+            ids = [i for i in table.ids(axis='observation') if i != fid]
+            tables.append(table.filter(ids, axis='observation',
+                                       inplace=False))
+        caught = []
+        for n_workers in [1, 2]:
+            with warnings.catch_warnings(record=True) as recorded:
+                warnings.simplefilter('always')
+                make_hierarchy([goodcsi1, goodcsi2], tables,
+                               n_workers=n_workers)
+            caught.append([str(w.message) for w in recorded
+                           if w.category is UserWarning])
+        self.assertEqual(len(caught[0]), 2)
+        self.assertEqual(caught[1], caught[0])
+
+    def test_distanceMatrix(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        for metric in ['euclidean', 'jaccard']:
+            fps = collate_fingerprints([goodcsi1, goodcsi2],
+                                       [self.features, self.features2],
+                                       metric=metric)
+            dm = fingerprint_distances(fps, metric, distance_dtype='float64')
+            exp = pdist(fps.values.astype(float), metric)
+            self.assertEqual(dm.values.ndim, 1)
+            np.testing.assert_allclose(dm.values, exp)
+            self.assertEqual(dm.ids, list(fps.index))
+            self.assertEqual(dm.metric, metric)
+            treeout = make_hierarchy([goodcsi1, goodcsi2],
+                                     [self.features, self.features2],
+                                     metric=metric)[0]
+            reused = make_hierarchy([goodcsi1, goodcsi2],
+                                    [self.features, self.features2],
+                                    metric=metric, distance_matrix=dm)[0]
+            with open(str(treeout)) as f, open(str(reused)) as g:
+                self.assertEqual(f.read(), g.read())
+        dm = fingerprint_distances(fps, 'jaccard')
+        self.assertEqual(dm.values.dtype, np.float32)
+        msg = "needs binary fingerprints"
+        with self.assertRaisesRegex(ValueError, msg):
+            fingerprint_distances(fps + 0.5, 'jaccard')
+        msg = "can only be clustered with `upgma`"
+        with self.assertRaisesRegex(ValueError, msg):
+            make_hierarchy([goodcsi1, goodcsi2],
+                           [self.features, self.features2], metric='jaccard',
+                           distance_matrix=dm, clustering='single-mst')
+        msg = "computed with the jaccard metric, not euclidean"
+        with self.assertRaisesRegex(ValueError, msg):
+            make_hierarchy([goodcsi1, goodcsi2],
+                           [self.features, self.features2],
+                           distance_matrix=dm)
+
+    def test_condensedSubset(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(7, 12),
+                           index=['fp%d' % i for i in range(7)])
+        dm = fingerprint_distances(fps, distance_dtype='float64')
+        self.assertIs(dm.subset(list(fps.index)), dm.values)
+        ids = ['fp5', 'fp1', 'fp6', 'fp2']
+        exp = pdist(fps.loc[ids].values)
+        np.testing.assert_allclose(dm.subset(ids), exp)
+        with self.assertRaisesRegex(ValueError, "7 fingerprints need 21"):
+            CondensedDistances(dm.values[1:], dm.ids, 'euclidean')
+
+    def test_encodedDistanceMatrix(self):
+        # fingerprints stored by collate-fingerprints and distances computed
+        # from them in float64 build the same tree as make-hierarchy itself
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        for metric in ['euclidean', 'jaccard']:
+            fps = collate_fingerprints([goodcsi1, goodcsi2],
+                                       [self.features, self.features2],
+                                       metric=metric)
+            stored = decode_fingerprints(*encode_fingerprints(fps))
+            dm = fingerprint_distances(stored, metric,
+                                       distance_dtype='float64')
+            # as stored in a DistanceMatrix artifact
+            fh = io.StringIO()
+            dm.write_lsmat(fh)
+            fh.seek(0)
+            dm = CondensedDistances.read_lsmat(fh)
+            treeout = make_hierarchy([goodcsi1, goodcsi2],
+                                     [self.features, self.features2],
+                                     metric=metric)[0]
+            reused = make_hierarchy([goodcsi1, goodcsi2],
+                                    [self.features, self.features2],
+                                    metric=metric, distance_matrix=dm)[0]
+            with open(str(treeout)) as f, open(str(reused)) as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_lsmatDistances(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(6, 10),
+                           index=['fp%d' % i for i in range(6)])
+        dm = fingerprint_distances(fps, distance_dtype='float64')
+        fh = io.StringIO()
+        dm.write_lsmat(fh)
+        fh.seek(0)
+        square = DistanceMatrix.read(fh)
+        self.assertEqual(list(square.ids), dm.ids)
+        np.testing.assert_array_equal(square.condensed_form(), dm.values)
+        fh.seek(0)
+        obs = CondensedDistances.read_lsmat(fh)
+        self.assertEqual(obs.ids, dm.ids)
+        self.assertIsNone(obs.metric)
+        np.testing.assert_array_equal(obs.values, dm.values)
+        for i in range(dm.n):
+            np.testing.assert_array_equal(dm.row(i), square.data[i])
+
+    def test_storedDistanceMatrix(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        fps = collate_fingerprints([goodcsi1, goodcsi2],
+                                   [self.features, self.features2])
+        fps = qiime2.Artifact.import_data('FeatureData[MolecularFingerprint]',
+                                          fps).view(pd.DataFrame)
+        dm = fingerprint_distances(fps, distance_dtype='float64')
+        # the distances are a DistanceMatrix for q2-diversity
+        stored = qiime2.Artifact.import_data('DistanceMatrix', dm)
+        self.assertEqual(str(stored.type), 'DistanceMatrix')
+        square = stored.view(DistanceMatrix)
+        self.assertEqual(list(square.ids), dm.ids)
+        np.testing.assert_array_equal(square.condensed_form(), dm.values)
+        obs = stored.view(CondensedDistances)
+        np.testing.assert_array_equal(obs.values, dm.values)
+        treeout = make_hierarchy([goodcsi1, goodcsi2],
+                                 [self.features, self.features2])[0]
+        reused = make_hierarchy([goodcsi1, goodcsi2],
+                                [self.features, self.features2],
+                                distance_matrix=obs)[0]
+        with open(str(treeout)) as f, open(str(reused)) as g:
+            self.assertEqual(f.read(), g.read())
+        compact = qiime2.Artifact.import_data('CondensedDistanceMatrix', dm)
+        obs = compact.view(CondensedDistances)
+        self.assertEqual(obs.metric, 'euclidean')
+        np.testing.assert_array_equal(obs.values, dm.values)
+
+    def test_precisionModes(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        for precision in ['float32', 'uint8']:
+            fps = collate_fingerprints([goodcsi1, goodcsi2],
+                                       [self.features, self.features2],
+                                       precision=precision)
+            self.assertEqual(fps.values.dtype, precision)
+            labels = [hashlib.md5(row.tobytes()).hexdigest()
+                      for row in fps.values]
+            self.assertEqual(list(fps.index), labels)
+            treeout, merged_fts, _ = make_hierarchy(
+                [goodcsi1, goodcsi2], [self.features, self.features2],
+                precision=precision)
+            tips = sorted(tip.name for tip in
+                          TreeNode.read(str(treeout)).tips())
+            self.assertEqual(tips, sorted(fps.index))
+            self.assertEqual(tips,
+                             sorted(merged_fts.ids(axis='observation')))
+
+    def test_quantizedDistances(self):
+        fps = pd.DataFrame(np.random.RandomState(0).randint(
+            0, 256, (40, 300)).astype('uint8'))
+        exp = pdist(fps.values / 255)
+        obs = condensed_distances(fps)
+        np.testing.assert_allclose(obs, exp)
+        np.testing.assert_array_equal(obs, condensed_distances(fps,
+                                                               n_jobs=3))
+        np.testing.assert_array_equal(
+            squareform(obs), FingerprintDistances(fps).rows(np.arange(40)))
+
+    def test_informativeColumns(self):
+        fps = pd.DataFrame([[0, 1, 0.2, 0.5], [0, 1, 0.2, 0.7],
+                            [0, 1, 0.25, 0.1]])
+        np.testing.assert_array_equal(informative_columns(fps),
+                                      [False, False, True, True])
+        np.testing.assert_array_equal(
+            informative_columns(fps, min_variance=0.01),
+            [False, False, False, True])
+        binary = (fps > 0.5).astype(int)
+        np.testing.assert_array_equal(informative_columns(binary, 'jaccard'),
+                                      [False, True, False, True])
+        np.testing.assert_array_equal(
+            informative_columns(fps.mul(255).round().astype('uint8'),
+                                min_variance=0.01),
+            [False, False, False, True])
+
+    def test_dropColumnsLossless(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        for metric in ['euclidean', 'jaccard']:
+            exp = make_hierarchy([goodcsi1, goodcsi2],
+                                 [self.features, self.features2],
+                                 metric=metric)[0]
+            obs = make_hierarchy([goodcsi1, goodcsi2],
+                                 [self.features, self.features2],
+                                 metric=metric, min_column_variance=0)[0]
+            exp, obs = TreeNode.read(str(exp)), TreeNode.read(str(obs))
+            self.assertEqual(obs.compare_rfd(exp), 0)
+            np.testing.assert_allclose(
+                sorted(tip.accumulate_to_ancestor(obs) for tip in obs.tips()),
+                sorted(tip.accumulate_to_ancestor(exp) for tip in exp.tips()))
+
+    def test_dropColumnsVerbose(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        for verbose in [False, True]:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                make_hierarchy([goodcsi1, goodcsi2],
+                               [self.features, self.features2],
+                               min_column_variance=0, verbose=verbose)
+            self.assertEqual('Dropped' in out.getvalue(), verbose)
+
+    def test_groupFingerprints(self):
+        rng = np.random.RandomState(0)
+        base = rng.rand(20, 100)
+        fps = np.vstack([base, base[rng.randint(0, 20, 40)] +
+                         rng.normal(0, 1e-3, (40, 100))])
+        for metric, data, max_distance in [
+                ('euclidean', fps, 0.05),
+                ('jaccard', (fps > 0.5).astype(int), 0.2)]:
+            dists = squareform(pdist(data, metric))
+            exp = np.full(data.shape[0], -1)
+            for i in range(data.shape[0]):
+                if exp[i] < 0:
+                    exp[(exp < 0) & (dists[i] <= max_distance)] = i
+            obs = group_fingerprints(pd.DataFrame(data), metric,
+                                     max_distance)
+            np.testing.assert_array_equal(obs, exp)
+            self.assertLess(len(set(obs)), data.shape[0])
+
+    def test_collapseNearDuplicates(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        _, fts, fdata = make_hierarchy([goodcsi1, goodcsi2],
+                                       [self.features, self.features2])
+        treeout, merged_fts, merged_fdata = make_hierarchy(
+            [goodcsi1, goodcsi2], [self.features, self.features2],
+            collapse_distance=3)
+        tree = TreeNode.read(str(treeout))
+        tip_names = {tip.name for tip in tree.tips()}
+        self.assertEqual(tip_names, set(fts.ids(axis='observation')))
+        self.assertEqual(merged_fts.shape[0], 5)
+        self.assertEqual(set(merged_fts.ids(axis='observation')),
+                         set(merged_fdata.index))
+        for representative, row in merged_fdata.iterrows():
+            members = row['members'].split(',')
+            self.assertIn(representative, members)
+            for label in members:
+                if label != representative:
+                    tip = tree.find(label)
+                    self.assertEqual(tip.length, 0)
+                    self.assertIn(tree.find(representative), tip.siblings())
+            # abundances and feature identifiers of the members are merged
+            # into their representative
+            exp = sum(fts.data(label, axis='observation') for label in members)
+            np.testing.assert_allclose(
+                merged_fts.data(representative, axis='observation'), exp)
+            self.assertEqual(
+                sorted(row['#featureID'].split(',')),
+                sorted(fid for label in members
+                       for fid in fdata.loc[label, '#featureID'].split(',')))
+        self.assertEqual(sorted(label for members in merged_fdata['members']
+                                for label in members.split(',')),
+                         sorted(fdata.index))
+        np.testing.assert_allclose(merged_fts.sum(axis='sample'),
+                                   fts.sum(axis='sample'))
+
+    def test_collapseVerbose(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        for verbose in [False, True]:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                make_hierarchy([goodcsi1, goodcsi2],
+                               [self.features, self.features2],
+                               collapse_distance=3, verbose=verbose)
+            self.assertEqual('Collapsed 6 fingerprints into 5 groups' in
+                             out.getvalue(), verbose)
+
+    def test_collapseSingleRepresentative(self):
+        goodcsi1 = self.goodcsi.view(CSIDirFmt)
+        goodcsi2 = self.goodcsi2.view(CSIDirFmt)
+        msg = "leaves a single representative"
+        with self.assertRaisesRegex(ValueError, msg):
+            make_hierarchy([goodcsi1, goodcsi2],
+                           [self.features, self.features2],
+                           collapse_distance=1e6)
+
     def test_FeatureDataMultipleRepeated(self):
         fdata1 = pd.DataFrame(index=list('aabbc'),
                               data=[['1', '1'], ['1', '2'], ['1', '3'],
@@ -103,6 +432,115 @@ class TestHierarchy(TestCase):
         self.assertEqual(merged_fdata.loc['c', 'table_number'], '1,2,2')
         self.assertEqual(fdata_featrs, ['a', 'b', 'c', 'd', 'e', 'f'])
 
+    def test_packedJaccard(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(20, 100) > 0.7,
+                           dtype=int)
+        fps.iloc[0] = 0
+        fps.iloc[1] = 0
+        exp = squareform(pairwise_distances(fps.values.astype(bool),
+                                            metric='jaccard'), checks=False)
+        obs = packed_jaccard_distances(pack_fingerprints(fps))
+        np.testing.assert_array_equal(obs, exp)
+
+    def test_packedJaccardTiles(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(50, 300) > 0.7,
+                           dtype=int)
+        fps.iloc[3] = 0
+        exp = pairwise_distances(fps.values.astype(bool), metric='jaccard')
+        # tiles of 2 x 2 fingerprints of 5 words
+        with mock.patch.object(_distances, '_TILE_WORDS', 20):
+            obs = packed_jaccard_distances(pack_fingerprints(fps))
+            rows = FingerprintDistances(fps, 'jaccard').rows(
+                [0, 3, 17], to=np.arange(5, 50))
+        np.testing.assert_array_equal(obs, squareform(exp, checks=False))
+        np.testing.assert_array_equal(rows, exp[[0, 3, 17], 5:])
+
+    def test_condensedDistances(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(30, 100))
+        exp = squareform(pairwise_distances(fps.values), checks=False)
+        obs = condensed_distances(fps, 'euclidean')
+        np.testing.assert_allclose(obs, exp)
+        fps = (fps > 0.5).astype(int)
+        exp = squareform(pairwise_distances(fps.values.astype(bool),
+                                            metric='jaccard'), checks=False)
+        obs = condensed_distances(fps, 'jaccard')
+        np.testing.assert_array_equal(obs, exp)
+
+    def test_parallelDistances(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(30, 100))
+        for metric, data in [('euclidean', fps),
+                             ('jaccard', (fps > 0.5).astype(int))]:
+            exp = condensed_distances(data, metric)
+            obs = condensed_distances(data, metric, n_jobs=3)
+            np.testing.assert_array_equal(obs, exp)
+
+    def test_memmapDistances(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(30, 100),
+                           index=['f%d' % i for i in range(30)])
+        exp = build_tree(fps)
+        with tempfile.TemporaryDirectory() as distance_dir:
+            for dtype in ['float32', 'float64']:
+                obs = build_tree(fps, 'euclidean', dtype, distance_dir)
+                self.assertEqual(obs.compare_rfd(exp), 0)
+            self.assertEqual(os.listdir(distance_dir), [])
+        with self.assertWarnsRegex(UserWarning, "copies float32 distances"):
+            build_tree(fps, 'euclidean', 'float32')
+
+    def test_nnChainAverageLinkage(self):
+        rs = np.random.RandomState(0)
+        fps = rs.rand(40, 30)
+        for metric, data in [('euclidean', fps), ('jaccard', fps > 0.5)]:
+            distances = pdist(data, metric)
+            exp = linkage(distances, method='average')
+            with tempfile.TemporaryDirectory() as tmp:
+                condensed = np.memmap(os.path.join(tmp, 'distances'),
+                                      dtype='float64', mode='w+',
+                                      shape=distances.shape)
+                condensed[:] = distances
+                obs = nn_chain_average_linkage(condensed)
+                del condensed
+            np.testing.assert_array_equal(obs, exp)
+
+    def test_mstSingleLinkage(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(30, 100))
+        exp = linkage(pdist(fps.values), method='single')
+        obs = mst_single_linkage(FingerprintDistances(fps))
+        np.testing.assert_array_equal(obs, exp)
+
+    def test_knnAverageLinkage(self):
+        fps = pd.DataFrame(np.random.RandomState(0).rand(30, 100),
+                           index=['f%d' % i for i in range(30)])
+        exp = build_tree(fps)
+        # a complete neighbour graph is exact UPGMA
+        obs = knn_average_linkage(FingerprintDistances(fps), n_neighbors=29)
+        obs = TreeNode.from_linkage_matrix(obs, fps.index.tolist())
+        self.assertEqual(obs.compare_rfd(exp), 0)
+        for clustering in ['single-mst', 'knn-upgma']:
+            obs = build_tree(fps, clustering=clustering, n_neighbors=5)
+            self.assertEqual({tip.name for tip in obs.tips()},
+                             set(fps.index))
+
+    def test_linkageTree(self):
+        fps = np.random.RandomState(0).rand(30, 100)
+        linkage_matrix = linkage(pdist(fps), method='average')
+        tips = ['f%d' % i for i in range(29)] + ["a tip, 'quoted'"]
+        exp = TreeNode.from_linkage_matrix(linkage_matrix, tips)
+        newick = io.StringIO()
+        exp.write(newick)
+        tree = LinkageTree(linkage_matrix, tips)
+        self.assertEqual(tree.to_newick(), newick.getvalue())
+        newick = io.StringIO()
+        tree.to_treenode().write(newick)
+        self.assertEqual(tree.to_newick(), newick.getvalue())
+        tree = LinkageTree(linkage_matrix, tips, {'f3': ['m1', 'm2']})
+        newick = io.StringIO()
+        tree.to_treenode().write(newick)
+        self.assertEqual(tree.to_newick(), newick.getvalue())
+        parent = tree.to_treenode().find('m1').parent
+        self.assertEqual([(child.name, child.length)
+                          for child in parent.children],
+                         [('f3', 0), ('m1', 0), ('m2', 0)])
+
     def test_emptyFeatures(self):
         goodcsi = self.goodcsi.view(CSIDirFmt)
         with self.assertRaises(ValueError):
@@ -112,6 +550,7 @@ class TestHierarchy(TestCase):
         goodcsi = self.goodcsi.view(CSIDirFmt)
         treeout, merged_fts, merged_fdata = make_hierarchy(
             [goodcsi], [self.features])
+        treeout = TreeNode.read(str(treeout))
         tip_names = {node.name for node in treeout.tips()}
         self.assertEqual(tip_names, set(merged_fts._observation_ids))
 
@@ -120,6 +559,7 @@ class TestHierarchy(TestCase):
         goodcsi2 = self.goodcsi2.view(CSIDirFmt)
         treeout, merged_fts, merged_fdata = make_hierarchy(
             [goodcsi1, goodcsi2], [self.features, self.features2])
+        treeout = TreeNode.read(str(treeout))
         tip_names = {node.name for node in treeout.tips()}
         self.assertEqual(tip_names, set(merged_fts._observation_ids))
 
@@ -8,13 +8,15 @@
 
 from unittest import TestCase, main
 import os
+import hashlib
+import numpy as np
 import pandas as pd
-from biom import load_table
+from biom import load_table, Table
 import qiime2
 
 from q2_qemistree import CSIDirFmt
 from q2_qemistree._process_fingerprint import collate_fingerprint
-from q2_qemistree._match import get_matched_tables
+from q2_qemistree._match import get_matched_tables, _md5_rows
 
 
 class TestMatch(TestCase):
@@ -54,6 +56,45 @@ class TestMatch(TestCase):
                                              'ms2_smiles', 'ms2_library_match',
                                              'parent_mass', 'retention_time']))
 
+    def test_md5Rows(self):
+        for fps in [self.tablefp, (self.tablefp > 0.5).astype(int)]:
+            exp = [str(hashlib.md5(fps.loc[fid].values.tobytes()).hexdigest())
+                   for fid in fps.index]
+            self.assertEqual(_md5_rows(fps.values), exp)
+            self.assertEqual(_md5_rows(fps.values, n_jobs=3), exp)
+
+    def test_md5RowsBinary(self):
+        # boolean fingerprints keep the labels of integer fingerprints
+        binary = (self.tablefp > 0.5).astype(int)
+        self.assertEqual(_md5_rows(binary.values.astype(bool)),
+                         _md5_rows(binary.values))
+        self.assertEqual(_md5_rows(binary.values.astype(bool), n_jobs=2),
+                         _md5_rows(binary.values))
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        jaccard = collate_fingerprint(goodcsi, metric='jaccard')
+        self.assertEqual(jaccard.values.dtype, bool)
+        obs = get_matched_tables(jaccard, self.smiles, self.features)[0]
+        exp = get_matched_tables(binary, self.smiles, self.features)[0]
+        self.assertEqual(list(obs.index), list(exp.index))
+        self.assertEqual(obs.values.dtype, bool)
+        np.testing.assert_array_equal(obs.values, exp.values)
+
+    def test_collapseSparse(self):
+        fps = pd.DataFrame([[1, 0], [1, 0], [0, 1]], index=['a', 'b', 'c'])
+        smiles = pd.DataFrame({col: 'x' for col in [
+            'csi_smiles', 'ms2_smiles', 'ms2_library_match', 'parent_mass',
+            'retention_time']}, index=['a', 'b', 'c'])
+        table = Table(np.array([[1, 0, 2], [3, 0, 0], [0, 5, 0],
+                                [7, 7, 7]]),
+                      ['a', 'b', 'c', 'd'], ['s1', 's2', 's3'])
+        relabeled_fps, matched_ft, _ = get_matched_tables(fps, smiles, table)
+        exp = table.filter(['a', 'b', 'c'], axis='observation',
+                           inplace=False).to_dataframe(dense=True)
+        exp = exp.groupby(_md5_rows(fps.values)).sum()
+        obs = matched_ft.to_dataframe(dense=True)
+        pd.testing.assert_frame_equal(obs, exp, check_names=False)
+        self.assertEqual(list(relabeled_fps.index), list(obs.index))
+
     def test_matchFps(self):
         relabeled_fps, matched_ft, matched_fdata = get_matched_tables(
             self.tablefp, self.smiles, self.features)
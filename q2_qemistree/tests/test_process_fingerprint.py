@@ -8,14 +8,22 @@
 
 from unittest import TestCase, main
 from biom import load_table
+import numpy as np
 import pandas as pd
 import os
+import shutil
+import tempfile
 import pkg_resources
 import qiime2
 
 from q2_qemistree import CSIDirFmt
+from q2_qemistree._hierarchy import collate_fingerprints
 from q2_qemistree._process_fingerprint import (collate_fingerprint,
-                                               get_feature_smiles)
+                                               get_feature_smiles,
+                                               process_csi_results,
+                                               encode_fingerprints,
+                                               decode_fingerprints,
+                                               _open_csi_result)
 
 data = pkg_resources.resource_filename('q2_qemistree', 'data')
 
@@ -27,8 +35,8 @@ class FingerprintTests(TestCase):
                                          'data/features_formated.biom')
         self.emptycsi = os.path.join(os.path.join(THIS_DIR,
                                                   'data/emptycsi'))
-        self.goodcsi = qiime2.Artifact.load(os.path.join(THIS_DIR,
-                                                         'data/csiFolder.qza'))
+        self.goodcsi_fp = os.path.join(THIS_DIR, 'data/csiFolder.qza')
+        self.goodcsi = qiime2.Artifact.load(self.goodcsi_fp)
         properties_path = os.path.join(data, 'molecular_properties.tsv')
         self.properties = pd.read_csv(properties_path, dtype=str, sep='\t')
         self.properties.set_index('absoluteIndex', inplace=True)
@@ -60,6 +68,123 @@ class FingerprintTests(TestCase):
         indx = self.properties.index
         self.assertEqual(set(tablefp.columns) == set(indx), True)
 
+    def test_collateThreaded(self):
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        tablefp = collate_fingerprint(goodcsi)
+        threadedfp = collate_fingerprint(goodcsi, n_jobs=4)
+        pd.testing.assert_frame_equal(tablefp, threadedfp)
+
+    def test_collateCached(self):
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        tablefp = collate_fingerprint(goodcsi)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            storedfp = collate_fingerprint(goodcsi, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            cachedfp = collate_fingerprint(goodcsi, cache_dir=cache_dir)
+        pd.testing.assert_frame_equal(tablefp, storedfp)
+        pd.testing.assert_frame_equal(tablefp, cachedfp)
+
+    def test_cacheKeyContents(self):
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = os.path.join(tmp, 'csi-output')
+            shutil.copytree(goodcsi.get_path(), folder)
+            cache_dir = os.path.join(tmp, 'cache')
+            storedfp = collate_fingerprint(folder, cache_dir=cache_dir)
+            # change one probability without changing the file size
+            fid = storedfp.index[0]
+            fpdir = next(os.path.join(folder, name, 'fingerprints')
+                         for name in os.listdir(folder)
+                         if name.split('_')[-1] == fid)
+            fpfile = os.path.join(fpdir, os.listdir(fpdir)[0])
+            with open(fpfile) as fh:
+                lines = fh.read().split('\n')
+            value = lines[0]
+            lines[0] = value[:-1] + ('1' if value[-1] != '1' else '2')
+            with open(fpfile, 'w') as fh:
+                fh.write('\n'.join(lines))
+            cachedfp = collate_fingerprint(folder, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+            self.assertNotEqual(cachedfp.iloc[0, 0], storedfp.iloc[0, 0])
+            pd.testing.assert_frame_equal(cachedfp.iloc[1:],
+                                          storedfp.iloc[1:])
+            # the contents of an artifact are keyed on its checksums
+            collate_fingerprint(self.goodcsi_fp, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 6)
+
+    def test_processArchive(self):
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        tablefp, smiles = process_csi_results(goodcsi)
+        archivefp, archivesmiles = process_csi_results(self.goodcsi_fp)
+        pd.testing.assert_frame_equal(tablefp.sort_index(),
+                                      archivefp.sort_index())
+        pd.testing.assert_frame_equal(smiles.sort_index(),
+                                      archivesmiles.sort_index())
+
+    def test_processOpenReader(self):
+        # a reader passed in stays open for its owner
+        reader = _open_csi_result(self.goodcsi_fp)
+        try:
+            tablefp, smiles = process_csi_results(reader)
+            again, _ = process_csi_results(reader)
+            self.assertIsNotNone(reader.read('csi_fingerid.tsv'))
+        finally:
+            reader.close()
+        pd.testing.assert_frame_equal(tablefp, again)
+
+    def test_encodeFingerprints(self):
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        tablefp = collate_fingerprint(goodcsi)
+        matrix, index = encode_fingerprints(tablefp)
+        self.assertEqual(index['encoding'], 'float64')
+        decoded = decode_fingerprints(matrix, index)
+        pd.testing.assert_frame_equal(decoded, tablefp, check_names=False)
+        tablefp = collate_fingerprint(goodcsi, metric='jaccard')
+        matrix, index = encode_fingerprints(tablefp)
+        self.assertEqual(index['encoding'], 'packed-bits')
+        self.assertEqual(matrix.shape, (tablefp.shape[0],
+                                        (tablefp.shape[1] + 7) // 8))
+        decoded = decode_fingerprints(matrix, index)
+        pd.testing.assert_frame_equal(decoded, tablefp, check_names=False)
+
+    def test_encodeCollated(self):
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        features = load_table(self.featureTable)
+        for metric, precision, encoding in [
+                ('euclidean', 'float64', 'float64'),
+                ('euclidean', 'float32', 'float32'),
+                ('euclidean', 'uint8', 'uint8'),
+                ('jaccard', 'float64', 'packed-bits')]:
+            collated = collate_fingerprints([goodcsi], [features], metric,
+                                            precision=precision)
+            matrix, index = encode_fingerprints(collated)
+            self.assertEqual(index['encoding'], encoding)
+            pd.testing.assert_frame_equal(decode_fingerprints(matrix, index),
+                                          collated)
+
+    def test_collatePrecision(self):
+        goodcsi = self.goodcsi.view(CSIDirFmt)
+        tablefp = collate_fingerprint(goodcsi)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for precision in ['float32', 'uint8']:
+                obs = collate_fingerprint(goodcsi, precision=precision,
+                                          cache_dir=cache_dir)
+                self.assertEqual(obs.values.dtype, precision)
+                cached = collate_fingerprint(goodcsi, precision=precision,
+                                             cache_dir=cache_dir)
+                pd.testing.assert_frame_equal(obs, cached)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+        np.testing.assert_array_equal(
+            obs.values, np.rint(tablefp.values * 255).astype('uint8'))
+        matrix, index = encode_fingerprints(obs)
+        self.assertEqual(index['encoding'], 'uint8')
+        pd.testing.assert_frame_equal(decode_fingerprints(matrix, index),
+                                      obs, check_names=False)
+        jaccard = collate_fingerprint(goodcsi, metric='jaccard',
+                                      precision='uint8')
+        pd.testing.assert_frame_equal(
+            jaccard, collate_fingerprint(goodcsi, metric='jaccard'))
+
 
 if __name__ == '__main__':
     main()
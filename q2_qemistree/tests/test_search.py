@@ -0,0 +1,111 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2018, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+import qiime2
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+
+from q2_qemistree import build_fingerprint_index, query_fingerprint_index
+from q2_qemistree._search import FingerprintSearchIndex
+from q2_qemistree._distances import quantize_fingerprints
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        centers = rng.rand(10, 50)
+        fps = np.clip(centers[rng.randint(0, 10, 500)] +
+                      rng.normal(0, 0.05, (500, 50)), 0, 1)
+        self.fps = pd.DataFrame(fps, index=['f%d' % i for i in range(500)])
+        self.queries = pd.DataFrame(
+            np.clip(centers[rng.randint(0, 10, 20)] +
+                    rng.normal(0, 0.05, (20, 50)), 0, 1),
+            index=['q%d' % i for i in range(20)])
+
+    def brute_force(self, fps, queries, metric, k):
+        dists = cdist(queries.values.astype(float),
+                      fps.values.astype(float), metric)
+        nearest = np.argsort(dists, axis=1, kind='mergesort')[:, :k]
+        return (fps.index.values[nearest],
+                np.take_along_axis(dists, nearest, axis=1))
+
+    def test_exactWithAllLists(self):
+        for metric, fps, queries in [
+                ('euclidean', self.fps, self.queries),
+                ('jaccard', (self.fps > 0.5).astype(int),
+                 (self.queries > 0.5).astype(int))]:
+            index = build_fingerprint_index(fps, metric, n_lists=16)
+            neighbors, dists = index.query(queries, 5, n_probe=16)
+            exp_dists = self.brute_force(fps, queries, metric, 5)[1]
+            np.testing.assert_allclose(dists, exp_dists)
+            if metric == 'euclidean':
+                exp_neighbors = self.brute_force(fps, queries, metric, 5)[0]
+                np.testing.assert_array_equal(neighbors, exp_neighbors)
+
+    def test_quantized(self):
+        fps = pd.DataFrame(quantize_fingerprints(self.fps.values),
+                           index=self.fps.index)
+        queries = pd.DataFrame(quantize_fingerprints(self.queries.values),
+                               index=self.queries.index)
+        index = build_fingerprint_index(fps, n_lists=16)
+        obs = index.query(queries, 5, n_probe=16)
+        exp = self.brute_force(fps / 255, queries / 255, 'euclidean', 5)
+        np.testing.assert_array_equal(obs[0], exp[0])
+        np.testing.assert_allclose(obs[1], exp[1])
+
+    def test_recall(self):
+        index = build_fingerprint_index(self.fps, n_lists=20)
+        neighbors, _ = index.query(self.queries, 10, n_probe=4, n_jobs=2)
+        exp = self.brute_force(self.fps, self.queries, 'euclidean', 10)[0]
+        recall = np.mean([len(set(o) & set(e)) / 10
+                          for o, e in zip(neighbors, exp)])
+        self.assertGreater(recall, 0.9)
+
+    def test_fewFingerprints(self):
+        index = build_fingerprint_index(self.fps.iloc[:3], n_lists=2)
+        neighbors, dists = index.query(self.queries, 10, n_probe=1)
+        self.assertEqual(neighbors.shape, (20, 3))
+        self.assertTrue((np.diff(dists, axis=1) >= 0).all())
+
+    def test_queryTable(self):
+        index = build_fingerprint_index(self.fps)
+        obs = query_fingerprint_index(index, self.fps.iloc[:4],
+                                      n_neighbors=3)
+        self.assertEqual(list(obs.index), ['f0', 'f1', 'f2', 'f3'])
+        for label, row in obs.iterrows():
+            neighbors = row['neighbors'].split(',')
+            self.assertEqual(len(neighbors), 3)
+            self.assertEqual(neighbors[0], label)
+            self.assertAlmostEqual(float(row['distances'].split(',')[0]), 0,
+                                   places=5)
+
+    def test_queryColumns(self):
+        index = build_fingerprint_index(self.fps)
+        with self.assertRaisesRegex(ValueError, 'same columns'):
+            query_fingerprint_index(index, self.queries.iloc[:, :10])
+
+    def test_jaccardNotBinary(self):
+        with self.assertRaisesRegex(ValueError, 'binary fingerprints'):
+            build_fingerprint_index(self.fps, 'jaccard')
+
+    def test_storedIndex(self):
+        fps = (self.fps > 0.5).astype(int)
+        index = build_fingerprint_index(fps, 'jaccard', n_lists=8)
+        stored = qiime2.Artifact.import_data('FingerprintIndex', index)
+        obs = stored.view(FingerprintSearchIndex)
+        queries = (self.queries > 0.5).astype(int)
+        exp = index.query(queries, 5)
+        self.assertEqual(obs.metric, 'jaccard')
+        np.testing.assert_array_equal(obs.query(queries, 5)[0], exp[0])
+        np.testing.assert_array_equal(obs.query(queries, 5)[1], exp[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@
 # ----------------------------------------------------------------------------
 
 from unittest import TestCase, main
-from q2_qemistree._semantics import validate_mgf
+from q2_qemistree._semantics import validate_mgf, validate_neighbors
 
 
 class FingerprintTests(TestCase):
@@ -84,6 +84,38 @@ class FingerprintTests(TestCase):
             validate_mgf(doubled.split('\n'))
 
 
+class NeighborsTests(TestCase):
+    def test_validate_neighbors(self):
+        self.assertTrue(validate_neighbors(GOOD_NEIGHBORS.split('\n')))
+
+    def test_validate_molecules(self):
+        molecules = ['id\t#featureID\tcsi_smiles\tms2_smiles',
+                     'a\t1\tCCO\tmissing']
+        with self.assertRaisesRegex(ValueError, 'columns `id`, `neighbors`'):
+            validate_neighbors(molecules)
+
+    def test_validate_counts(self):
+        bad = GOOD_NEIGHBORS.replace('0.5,0.75', '0.5')
+        with self.assertRaisesRegex(ValueError, 'Query "q2" has 2 neighbours '
+                                    'but 1 distances'):
+            validate_neighbors(bad.split('\n'))
+
+    def test_validate_sorted(self):
+        bad = GOOD_NEIGHBORS.replace('0.5,0.75', '0.75,0.5')
+        with self.assertRaisesRegex(ValueError, 'not sorted'):
+            validate_neighbors(bad.split('\n'))
+
+    def test_validate_numbers(self):
+        bad = GOOD_NEIGHBORS.replace('0.5,0.75', '0.5,far')
+        with self.assertRaisesRegex(ValueError, 'not numbers'):
+            validate_neighbors(bad.split('\n'))
+
+
+GOOD_NEIGHBORS = """id\tneighbors\tdistances
+q1\ta,b\t0.0,0.25
+q2\tc,a\t0.5,0.75
+"""
+
 GOOD_MGF = """BEGIN IONS
 FEATURE_ID=1
 PEPMASS=267.137451171875